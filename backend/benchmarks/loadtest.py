@@ -0,0 +1,416 @@
+"""
+End-to-end load test of the ASGI application, in process.
+
+Provisions a dedicated Postgres database from ddl.sql with synthetic users
+and services, then drives serviceauth.asgi.application directly (no sockets,
+no nginx) with a request mix and prints throughput and latency percentiles
+per endpoint as JSON, so two runs can be diffed or compared by a script.
+
+    # once: create/reset the database and seed 10k users, 20 services
+    python benchmarks/loadtest.py --provision --reset --users 10000 --services 20
+
+    # closed loop, 64 clients for 30s
+    python benchmarks/loadtest.py --concurrency 64 --duration 30 --output before.json
+
+    # open loop, 800 requests/s with Poisson arrivals
+    python benchmarks/loadtest.py --rate 800 --duration 30
+
+The default mix is mostly auth_request validations with some logins and
+refreshes and the occasional admin read/write, --mix changes it. Open loop
+latencies are measured from the scheduled start, so queueing shows up in the
+percentiles instead of silently lowering the offered rate.
+"""
+from datetime import datetime,timezone
+import argparse
+import asyncio
+import random
+import json
+import time
+import tempfile
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DDL_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "ddl.sql")
+DEFAULT_MIX = "validate=88,validate_denied=4,login=3,refresh=3,admin_read=1,admin_write=1"
+LOADTEST_PASSWORD = "loadtest1"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    db = parser.add_argument_group("database")
+    db.add_argument("--db-host", default=os.environ.get("LOADTEST_DB_HOST", "127.0.0.1"))
+    db.add_argument("--db-name", default=os.environ.get("LOADTEST_DB_NAME", "auth_service_loadtest"))
+    db.add_argument("--db-user", default=os.environ.get("LOADTEST_DB_USER", "postgres"))
+    db.add_argument("--db-password", default=os.environ.get("LOADTEST_DB_PASSWORD", "postgres"))
+    seed = parser.add_argument_group("provisioning")
+    seed.add_argument("--provision", action="store_true", help="create the database and schema, seed synthetic data")
+    seed.add_argument("--reset", action="store_true", help="drop and recreate the database first")
+    seed.add_argument("--users", type=int, default=10000)
+    seed.add_argument("--admins", type=int, default=5)
+    seed.add_argument("--services", type=int, default=20)
+    seed.add_argument("--access-per-user", type=int, default=5)
+    seed.add_argument("--password-hash-n", type=int, help="scrypt n for the seeded passwords and logins (PASSWORD_HASH_N)")
+    run = parser.add_argument_group("load")
+    run.add_argument("--duration", type=float, default=30, help="seconds of measured load")
+    run.add_argument("--warmup", type=float, default=5, help="seconds of unmeasured load first")
+    run.add_argument("--concurrency", type=int, default=32, help="closed loop clients")
+    run.add_argument("--rate", type=float, help="open loop requests/second instead of a closed loop")
+    run.add_argument("--mix", default=DEFAULT_MIX, help=f"endpoint=weight list (default {DEFAULT_MIX})")
+    run.add_argument("--tokens", type=int, default=2000, help="distinct users with pre-minted tokens")
+    run.add_argument("--seed", type=int, default=1, help="random seed, same seed = same request sequence")
+    run.add_argument("--output", help="also write the JSON report to this file")
+    return parser.parse_args()
+
+
+def configure(args):
+    # Before Django and the utils modules are imported, they read these at import time
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "serviceauth.settings")
+    if args.password_hash_n:
+        os.environ["PASSWORD_HASH_N"] = str(args.password_hash_n)
+    # Same private per-user directory as the default one, the snapshot refuses shared dirs
+    os.environ.setdefault("ACCESS_SNAPSHOT_PATH", os.path.join(tempfile.gettempdir(), f"serviceauth-{os.getuid()}",
+                                                                f"{args.db_name}.snapshot"))
+
+    from utils import database
+    database.DB_HOST = args.db_host
+    database.DB_NAME = args.db_name
+    database.DB_USER = args.db_user
+    database.DB_PASSWORD = args.db_password
+
+
+def provision(args):
+    import psycopg2
+    from psycopg2 import sql
+    from utils.passwords import make_hash
+    from utils.change_feed import suppress_row_notifications
+
+    if "loadtest" not in args.db_name and args.reset:
+        sys.exit(f"Refusing to reset '{args.db_name}', load test database names must contain 'loadtest'.")
+
+    admin = psycopg2.connect(host=args.db_host, dbname="postgres", user=args.db_user, password=args.db_password)
+    admin.autocommit = True
+    cur = admin.cursor()
+    cur.execute("SELECT 1 FROM pg_database WHERE datname = %s", (args.db_name,))
+    exists = cur.fetchone() is not None
+    if exists and args.reset:
+        cur.execute(sql.SQL("DROP DATABASE {} WITH (FORCE)").format(sql.Identifier(args.db_name)))
+        exists = False
+    if not exists:
+        cur.execute(sql.SQL("CREATE DATABASE {}").format(sql.Identifier(args.db_name)))
+    cur.close()
+    admin.close()
+
+    conn = psycopg2.connect(host=args.db_host, dbname=args.db_name, user=args.db_user, password=args.db_password)
+    cur = conn.cursor()
+    cur.execute("SELECT to_regclass('usr_info')")
+    if cur.fetchone()[0] is None:
+        with open(DDL_PATH, encoding="utf-8") as ddl:
+            cur.execute(ddl.read())
+    conn.commit()
+
+    started = time.perf_counter()
+    suppress_row_notifications(cur)
+    cur.execute("TRUNCATE usr_info, services_info RESTART IDENTITY CASCADE")
+    cur.execute("""
+        INSERT INTO services_info (srv_name, srv_ip, srv_desc, srv_prefix, srv_upstream)
+        SELECT 'loadtest service ' || g, '127.0.0.1', 'synthetic', '/loadtest_' || g || '/', 'http://127.0.0.1:9/'
+        FROM generate_series(1, %s) g
+    """, (args.services,))
+    # One hash for everybody, hashing 10k passwords would dominate provisioning
+    cur.execute("""
+        INSERT INTO usr_info (usr_login, usr_password, usr_admin, created_at, jwt_expiration)
+        SELECT 'loadtest_' || g, %s, g <= %s, now() - (g || ' seconds')::interval, '1'
+        FROM generate_series(1, %s) g
+    """, (make_hash(LOADTEST_PASSWORD), args.admins, args.users))
+    cur.execute("""
+        INSERT INTO user_service_access (usr_id, srv_id)
+        SELECT u.usr_id, s.srv_id FROM usr_info u
+        JOIN services_info s ON (s.srv_id + u.usr_id) %% %s < %s
+    """, (args.services, min(args.access_per_user, args.services)))
+    conn.commit()
+    cur.execute("ANALYZE")
+    conn.commit()
+    cur.close()
+    conn.close()
+    print(f"Provisioned {args.db_name}: {args.users} users, {args.services} services "
+          f"in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+
+
+class Fixtures:
+    """Users, pre-minted tokens and services the request generators pick from."""
+
+    def __init__(self, args):
+        from utils.database import db_connection
+        from utils.access import ACCESS_ARRAY_SQL
+        from utils.jwt import create_token
+
+        with db_connection() as conn:
+            cur = conn.cursor()
+            try:
+                cur.execute(f"""
+                    SELECT usr_id, usr_login, usr_admin, usr_perm_version, {ACCESS_ARRAY_SQL}
+                    FROM usr_info ORDER BY usr_id
+                """)
+                users = cur.fetchall()
+                cur.execute("SELECT srv_id FROM services_info ORDER BY srv_id")
+                self.services = [row[0] for row in cur.fetchall()]
+            finally:
+                cur.close()
+        if not users or not self.services:
+            sys.exit("The load test database is empty, run with --provision first.")
+
+        rng = random.Random(args.seed)
+        self.logins = [login for _, login, admin, _, _ in users if not admin]
+        self.user_ids = [user_id for user_id, _, admin, _, _ in users if not admin]
+        self.sessions = []
+        for user_id, login, admin, perm_version, access in rng.sample(users, min(args.tokens, len(users))):
+            if admin or not access:
+                continue
+            denied = [srv_id for srv_id in self.services if srv_id not in access]
+            self.sessions.append({
+                "access_token": create_token(user_id, login, 1, access, perm_version),
+                "refresh_token": create_token(user_id, login, 90),
+                "allowed": access,
+                "denied": denied,
+            })
+        admin_user = next(user for user in users if user[2])
+        self.admin_token = create_token(admin_user[0], admin_user[1], 1)
+
+
+def build_request(kind, fixtures, rng):
+    """(method, path, query string, headers, body) for one request of the given kind."""
+    ip = f"10.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(1, 255)}".encode()
+    json_headers = [(b"content-type", b"application/json"), (b"x-real-ip", ip)]
+    if kind in ("validate", "validate_denied"):
+        session = rng.choice(fixtures.sessions)
+        services = session["denied"] if kind == "validate_denied" and session["denied"] else session["allowed"]
+        return "GET", "/api/v1/users/validate", "", [
+            (b"authorization", f"Bearer {session['access_token']}".encode()),
+            (b"x-service-id", str(rng.choice(services)).encode()),
+        ], b""
+    if kind == "login":
+        body = {"user_name": rng.choice(fixtures.logins), "user_pass": LOADTEST_PASSWORD}
+        return "POST", "/api/v1/users/login/", "", json_headers, json.dumps(body).encode()
+    if kind == "refresh":
+        body = {"refresh_token": rng.choice(fixtures.sessions)["refresh_token"]}
+        return "POST", "/api/v1/users/refresh/", "", json_headers, json.dumps(body).encode()
+    admin_headers = json_headers + [(b"authorization", f"Bearer {fixtures.admin_token}".encode())]
+    if kind == "admin_read":
+        return "GET", "/api/v1/users/admin/", "limit=50", admin_headers, b""
+    if kind == "admin_write":
+        user_id = rng.choice(fixtures.user_ids)
+        body = {"access": rng.sample(fixtures.services, min(3, len(fixtures.services)))}
+        return "PUT", f"/api/v1/users/admin/{user_id}/", "", admin_headers, json.dumps(body).encode()
+    raise ValueError(f"unknown request kind {kind}")
+
+
+async def call(app, method, path, query_string, headers, body):
+    """One request through the ASGI app, returns the status code."""
+    sent = False
+    response = {}
+    done = asyncio.Event()
+
+    async def receive():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await done.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+        elif message["type"] == "http.response.body" and not message.get("more_body"):
+            done.set()
+
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+        "method": method, "scheme": "http", "path": path, "raw_path": path.encode(),
+        "query_string": query_string.encode(), "root_path": "",
+        "headers": [(b"host", b"localhost")] + headers + [(b"content-length", str(len(body)).encode())],
+        "client": ("127.0.0.1", 40000), "server": ("localhost", 80),
+    }
+    try:
+        await app(scope, receive, send)
+    finally:
+        done.set()
+    return response.get("status", 0)
+
+
+class Recorder:
+    def __init__(self):
+        self.measuring = False
+        self.samples = {}   # kind -> list of latencies (seconds)
+        self.statuses = {}  # kind -> {status: count}
+
+    def record(self, kind, status_code, latency):
+        if not self.measuring:
+            return
+        self.samples.setdefault(kind, []).append(latency)
+        counts = self.statuses.setdefault(kind, {})
+        counts[status_code] = counts.get(status_code, 0) + 1
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+# Responses that are the expected answer for the kind, anything else counts as an error
+EXPECTED_STATUS = {"validate": {200}, "validate_denied": {401}, "login": {200}, "refresh": {200},
+                   "admin_read": {200}, "admin_write": {200}}
+
+
+def summarize(recorder, duration):
+    endpoints = {}
+    total = 0
+    for kind, latencies in sorted(recorder.samples.items()):
+        latencies.sort()
+        errors = sum(count for status_code, count in recorder.statuses[kind].items()
+                     if status_code not in EXPECTED_STATUS[kind])
+        total += len(latencies)
+        endpoints[kind] = {
+            "requests": len(latencies),
+            "errors": errors,
+            "throughput_rps": round(len(latencies) / duration, 1),
+            "status": {str(code): count for code, count in sorted(recorder.statuses[kind].items())},
+            "latency_ms": {
+                "mean": round(sum(latencies) / len(latencies) * 1000, 3),
+                "p50": round(percentile(latencies, 0.50) * 1000, 3),
+                "p90": round(percentile(latencies, 0.90) * 1000, 3),
+                "p99": round(percentile(latencies, 0.99) * 1000, 3),
+                "p999": round(percentile(latencies, 0.999) * 1000, 3),
+                "max": round(latencies[-1] * 1000, 3),
+            },
+        }
+    return endpoints, round(total / duration, 1)
+
+
+async def one(app, kind, fixtures, rng, recorder, scheduled=None):
+    request = build_request(kind, fixtures, rng)
+    start = scheduled if scheduled is not None else time.perf_counter()
+    try:
+        status_code = await call(app, *request)
+    except Exception as e:
+        print(f"{kind} request failed: {e}", file=sys.stderr)
+        status_code = 0
+    recorder.record(kind, status_code, time.perf_counter() - start)
+
+
+async def closed_loop(app, args, fixtures, kinds, weights, recorder, deadline):
+    async def client(index):
+        rng = random.Random(args.seed * 1000 + index)
+        while time.perf_counter() < deadline:
+            await one(app, rng.choices(kinds, weights)[0], fixtures, rng, recorder)
+
+    await asyncio.gather(*(client(index) for index in range(args.concurrency)))
+
+
+async def open_loop(app, args, fixtures, kinds, weights, recorder, deadline):
+    rng = random.Random(args.seed)
+    tasks = set()
+    next_at = time.perf_counter()
+    while next_at < deadline:
+        delay = next_at - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        task = asyncio.create_task(one(app, rng.choices(kinds, weights)[0], fixtures,
+                                       random.Random(rng.random()), recorder, scheduled=next_at))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        next_at += rng.expovariate(args.rate)
+    if tasks:
+        await asyncio.gather(*tasks)
+
+
+class Lifespan:
+    """Drives the app's lifespan protocol like uvicorn would."""
+
+    def __init__(self, app):
+        self.app = app
+        self.messages = asyncio.Queue()
+        self.replies = asyncio.Queue()
+        self.task = None
+
+    async def startup(self):
+        self.task = asyncio.create_task(self.app({"type": "lifespan", "asgi": {"version": "3.0"}},
+                                                 self.messages.get, self.replies.put))
+        await self.messages.put({"type": "lifespan.startup"})
+        await self.replies.get()
+
+    async def shutdown(self):
+        await self.messages.put({"type": "lifespan.shutdown"})
+        await self.replies.get()
+        await self.task
+
+
+async def run(args):
+    from serviceauth.asgi import application
+
+    mix = dict(item.split("=") for item in args.mix.split(","))
+    kinds = [kind for kind in mix if kind in EXPECTED_STATUS]
+    weights = [float(mix[kind]) for kind in kinds]
+    if len(kinds) != len(mix):
+        sys.exit(f"Unknown endpoints in --mix, known: {', '.join(EXPECTED_STATUS)}")
+
+    fixtures = Fixtures(args)
+    lifespan = Lifespan(application)
+    await lifespan.startup()
+
+    recorder = Recorder()
+    runner = open_loop if args.rate else closed_loop
+    if args.warmup:
+        await runner(application, args, fixtures, kinds, weights, recorder, time.perf_counter() + args.warmup)
+    recorder.measuring = True
+    started = time.perf_counter()
+    await runner(application, args, fixtures, kinds, weights, recorder, started + args.duration)
+    elapsed = time.perf_counter() - started
+    recorder.measuring = False
+    await lifespan.shutdown()
+
+    endpoints, throughput = summarize(recorder, elapsed)
+    from utils.database import get_pool_stats
+    from utils.auth_cache import decision_cache
+    return {
+        "started_at": datetime.now(tz=timezone.utc).isoformat(),
+        "config": {
+            "mode": "open" if args.rate else "closed",
+            "rate": args.rate,
+            "concurrency": None if args.rate else args.concurrency,
+            "duration": args.duration,
+            "warmup": args.warmup,
+            "mix": dict(zip(kinds, weights)),
+            "seed": args.seed,
+            "python": sys.version.split()[0],
+            "cpus": os.cpu_count(),
+        },
+        "throughput_rps": throughput,
+        "endpoints": endpoints,
+        "db_pool": get_pool_stats(),
+        "decision_cache": decision_cache.stats(),
+    }
+
+
+def main():
+    args = parse_args()
+    configure(args)
+    import django
+    django.setup()
+
+    if args.provision:
+        provision(args)
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2, default=str)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            output.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
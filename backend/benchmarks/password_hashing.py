@@ -0,0 +1,82 @@
+"""
+Login throughput per scrypt cost setting.
+
+For each (n, r, p) it times single verifications and then runs the password
+pool with 1..--workers threads, printing verifications (≈ logins) per second
+overall and per core. Pick PASSWORD_HASH_N/R/P from the row that still fits
+the expected login rate on the production core count.
+
+    python benchmarks/password_hashing.py --seconds 3 --workers 4
+"""
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import json
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.passwords import make_hash, check_hash
+
+COSTS = [(2 ** 13, 8, 1), (2 ** 14, 8, 1), (2 ** 15, 8, 1), (2 ** 16, 8, 1)]
+
+
+def single_latency(stored, samples):
+    timings = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        check_hash("benchmark-password1", stored)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return timings[len(timings) // 2] * 1000
+
+
+def throughput(stored, workers, seconds):
+    deadline = time.perf_counter() + seconds
+
+    def loop():
+        done = 0
+        while time.perf_counter() < deadline:
+            check_hash("benchmark-password1", stored)
+            done += 1
+        return done
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        total = sum(executor.map(lambda _: loop(), range(workers)))
+    return total / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--seconds", type=float, default=3, help="duration of each throughput run")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="largest pool size to try")
+    parser.add_argument("--samples", type=int, default=10, help="single-thread latency samples")
+    parser.add_argument("--json", action="store_true", help="print JSON lines instead of a table")
+    args = parser.parse_args()
+
+    if not args.json:
+        print(f"{'n':>7} {'r':>2} {'p':>2} {'mem MiB':>8} {'p50 ms':>8} {'workers':>8} {'logins/s':>9} {'per core':>9}")
+    for n, r, p in COSTS:
+        stored = make_hash("benchmark-password1", n, r, p)
+        latency = single_latency(stored, args.samples)
+        for workers in sorted({1, args.workers}):
+            rate = throughput(stored, workers, args.seconds)
+            result = {
+                "n": n, "r": r, "p": p,
+                "memory_mib": round(128 * n * r / 2 ** 20, 1),
+                "p50_ms": round(latency, 2),
+                "workers": workers,
+                "logins_per_second": round(rate, 1),
+                "logins_per_second_per_core": round(rate / min(workers, os.cpu_count() or 1), 1),
+            }
+            if args.json:
+                print(json.dumps(result))
+            else:
+                print(f"{n:>7} {r:>2} {p:>2} {result['memory_mib']:>8} {result['p50_ms']:>8} {workers:>8} "
+                      f"{result['logins_per_second']:>9} {result['logins_per_second_per_core']:>9}")
+
+
+if __name__ == "__main__":
+    main()
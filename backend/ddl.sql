@@ -12,5 +12,197 @@ create table usr_info (
    usr_password text not null,
    usr_access   text,
    usr_admin    boolean default false,
-   created_at   timestamptz default current_timestamp
-);
\ No newline at end of file
+   created_at   timestamptz default current_timestamp,
+   jwt_expiration text   -- access token lifetime in days, or 'inf'
+);
+
+-- user to service access, replaces the comma separated usr_info.usr_access
+create table user_service_access (
+   usr_id integer not null references usr_info (usr_id) on delete cascade,
+   srv_id integer not null references services_info (srv_id) on delete cascade,
+   primary key (usr_id, srv_id)
+);
+create index user_service_access_srv_usr_idx on user_service_access (srv_id, usr_id);
+
+-- migration: backfill from the legacy usr_access strings ("4,5,7")
+-- usr_access is no longer read or written, kept only for rollback
+insert into user_service_access (usr_id, srv_id)
+select ui.usr_id, trim(a.srv_id)::integer
+from usr_info ui
+cross join lateral unnest(string_to_array(ui.usr_access, ',')) as a (srv_id)
+where trim(a.srv_id) ~ '^\d+$'
+  and exists (select 1 from services_info si where si.srv_id = trim(a.srv_id)::integer)
+on conflict do nothing;
+
+-- permission version, bumped on every change to a user's access or admin flag
+-- tokens with embedded service scopes carry the version they were issued at
+alter table usr_info add column usr_perm_version integer not null default 0;
+
+-- change feed: every write to the auth tables is announced on the auth_changes
+-- channel, workers LISTEN and invalidate their caches (utils/change_feed.py)
+-- (usr_tokens_not_before and revoked_tokens are created further down, the
+-- function only looks them up when it runs)
+create or replace function notify_auth_change() returns trigger as $$
+declare
+   payload json;
+begin
+   -- bulk endpoints send one aggregated notification themselves
+   if current_setting('serviceauth.bulk_change', true) = 'on' then
+      return null;
+   end if;
+   if TG_TABLE_NAME = 'usr_info' then
+      payload := json_build_object('table', TG_TABLE_NAME, 'op', TG_OP,
+                                   'usr_id', coalesce(NEW.usr_id, OLD.usr_id),
+                                   'pv', NEW.usr_perm_version,
+                                   'nbf', extract(epoch from NEW.usr_tokens_not_before));
+   elsif TG_TABLE_NAME = 'services_info' then
+      payload := json_build_object('table', TG_TABLE_NAME, 'op', TG_OP,
+                                   'srv_id', coalesce(NEW.srv_id, OLD.srv_id));
+   elsif TG_TABLE_NAME = 'revoked_tokens' then
+      payload := json_build_object('table', TG_TABLE_NAME, 'op', TG_OP,
+                                   'usr_id', NEW.usr_id,
+                                   'jti', NEW.jti);
+   else
+      payload := json_build_object('table', TG_TABLE_NAME, 'op', TG_OP,
+                                   'usr_id', coalesce(NEW.usr_id, OLD.usr_id),
+                                   'srv_id', coalesce(NEW.srv_id, OLD.srv_id));
+   end if;
+   perform pg_notify('auth_changes', payload::text);
+   return null;
+end;
+$$ language plpgsql;
+
+-- access changed straight in SQL still has to move the permission version,
+-- otherwise tokens with embedded scopes and the access snapshot miss it
+create or replace function bump_perm_version_on_access_change() returns trigger as $$
+begin
+   if current_setting('serviceauth.bulk_change', true) = 'on' then
+      return null;
+   end if;
+   update usr_info set usr_perm_version = usr_perm_version + 1
+   where usr_id = coalesce(NEW.usr_id, OLD.usr_id);
+   return null;
+end;
+$$ language plpgsql;
+
+-- same for the admin flag, the access snapshot caches it per version
+create or replace function bump_perm_version_on_admin_change() returns trigger as $$
+begin
+   if NEW.usr_admin is distinct from OLD.usr_admin and NEW.usr_perm_version = OLD.usr_perm_version then
+      NEW.usr_perm_version := OLD.usr_perm_version + 1;
+   end if;
+   return NEW;
+end;
+$$ language plpgsql;
+
+create trigger usr_info_notify after insert or update or delete on usr_info
+   for each row execute function notify_auth_change();
+create trigger services_info_notify after insert or update or delete on services_info
+   for each row execute function notify_auth_change();
+create trigger user_service_access_notify after insert or update or delete on user_service_access
+   for each row execute function notify_auth_change();
+create trigger user_service_access_bump_version after insert or update or delete on user_service_access
+   for each row execute function bump_perm_version_on_access_change();
+create trigger usr_info_bump_version before update of usr_admin on usr_info
+   for each row execute function bump_perm_version_on_admin_change();
+
+-- service images are served by /api/v1/services/<id>/image, the list only
+-- returns a versioned URL built from the hash
+alter table services_info add column srv_image_hash text;
+alter table services_info add column srv_image_type text;
+alter table services_info add column srv_image_updated_at timestamptz;
+
+-- migration: backfill hash and content type for the existing images
+update services_info set
+   srv_image_hash = encode(sha256(srv_image), 'hex'),
+   srv_image_type = case
+      when substring(srv_image from 1 for 8) = '\x89504e470d0a1a0a'::bytea then 'image/png'
+      when substring(srv_image from 1 for 3) = '\xffd8ff'::bytea then 'image/jpeg'
+      when substring(srv_image from 1 for 4) = '\x47494638'::bytea then 'image/gif'
+      else 'application/octet-stream'
+   end,
+   srv_image_updated_at = current_timestamp
+where srv_image is not null;
+
+-- resized renditions of srv_image built in the background (services/renditions.py)
+create table service_image_renditions (
+   srv_id       integer not null references services_info (srv_id) on delete cascade,
+   rendition    text not null,
+   content_type text not null,
+   source_hash  text not null,
+   image_hash   text not null,
+   bytes        integer not null,
+   data         bytea not null,
+   created_at   timestamptz default current_timestamp,
+   primary key (srv_id, rendition, content_type)
+);
+
+-- admin user listing filters (login prefix search, created_at ranges)
+create index usr_info_login_prefix_idx on usr_info (usr_login text_pattern_ops);
+create index usr_info_created_at_idx on usr_info (created_at, usr_id);
+
+-- gateway routing, services/gateway.py renders the nginx locations from these
+-- services without a prefix are left out of the gateway config
+alter table services_info add column srv_prefix text unique;            -- '/painel_relatorios/'
+alter table services_info add column srv_upstream text;                 -- 'http://127.0.0.1:5111/'
+alter table services_info add column srv_rewrite_assets boolean not null default true;
+alter table services_info add column srv_api_prefix text unique;        -- '/api/report_manager_api/'
+alter table services_info add column srv_api_upstream text;             -- 'http://127.0.0.1:5111'
+
+-- migration: the services that were hand written in extra/api-gateway.conf
+update services_info s set srv_prefix = v.prefix, srv_upstream = v.upstream, srv_rewrite_assets = v.rewrite,
+                           srv_api_prefix = v.api_prefix, srv_api_upstream = v.api_upstream
+from (values
+   (4,  '/painel_relatorios/',     'http://127.0.0.1:5111/',                   true,  '/api/report_manager_api/',      'http://127.0.0.1:5111'),
+   (5,  '/painel_pacientes/',      'http://127.0.0.1:5112/',                   true,  '/api/enfermaria_status/',       'http://127.0.0.1:5112'),
+   (6,  '/painel_pacientes_cpoe/', 'http://127.0.0.1:5113/',                   true,  '/api/enfermaria_status_cpoe/',  'http://127.0.0.1:5113'),
+   (7,  '/painel_materiais/',      'http://127.0.0.1:5114/',                   true,  '/api/farmacia_resuprimento/',   'http://127.0.0.1:5114'),
+   (8,  '/painel_prescricao/',     'http://127.0.0.1:5110/',                   true,  '/api/prescricao_api/',          'http://127.0.0.1:5110'),
+   (9,  '/relatorios_samur/',      'http://192.168.1.69/pdf/rel/relatorio/',   false, null,                            null),
+   (10, '/painel_ocupacao/',       'http://192.168.1.69/relatorio_taxa/',      false, null,                            null)
+) as v (srv_id, prefix, upstream, rewrite, api_prefix, api_upstream)
+where s.srv_id = v.srv_id;
+
+-- gateway operations (nginx test/reload/config deploy) run as background jobs,
+-- any worker can answer the status polls (services/jobs.py)
+create table gateway_jobs (
+   job_id       uuid primary key,
+   action       text not null,
+   status       text not null,   -- queued, running, succeeded, failed, timeout
+   requested_by integer references usr_info (usr_id) on delete set null,
+   options      jsonb not null default '{}',
+   output       text not null default '',
+   result       jsonb,
+   created_at   timestamptz not null default current_timestamp,
+   started_at   timestamptz,
+   finished_at  timestamptz
+);
+create index gateway_jobs_created_at_idx on gateway_jobs (created_at desc);
+
+-- token signing keys, the newest activated one signs and the older ones keep
+-- verifying for a while (utils/signing_keys.py rotates and prunes them)
+create table jwt_signing_keys (
+   kid          text primary key,
+   alg          text not null,   -- EdDSA or ES256
+   private_key  text not null,   -- PKCS8 PEM, encrypted with JWT_KEY_PASSPHRASE when it is set
+   created_at   timestamptz not null default current_timestamp,
+   activates_at timestamptz not null
+);
+create index jwt_signing_keys_activates_at_idx on jwt_signing_keys (alg, activates_at desc);
+
+-- token revocation (utils/revocation.py): single tokens by jti (logout) and
+-- every token a user got before usr_tokens_not_before (log out everywhere,
+-- password changes). Workers keep both in memory, the change feed carries
+-- the new entries.
+alter table usr_info add column usr_tokens_not_before timestamptz;
+
+create table revoked_tokens (
+   jti        text primary key,
+   usr_id     integer references usr_info (usr_id) on delete cascade,
+   revoked_at timestamptz not null default current_timestamp,
+   expires_at timestamptz          -- the token's exp, null for 'inf' tokens, pruned after this
+);
+create index revoked_tokens_expires_at_idx on revoked_tokens (expires_at);
+
+create trigger revoked_tokens_notify after insert on revoked_tokens
+   for each row execute function notify_auth_change();
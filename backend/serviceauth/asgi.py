@@ -13,4 +13,31 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'serviceauth.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# The nginx auth_request subrequest skips the Django stack entirely
+from users.fast_validate import FastValidateApp
+application = FastValidateApp(django_application)
+
+# Open the minimum number of pooled connections before the first request
+from utils.database import get_pool
+try:
+    get_pool().fill()
+except Exception as e:
+    print(f"Database pool warmup failed: {e}")
+
+# Token signing keys, rotated and refreshed in the background
+from utils.signing_keys import key_ring
+key_ring.start()
+
+# Revoked tokens and per-user cut-offs, kept current by the change feed
+from utils.revocation import revocation_list
+revocation_list.start()
+
+# Map the last persisted access snapshot and join the rebuild election
+from utils.access_snapshot import access_snapshot
+access_snapshot.start()
+
+# Cache invalidations pushed by the database triggers (ddl.sql)
+from utils.change_feed import change_feed
+change_feed.start()
@@ -20,6 +20,9 @@ from django.conf import settings
 from django.conf.urls.static import static
 
 
+from utils.metrics import metrics_view
+from utils.signing_keys import jwks_view
+
 from rest_framework_simplejwt.views import (
     TokenObtainPairView,
     TokenRefreshView,
@@ -32,6 +35,12 @@ urlpatterns = [
     
     path('api/token/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
     path('api/token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
+
+    # Public keys for verifying tokens locally (utils/signing_keys.py)
+    path('.well-known/jwks.json', jwks_view, name='jwks'),
+
+    # Prometheus scrape target, not routed by the gateway (only /api/ is)
+    path('metrics', metrics_view, name='metrics'),
 ]
 
 if settings.DEBUG:
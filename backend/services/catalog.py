@@ -0,0 +1,115 @@
+"""
+Per-permission-set service catalog for the dashboard (ServicesManager.get).
+
+Users with the same services share one cached entry: the response body and
+its ETag, built by one primary key lookup on services_info. The service ids
+come from the request's identity (access snapshot, at the user's current
+permission version), so a warm dashboard load doesn't touch the database
+and a repeat load with the ETag gets a 304. Any services_info change, or a
+new tile rendition (it changes the image URLs), clears the cache in every
+worker through the change feed. CATALOG_CACHE_TTL is only a backstop.
+"""
+from collections import OrderedDict
+import threading
+import hashlib
+import json
+import time
+import os
+
+from utils.database import db_connection
+from utils.change_feed import change_feed
+from utils.metrics import record_cache
+from .images import image_url
+
+CATALOG_CACHE_MAX_ENTRIES = int(os.environ.get("CATALOG_CACHE_MAX_ENTRIES", 1000))
+CATALOG_CACHE_TTL = float(os.environ.get("CATALOG_CACHE_TTL", 10 * 60))
+
+
+def load_catalog(cur, service_ids):
+    cur.execute("""
+        SELECT si.srv_id, si.srv_image_hash, si.srv_name, si.srv_ip, si.srv_desc,
+               EXISTS (SELECT 1 FROM service_image_renditions r
+                       WHERE r.srv_id = si.srv_id AND r.source_hash = si.srv_image_hash)
+        FROM services_info si
+        WHERE si.srv_id = ANY(%s)
+        ORDER BY si.srv_id
+    """, (list(service_ids),))
+    return [
+        {
+            "srv_id": row[0],
+            "srv_image_url": image_url(row[0], row[1], "tile" if row[5] else None),
+            "srv_image_hash": row[1],
+            "srv_name": row[2],
+            "srv_ip": row[3],
+            "srv_desc": row[4]
+        } for row in cur.fetchall()
+    ]
+
+
+class CatalogCache:
+    """LRU of sorted service ids -> (expires_at, ETag, JSON body)."""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "clears": 0}
+
+    def get(self, service_ids):
+        """(ETag, body bytes) for this set of services, loading it on a miss."""
+        key = tuple(sorted(set(service_ids)))
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            hit = entry is not None and entry[0] > now
+            self._stats["hits" if hit else "misses"] += 1
+            if hit:
+                self._entries.move_to_end(key)
+            generation = self._generation
+        record_cache("catalog", hit)
+        if hit:
+            return entry[1], entry[2]
+
+        content = []
+        if key:
+            with db_connection() as conn:
+                cur = conn.cursor()
+                try:
+                    content = load_catalog(cur, key)
+                finally:
+                    cur.close()
+        body = json.dumps({"message": "success", "content": content}).encode()
+        etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+        with self._lock:
+            # Not cached when the services changed while we were reading them
+            if generation == self._generation:
+                self._entries[key] = (now + self.ttl, etag, body)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return etag, body
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._stats["clears"] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+        return stats
+
+
+catalog_cache = CatalogCache(CATALOG_CACHE_MAX_ENTRIES, CATALOG_CACHE_TTL)
+
+
+def _on_change(event):
+    if event.get("table") in ("services_info", "service_image_renditions"):
+        catalog_cache.clear()
+
+change_feed.subscribe(_on_change, catalog_cache.clear)
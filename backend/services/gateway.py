@@ -0,0 +1,221 @@
+"""
+nginx gateway config generated from services_info.
+
+The static parts (SPA, login, /_auth with its cache zone, error pages) live in
+gateway.conf.in, every service with a srv_prefix gets its protected locations
+rendered from the table. apply_config() uploads the result next to the deployed file,
+swaps it in with a rename, runs nginx -t and reloads, putting the previous
+file back when the test fails.
+"""
+from rest_framework.exceptions import ValidationError
+
+import threading
+import difflib
+import shlex
+import uuid
+import re
+import os
+
+from utils.database import db_connection
+from .ssh import ssh_pool,run_sudo
+
+GATEWAY_CONFIG_PATH = os.environ.get("GATEWAY_CONFIG_PATH", "/etc/nginx/conf.d/api-gateway.conf")
+GATEWAY_SERVER_NAME = os.environ.get("GATEWAY_SERVER_NAME", "192.168.1.64")
+GATEWAY_BACKEND_UPSTREAM = os.environ.get("GATEWAY_BACKEND_UPSTREAM", "192.168.1.64:1112")
+
+GATEWAY_SKELETON = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gateway.conf.in")
+
+GATEWAY_COLUMNS_SQL = "srv_id, srv_name, srv_prefix, srv_upstream, srv_rewrite_assets, srv_api_prefix, srv_api_upstream"
+
+# Values end up inside nginx directives, only allow what a location/proxy_pass needs
+PREFIX_REGEX = re.compile(r"^/[A-Za-z0-9_\-./]*/$")
+UPSTREAM_REGEX = re.compile(r"^https?://[A-Za-z0-9.\-]+(:\d{1,5})?(/[A-Za-z0-9_\-./]*)?$")
+
+_apply_lock = threading.Lock()
+
+
+def validate_prefix(value, name):
+    if not PREFIX_REGEX.match(value) or "//" in value or "/../" in value:
+        raise ValidationError({"detail": f"'{name}' must be a path like /my_service/ (letters, digits, _ - . /)."})
+    if value in ("/", "/api/", "/media/", "/static/", "/_auth/", "/.well-known/"):
+        raise ValidationError({"detail": f"'{name}' {value} is reserved by the gateway."})
+    return value
+
+
+def validate_upstream(value, name):
+    if not UPSTREAM_REGEX.match(value):
+        raise ValidationError({"detail": f"'{name}' must be an http(s)://host[:port][/path] URL."})
+    return value
+
+
+def gateway_fields(data):
+    """
+    SQL assignments and values for the gateway columns present in the request
+    (services POST/PUT). Empty strings clear a value.
+    """
+    fields = []
+    values = []
+    for name, validator in (("srv_prefix", validate_prefix), ("srv_upstream", validate_upstream),
+                            ("srv_api_prefix", validate_prefix), ("srv_api_upstream", validate_upstream)):
+        value = data.get(name)
+        if value is None:
+            continue
+        value = value.strip()
+        fields.append(f"{name} = %s")
+        values.append(validator(value, name) if value else None)
+    rewrite = data.get("srv_rewrite_assets")
+    if rewrite is not None:
+        fields.append("srv_rewrite_assets = %s")
+        values.append(str(rewrite).lower() in ("1", "true", "yes", "on"))
+    return fields, values
+
+
+def _comment(text):
+    # Service names go in a comment line, keep them on one line
+    return re.sub(r"[^\w .,()\-]", " ", text or "").strip()
+
+
+def render_service(service):
+    srv_id, name, prefix, upstream, rewrite_assets, api_prefix, api_upstream = service
+    auth = f"""    set $service_id {srv_id};
+    auth_request /_auth;
+    auth_request_set $auth_user_id $upstream_http_x_auth_user_id;
+    auth_request_set $auth_user_name $upstream_http_x_auth_user_name;
+    proxy_set_header X-Auth-User-Id $auth_user_id;
+    proxy_set_header X-Auth-User-Name $auth_user_name;
+"""
+    block = f"""# ——————————————————————————————
+# service {srv_id}) {_comment(name)}
+# ——————————————————————————————
+  location {prefix} {{
+{auth}
+    proxy_pass {upstream};
+    proxy_http_version 1.1;
+"""
+    if rewrite_assets:
+        block += f"""
+    # Fix asset loading by rewriting URLs (very basic)
+    sub_filter_types text/html;
+    sub_filter_once off;
+    sub_filter '/assets/' '{prefix}assets/';
+"""
+    block += "  }\n"
+    if api_prefix and api_upstream:
+        block += f"""
+  location {api_prefix} {{
+{auth}
+    proxy_pass {api_upstream};
+    proxy_set_header Host $host;
+    proxy_set_header X-Real-IP $remote_addr;
+    proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
+    proxy_set_header X-Forwarded-Proto $scheme;
+  }}
+"""
+    return block
+
+
+def load_services(cur):
+    cur.execute(f"""
+        SELECT {GATEWAY_COLUMNS_SQL} FROM services_info
+        WHERE srv_prefix IS NOT NULL AND srv_upstream IS NOT NULL
+        ORDER BY srv_id
+    """)
+    return cur.fetchall()
+
+
+def render_config(services):
+    with open(GATEWAY_SKELETON, encoding="utf-8") as skeleton:
+        text = skeleton.read()
+    return (text.replace("@SERVICES@\n", "\n".join(render_service(service) for service in services) + "\n")
+                .replace("@SERVER_NAME@", GATEWAY_SERVER_NAME)
+                .replace("@BACKEND_UPSTREAM@", GATEWAY_BACKEND_UPSTREAM))
+
+
+def diff_config(deployed, rendered):
+    return "".join(difflib.unified_diff(
+        deployed.splitlines(keepends=True), rendered.splitlines(keepends=True),
+        fromfile=f"{GATEWAY_CONFIG_PATH} (deployed)", tofile=f"{GATEWAY_CONFIG_PATH} (rendered)"))
+
+
+def read_deployed(client):
+    exit_status, output = run_sudo(client, f"cat {shlex.quote(GATEWAY_CONFIG_PATH)} 2>/dev/null || true")
+    return output
+
+
+def apply_config(client, rendered):
+    """
+    Atomic swap + nginx -t + reload on the gateway. Returns (applied, output),
+    on a failed test the previous file is back in place and nginx untouched.
+    """
+    upload = f"/tmp/api-gateway.{uuid.uuid4().hex}.conf"
+    path = shlex.quote(GATEWAY_CONFIG_PATH)
+    script = f"""
+        set -e
+        exec 9>{path}.lock
+        flock -w 30 9
+        install -m 644 {upload} {path}.new
+        rm -f {upload}
+        if [ -f {path} ]; then cp -p {path} {path}.bak; fi
+        mv -f {path}.new {path}
+        if ! nginx -t 2>&1; then
+            if [ -f {path}.bak ]; then mv -f {path}.bak {path}; else rm -f {path}; fi
+            echo "nginx -t failed, previous configuration restored"
+            exit 3
+        fi
+        nginx -s reload 2>&1
+    """
+    with _apply_lock:
+        sftp = client.open_sftp()
+        try:
+            with sftp.open(upload, "w") as remote_file:
+                remote_file.write(rendered.encode())
+        finally:
+            sftp.close()
+        exit_status, output = run_sudo(client, script)
+    return exit_status == 0, output
+
+
+def render_current():
+    with db_connection() as conn:
+        cur = conn.cursor()
+        try:
+            services = load_services(cur)
+        finally:
+            cur.close()
+    return render_config(services)
+
+
+def preview():
+    """Rendered config and its diff against the deployed file."""
+    rendered = render_current()
+    with ssh_pool.session() as client:
+        deployed = read_deployed(client)
+    return rendered, diff_config(deployed, rendered)
+
+
+def deploy(force=False):
+    """Renders, diffs and applies when something changed (or force)."""
+    rendered = render_current()
+    with ssh_pool.session() as client:
+        diff = diff_config(read_deployed(client), rendered)
+        if not diff and not force:
+            return {"applied": False, "changed": False, "diff": "", "output": "Deployed configuration is up to date."}
+        applied, output = apply_config(client, rendered)
+    return {"applied": applied, "changed": bool(diff), "diff": diff, "output": output}
+
+
+def test_config():
+    with ssh_pool.session() as client:
+        exit_status, output = run_sudo(client, "nginx -t 2>&1")
+    return {
+        "syntax_status": "syntax is ok" in output,
+        "test_status": "test is successful" in output,
+        "output": output,
+    }
+
+
+def reload_config():
+    """nginx -s reload, only after a passing nginx -t."""
+    with ssh_pool.session() as client:
+        exit_status, output = run_sudo(client, "nginx -t 2>&1 && nginx -s reload 2>&1")
+    return {"reloaded": exit_status == 0, "output": output}
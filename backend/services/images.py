@@ -0,0 +1,35 @@
+import hashlib
+
+IMAGE_CACHE_MAX_AGE = 60 * 60 * 24 * 365   # versioned URLs never change
+IMAGE_REVALIDATE_MAX_AGE = 60 * 5           # rendition URLs answered with the original, revalidated with the ETag
+
+_SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+]
+
+
+def detect_image_type(data):
+    # Sniff the bytes, the upload's extension and content type can't be trusted
+    for signature, content_type in _SIGNATURES:
+        if data.startswith(signature):
+            return content_type
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+def image_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def image_url(service_id, image_hash, rendition=None):
+    # The hash in the query string makes the URL change with the content, and
+    # is required to fetch the image at all (see ServiceImage)
+    if not image_hash:
+        return None
+    if rendition:
+        return f"/api/v1/services/{service_id}/image?r={rendition}&v={image_hash[:16]}"
+    return f"/api/v1/services/{service_id}/image?v={image_hash[:16]}"
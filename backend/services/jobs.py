@@ -0,0 +1,167 @@
+"""
+Gateway operations as background jobs.
+
+Views only insert a gateway_jobs row and hand the job to a small executor
+(one worker by default, so operations from this process never overlap), the
+client polls the row for the status and captured output. Jobs that a worker
+restart left queued/running are reported as "lost" once they are older than
+GATEWAY_JOB_TIMEOUT.
+"""
+from rest_framework.exceptions import APIException,ValidationError
+from rest_framework import status
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime,timedelta,timezone
+import threading
+import uuid
+import os
+
+import paramiko
+from psycopg2.extras import Json
+
+from utils.database import db_connection
+from .gateway import deploy,test_config,reload_config
+from .ssh import CommandTimeout
+
+GATEWAY_JOB_WORKERS = int(os.environ.get("GATEWAY_JOB_WORKERS", 1))
+GATEWAY_JOB_QUEUE = int(os.environ.get("GATEWAY_JOB_QUEUE", 16))
+GATEWAY_JOB_TIMEOUT = float(os.environ.get("GATEWAY_JOB_TIMEOUT", 300))  # seconds before an unfinished job counts as lost
+GATEWAY_JOB_HISTORY = 50
+
+
+def _test(options):
+    result = test_config()
+    return result["test_status"], result
+
+
+def _reload(options):
+    result = reload_config()
+    return result["reloaded"], result
+
+
+def _deploy(options):
+    result = deploy(force=bool(options.get("force")))
+    return result["applied"] or not result["changed"], result
+
+
+# action -> function(options) returning (succeeded, result with the command "output")
+ACTIONS = {"test": _test, "reload": _reload, "deploy": _deploy}
+
+JOB_COLUMNS_SQL = "job_id, action, status, requested_by, options, output, result, created_at, started_at, finished_at"
+
+_executor = ThreadPoolExecutor(max_workers=GATEWAY_JOB_WORKERS, thread_name_prefix="gateway-jobs")
+_slots = threading.BoundedSemaphore(GATEWAY_JOB_WORKERS + GATEWAY_JOB_QUEUE)
+
+
+class GatewayJobsBusy(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = "Too many gateway operations queued, try again shortly."
+    default_code = "gateway_jobs_busy"
+
+
+def job_row_to_dict(row):
+    job_id, action, job_status, requested_by, options, output, result, created_at, started_at, finished_at = row
+    if job_status in ("queued", "running") and created_at < datetime.now(tz=timezone.utc) - timedelta(seconds=GATEWAY_JOB_TIMEOUT):
+        job_status = "lost"
+    return {
+        "id": str(job_id),
+        "action": action,
+        "status": job_status,
+        "requested_by": requested_by,
+        "options": options,
+        "output": output,
+        "result": result,
+        "created_at": created_at.isoformat() if created_at else None,
+        "started_at": started_at.isoformat() if started_at else None,
+        "finished_at": finished_at.isoformat() if finished_at else None,
+        "status_url": f"/api/v1/services/ssh/jobs/{job_id}",
+    }
+
+
+def _update(job_id, **fields):
+    assignments = ", ".join(f"{name} = %s" for name in fields)
+    values = [Json(value) if name in ("result", "options") else value for name, value in fields.items()]
+    with db_connection() as conn:
+        cur = conn.cursor()
+        try:
+            cur.execute(f"UPDATE gateway_jobs SET {assignments} WHERE job_id = %s", (*values, job_id))
+            conn.commit()
+        finally:
+            cur.close()
+
+
+def _run(job_id, action, options):
+    try:
+        _update(job_id, status="running", started_at=datetime.now(tz=timezone.utc))
+        try:
+            succeeded, result = ACTIONS[action](options)
+            output = result.pop("output", "")
+            _update(job_id, status="succeeded" if succeeded else "failed", output=output, result=result,
+                    finished_at=datetime.now(tz=timezone.utc))
+        except CommandTimeout as e:
+            _update(job_id, status="timeout", output=e.output, finished_at=datetime.now(tz=timezone.utc))
+        except (APIException, paramiko.SSHException, OSError) as e:
+            detail = e.detail if isinstance(e, APIException) else str(e)
+            _update(job_id, status="failed", output=str(detail), finished_at=datetime.now(tz=timezone.utc))
+    except Exception as e:
+        print(f"Gateway job {job_id} ({action}) failed: {e}")
+    finally:
+        _slots.release()
+
+
+def submit(action, requested_by, options=None):
+    """Records the job and queues it, returns the job as a dict."""
+    if action not in ACTIONS:
+        raise ValidationError({"detail": f"'action' must be one of {', '.join(ACTIONS)}."})
+    options = options or {}
+    if not _slots.acquire(blocking=False):
+        raise GatewayJobsBusy()
+    try:
+        job_id = uuid.uuid4()
+        with db_connection() as conn:
+            cur = conn.cursor()
+            try:
+                cur.execute(f"""
+                    INSERT INTO gateway_jobs (job_id, action, status, requested_by, options)
+                    VALUES (%s, %s, 'queued', %s, %s) RETURNING {JOB_COLUMNS_SQL}
+                """, (str(job_id), action, requested_by, Json(options)))
+                job = job_row_to_dict(cur.fetchone())
+                # Keep the table small, only the recent history is interesting
+                cur.execute("""
+                    DELETE FROM gateway_jobs WHERE job_id IN (
+                        SELECT job_id FROM gateway_jobs ORDER BY created_at DESC OFFSET %s)
+                """, (GATEWAY_JOB_HISTORY,))
+                conn.commit()
+            finally:
+                cur.close()
+        _executor.submit(_run, str(job_id), action, options)
+    except BaseException:
+        _slots.release()
+        raise
+    return job
+
+
+def get_job(job_id):
+    try:
+        uuid.UUID(str(job_id))
+    except ValueError:
+        return None
+    with db_connection() as conn:
+        cur = conn.cursor()
+        try:
+            cur.execute(f"SELECT {JOB_COLUMNS_SQL} FROM gateway_jobs WHERE job_id = %s", (str(job_id),))
+            row = cur.fetchone()
+        finally:
+            cur.close()
+    return job_row_to_dict(row) if row else None
+
+
+def recent_jobs(limit=20):
+    with db_connection() as conn:
+        cur = conn.cursor()
+        try:
+            cur.execute(f"SELECT {JOB_COLUMNS_SQL} FROM gateway_jobs ORDER BY created_at DESC LIMIT %s", (limit,))
+            rows = cur.fetchall()
+        finally:
+            cur.close()
+    return [job_row_to_dict(row) for row in rows]
@@ -0,0 +1,104 @@
+"""
+Resized renditions of the uploaded service images.
+
+Uploads are stored as-is, then a bounded thread pool builds the dashboard
+tile renditions (WebP plus a PNG fallback) off the request path and stores
+them in service_image_renditions next to the original. Jobs that don't fit
+in the queue are dropped, the image endpoint queues them again the next time
+it has to serve an original.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+import threading
+import os
+
+from PIL import Image, ImageOps
+import psycopg2
+
+from utils.database import db_connection
+from utils.change_feed import publish
+from .images import image_hash
+
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", 2))
+IMAGE_QUEUE_SIZE = int(os.environ.get("IMAGE_QUEUE_SIZE", 16))
+
+TILE_SIZE = (640, 360)  # 2x the dashboard tile, fit inside keeping the aspect ratio
+
+# rendition name -> list of (content type, Pillow format, save options)
+RENDITIONS = {
+    "tile": [
+        ("image/webp", "WEBP", {"quality": 80, "method": 4}),
+        ("image/png", "PNG", {"optimize": True}),
+    ],
+}
+
+_executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="image-renditions")
+_slots = threading.BoundedSemaphore(IMAGE_WORKERS + IMAGE_QUEUE_SIZE)
+_pending = set()
+_pending_lock = threading.Lock()
+
+
+def render(data, size, image_format, options):
+    with Image.open(BytesIO(data)) as image:
+        image.seek(0)  # first frame of animated GIFs
+        image = ImageOps.exif_transpose(image)
+        image = image.convert("RGBA" if image.mode in ("RGBA", "LA", "P") else "RGB")
+        image.thumbnail(size, Image.LANCZOS)
+        out = BytesIO()
+        image.save(out, image_format, **options)
+        return out.getvalue()
+
+
+def build_renditions(service_id, source_hash, data):
+    rows = []
+    for rendition, formats in RENDITIONS.items():
+        for content_type, image_format, options in formats:
+            output = render(data, TILE_SIZE, image_format, options)
+            rows.append((rendition, content_type, output))
+
+    with db_connection() as conn:
+        cur = conn.cursor()
+        try:
+            for rendition, content_type, output in rows:
+                # Only if the original didn't change while we were working
+                cur.execute("""
+                    INSERT INTO service_image_renditions
+                        (srv_id, rendition, content_type, source_hash, image_hash, bytes, data)
+                    SELECT si.srv_id, %s, %s, %s, %s, %s, %s
+                    FROM services_info si WHERE si.srv_id = %s AND si.srv_image_hash = %s
+                    ON CONFLICT (srv_id, rendition, content_type) DO UPDATE SET
+                        source_hash = EXCLUDED.source_hash,
+                        image_hash = EXCLUDED.image_hash,
+                        bytes = EXCLUDED.bytes,
+                        data = EXCLUDED.data,
+                        created_at = current_timestamp
+                """, (rendition, content_type, source_hash, image_hash(output), len(output),
+                      psycopg2.Binary(output), service_id, source_hash))
+            # Image URLs in the cached dashboard catalogs switch to the rendition
+            publish(cur, {"table": "service_image_renditions", "op": "INSERT", "rendition_of": service_id})
+            conn.commit()
+        finally:
+            cur.close()
+
+
+def _run(service_id, source_hash, data):
+    try:
+        build_renditions(service_id, source_hash, data)
+    except Exception as e:
+        print(f"Image renditions for service {service_id} failed: {e}")
+    finally:
+        with _pending_lock:
+            _pending.discard((service_id, source_hash))
+        _slots.release()
+
+
+def queue_renditions(service_id, source_hash, data):
+    """Queues the renditions of an original, False when the queue is full."""
+    with _pending_lock:
+        if (service_id, source_hash) in _pending:
+            return True
+        if not _slots.acquire(blocking=False):
+            return False
+        _pending.add((service_id, source_hash))
+    _executor.submit(_run, service_id, source_hash, data)
+    return True
@@ -0,0 +1,144 @@
+"""
+Persistent SSH sessions to the nginx gateway.
+
+Connections are kept open between operations (TCP keepalive plus SSH
+keepalive packets so idle sessions survive firewalls), at most
+GATEWAY_SSH_POOL_SIZE per worker. A session whose transport died is dropped
+and replaced on the next checkout, so only the first operation after an
+outage pays the key exchange and password auth again.
+"""
+from rest_framework.exceptions import APIException
+from rest_framework import status
+
+from contextlib import contextmanager
+from collections import deque
+import threading
+import socket
+import shlex
+import time
+import os
+
+import paramiko
+
+GATEWAY_SSH_HOST = os.environ.get("GATEWAY_SSH_HOST", "192.168.1.64")
+GATEWAY_SSH_USER = os.environ.get("GATEWAY_SSH_USER", "ti")
+GATEWAY_SSH_PASSWORD = os.environ.get("GATEWAY_SSH_PASSWORD", "123Mudar")
+GATEWAY_SSH_TIMEOUT = float(os.environ.get("GATEWAY_SSH_TIMEOUT", 10))       # connect/auth and waiting for a session
+GATEWAY_SSH_POOL_SIZE = int(os.environ.get("GATEWAY_SSH_POOL_SIZE", 2))
+GATEWAY_SSH_KEEPALIVE = int(os.environ.get("GATEWAY_SSH_KEEPALIVE", 30))     # seconds between keepalive packets
+GATEWAY_COMMAND_TIMEOUT = float(os.environ.get("GATEWAY_COMMAND_TIMEOUT", 60))
+
+
+class GatewayUnavailable(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = "Can't connect to ssh."
+    default_code = "gateway_unavailable"
+
+
+class CommandTimeout(Exception):
+    def __init__(self, output):
+        super().__init__("command timed out")
+        self.output = output
+
+
+class SshPool:
+    def __init__(self, size, keepalive):
+        self.size = size
+        self.keepalive = keepalive
+        self._idle = deque()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+        self._stats = {"connects": 0, "reuses": 0, "dropped": 0}
+
+    def _connect(self):
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        try:
+            client.connect(hostname=GATEWAY_SSH_HOST, username=GATEWAY_SSH_USER, password=GATEWAY_SSH_PASSWORD,
+                           timeout=GATEWAY_SSH_TIMEOUT, banner_timeout=GATEWAY_SSH_TIMEOUT,
+                           auth_timeout=GATEWAY_SSH_TIMEOUT, look_for_keys=False, allow_agent=False)
+        except (paramiko.SSHException, OSError) as e:
+            client.close()
+            print(f"Gateway SSH connection failed: {e}")
+            raise GatewayUnavailable()
+        transport = client.get_transport()
+        transport.set_keepalive(self.keepalive)
+        transport.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self._stats["connects"] += 1
+        return client
+
+    def _checkout(self):
+        with self._lock:
+            while self._idle:
+                client = self._idle.pop()
+                transport = client.get_transport()
+                if transport is not None and transport.is_active():
+                    self._stats["reuses"] += 1
+                    return client
+                client.close()
+                self._stats["dropped"] += 1
+        return self._connect()
+
+    @contextmanager
+    def session(self):
+        if not self._slots.acquire(timeout=GATEWAY_SSH_TIMEOUT):
+            raise GatewayUnavailable("All gateway SSH sessions are busy.")
+        client = None
+        try:
+            client = self._checkout()
+            yield client
+        except (paramiko.SSHException, OSError, CommandTimeout):
+            # Don't hand a broken (or still busy) session to the next caller
+            if client is not None:
+                client.close()
+                client = None
+                self._stats["dropped"] += 1
+            raise
+        finally:
+            if client is not None:
+                with self._lock:
+                    self._idle.append(client)
+            self._slots.release()
+
+    def close_all(self):
+        with self._lock:
+            while self._idle:
+                self._idle.pop().close()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["idle"] = len(self._idle)
+        stats["size"] = self.size
+        return stats
+
+
+ssh_pool = SshPool(GATEWAY_SSH_POOL_SIZE, GATEWAY_SSH_KEEPALIVE)
+
+
+def run_sudo(client, script, timeout=None):
+    """
+    Runs a shell script as root on the gateway, returns (exit status, combined
+    output). Raises CommandTimeout (with the output so far) past the timeout.
+    """
+    command = f"echo {shlex.quote(GATEWAY_SSH_PASSWORD)} | sudo -S -p '' sh -c {shlex.quote(script)}"
+    deadline = time.monotonic() + (timeout or GATEWAY_COMMAND_TIMEOUT)
+    channel = client.get_transport().open_session()
+    chunks = []
+    try:
+        channel.set_combine_stderr(True)
+        channel.settimeout(1)
+        channel.exec_command(command)
+        while True:
+            try:
+                data = channel.recv(32768)
+            except socket.timeout:
+                if time.monotonic() > deadline:
+                    raise CommandTimeout(b"".join(chunks).decode(errors="replace"))
+                continue
+            if not data:
+                break
+            chunks.append(data)
+        return channel.recv_exit_status(), b"".join(chunks).decode(errors="replace")
+    finally:
+        channel.close()
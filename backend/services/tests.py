@@ -1,3 +1,428 @@
-from django.test import TestCase
+from django.test import SimpleTestCase
+from rest_framework.test import APIRequestFactory,force_authenticate
+from rest_framework import status
+from rest_framework.exceptions import ValidationError
+from django.core.files.uploadedfile import SimpleUploadedFile
 
-# Create your tests here.
+from datetime import datetime,timedelta,timezone
+from contextlib import contextmanager
+from unittest import mock
+import threading
+import socket
+import time
+import psycopg2
+import json
+
+from .catalog import CatalogCache
+from .gateway import deploy,gateway_fields,preview,render_config
+from .jobs import GatewayJobsBusy,get_job,job_row_to_dict,submit
+from .ssh import CommandTimeout,GatewayUnavailable,SshPool,run_sudo
+from . import jobs
+from .views import GatewayConfig,ServicesManager,ServicesManagerUpdate,SshManager
+from utils.auth_cache import DecisionCache
+
+
+class FakeUser:
+    """What JWTCustomAuth puts on the request, just the identity the view reads."""
+
+    is_authenticated = True
+
+    def __init__(self, service_ids, user_id=1):
+        self.id = user_id
+        self.identity = {"service_ids": service_ids}
+
+
+class FakeConnection:
+    def cursor(self):
+        return mock.Mock()
+
+
+class CatalogETagTests(SimpleTestCase):
+    def setUp(self):
+        self.loads = []
+
+        def load_catalog(cur, service_ids):
+            self.loads.append(service_ids)
+            return [{"srv_id": srv_id, "srv_name": f"service {srv_id}"} for srv_id in service_ids]
+
+        @contextmanager
+        def db_connection():
+            yield FakeConnection()
+
+        self.cache = CatalogCache(10, 60)
+        for target, value in (("services.catalog.load_catalog", load_catalog),
+                              ("services.catalog.db_connection", db_connection),
+                              ("services.views.catalog_cache", self.cache)):
+            patcher = mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.factory = APIRequestFactory()
+
+    def get(self, service_ids, etag=None):
+        headers = {"HTTP_IF_NONE_MATCH": etag} if etag else {}
+        request = self.factory.get("/api/services/", **headers)
+        force_authenticate(request, user=FakeUser(service_ids))
+        return ServicesManager.as_view()(request)
+
+    def test_first_load_returns_body_and_etag(self):
+        response = self.get([3, 1])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response["ETag"].startswith('"'))
+        self.assertEqual(response["Cache-Control"], "private, no-cache")
+        body = json.loads(response.content)
+        self.assertEqual([s["srv_id"] for s in body["content"]], [1, 3])
+        self.assertEqual(self.loads, [(1, 3)])
+
+    def test_matching_etag_gets_304_without_a_load(self):
+        etag = self.get([1, 2])["ETag"]
+        response = self.get([1, 2], etag=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response["ETag"], etag)
+        self.assertEqual(response.content, b"")
+        self.assertEqual(len(self.loads), 1)
+
+    def test_weak_and_wildcard_etags_match(self):
+        etag = self.get([1])["ETag"]
+        self.assertEqual(self.get([1], etag="W/" + etag).status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(self.get([1], etag="*").status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_stale_etag_gets_the_body(self):
+        self.get([1])
+        response = self.get([1], etag='"stale"')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.content)
+
+    def test_same_service_set_shares_an_entry(self):
+        first = self.get([2, 1, 2])
+        second = self.get([1, 2])
+        self.assertEqual(first["ETag"], second["ETag"])
+        self.assertEqual(self.loads, [(1, 2)])
+        self.assertNotEqual(self.get([1])["ETag"], first["ETag"])
+
+    def test_clear_reloads(self):
+        self.get([1])
+        self.cache.clear()
+        self.get([1])
+        self.assertEqual(len(self.loads), 2)
+        self.assertEqual(self.cache.stats()["clears"], 1)
+
+    def test_no_services_skips_the_database(self):
+        response = self.get([])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(response.content)["content"], [])
+        self.assertEqual(self.loads, [])
+
+    def test_database_error_resolving_the_identity_is_an_api_error(self):
+        user = mock.Mock(is_authenticated=True)
+        type(user).identity = mock.PropertyMock(side_effect=psycopg2.OperationalError("server closed the connection"))
+        request = self.factory.get("/api/services/")
+        force_authenticate(request, user=user)
+        response = ServicesManager.as_view()(request)
+        self.assertEqual(response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        self.assertIn("Service list query failed", str(response.data["detail"]))
+
+
+PNG_BYTES = b"\x89PNG\r\n\x1a\n" + bytes(32)
+
+
+class ServiceCreateTests(SimpleTestCase):
+    def setUp(self):
+        self.conn = mock.Mock()
+        self.cur = self.conn.cursor.return_value
+        self.cur.fetchone.return_value = (12,)
+        self.cache = CatalogCache(10, 60)
+        self.queue_renditions = mock.Mock()
+        for target, value in (("services.views.get_admin_user_from_token", mock.Mock(return_value={"user_id": 1})),
+                              ("services.views.get_db_connection", mock.Mock(return_value=self.conn)),
+                              ("services.views.grant_access", mock.Mock()),
+                              ("services.views.bump_permission_versions", mock.Mock(return_value=[(1, 5)])),
+                              ("services.views.permission_versions", mock.Mock()),
+                              ("services.views.queue_renditions", self.queue_renditions),
+                              ("services.views.catalog_cache", self.cache)):
+            patcher = mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def post(self, **files):
+        request = APIRequestFactory().post("/api/services/", {"srv_name": "Painel", "srv_ip": "10.0.0.5", **files},
+                                           format="multipart")
+        force_authenticate(request, user=FakeUser([]))
+        return ServicesManager.as_view()(request)
+
+    def test_created_service_clears_the_catalog_after_the_commit(self):
+        response = self.post(srv_image=SimpleUploadedFile("tile.png", PNG_BYTES))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {"message": "Success", "id": 12})
+        self.conn.commit.assert_called_once()
+        self.assertEqual(self.cache.stats()["clears"], 1)
+        self.assertEqual(self.queue_renditions.call_args[0][0], 12)
+
+    def test_failed_insert_changes_nothing(self):
+        self.cur.execute.side_effect = psycopg2.IntegrityError("duplicate key")
+        with mock.patch("builtins.print"):
+            response = self.post(srv_image=SimpleUploadedFile("tile.png", PNG_BYTES))
+        self.assertEqual(response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        self.conn.rollback.assert_called_once()
+        self.assertEqual(self.cache.stats()["clears"], 0)
+        self.queue_renditions.assert_not_called()
+
+    def test_missing_or_fake_image_is_rejected_before_borrowing_a_connection(self):
+        self.assertEqual(self.post().status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.post(srv_image=SimpleUploadedFile("tile.png", b"not an image"))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.conn.cursor.assert_not_called()
+
+
+class ServiceDeleteTests(SimpleTestCase):
+    def test_only_the_deleted_services_decisions_are_dropped(self):
+        conn = mock.Mock()
+        conn.cursor.return_value.fetchone.return_value = (1,)
+        conn.cursor.return_value.fetchall.return_value = [(7,)]
+        decisions = DecisionCache(100, 60, 60)
+        decisions.set((b"token", "4"), 200, {}, user_id=7)
+        decisions.set((b"token", "5"), 200, {}, user_id=7)
+        with mock.patch("services.views.get_admin_user_from_token"), \
+                mock.patch("services.views.get_db_connection", return_value=conn), \
+                mock.patch("services.views.bump_permission_versions", return_value=[(7, 3)]), \
+                mock.patch("services.views.permission_versions"), \
+                mock.patch("services.views.decision_cache", decisions), \
+                mock.patch("services.views.catalog_cache", CatalogCache(10, 60)):
+            request = APIRequestFactory().delete("/api/services/4/")
+            force_authenticate(request, user=FakeUser([4, 5]))
+            response = ServicesManagerUpdate.as_view()(request, service_id=4)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIsNone(decisions.get((b"token", "4")))
+        self.assertIsNotNone(decisions.get((b"token", "5")))
+
+
+GATEWAY_SERVICES = [
+    (4, "Painel\nserver { }", "/painel/", "http://10.0.0.5:3000", True, "/painel-api/", "http://10.0.0.5:8000/api/"),
+    (9, "Docs", "/docs/", "http://10.0.0.6", False, None, None),
+]
+
+
+class GatewayRenderTests(SimpleTestCase):
+    def setUp(self):
+        self.deployed = render_config(GATEWAY_SERVICES)
+        self.run_sudo = mock.Mock(side_effect=self.sudo)
+        self.ssh_pool = mock.MagicMock()
+
+        @contextmanager
+        def db_connection():
+            conn = mock.Mock()
+            conn.cursor.return_value.fetchall.return_value = self.services
+            yield conn
+
+        self.services = GATEWAY_SERVICES
+        for target, value in (("services.gateway.db_connection", db_connection),
+                              ("services.gateway.ssh_pool", self.ssh_pool),
+                              ("services.gateway.run_sudo", self.run_sudo)):
+            patcher = mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def sudo(self, client, script):
+        if script.startswith("cat "):
+            return 0, self.deployed
+        return 0, "nginx: configuration file test is successful"
+
+    def test_rendered_locations(self):
+        config = render_config(GATEWAY_SERVICES)
+        for placeholder in ("@SERVICES@", "@SERVER_NAME@", "@BACKEND_UPSTREAM@"):
+            self.assertNotIn(placeholder, config)
+        self.assertIn("location /painel/ {\n    set $service_id 4;\n    auth_request /_auth;", config)
+        self.assertIn("proxy_pass http://10.0.0.5:3000;", config)
+        self.assertIn("sub_filter '/assets/' '/painel/assets/';", config)
+        self.assertIn("location /painel-api/ {", config)
+        self.assertIn("proxy_pass http://10.0.0.5:8000/api/;", config)
+        self.assertIn("location /docs/ {\n    set $service_id 9;", config)
+        self.assertNotIn("/docs/assets/", config)
+        # The service name only ever lands in a comment line
+        self.assertIn("# service 4) Painel server", config)
+        self.assertNotIn("server { }", config)
+
+    def test_gateway_fields_reject_what_nginx_would_misread(self):
+        fields, values = gateway_fields({"srv_prefix": " /painel/ ", "srv_upstream": "", "srv_rewrite_assets": "on"})
+        self.assertEqual(fields, ["srv_prefix = %s", "srv_upstream = %s", "srv_rewrite_assets = %s"])
+        self.assertEqual(values, ["/painel/", None, True])
+        for data in ({"srv_prefix": "/painel"}, {"srv_prefix": "/a/; return 200;/"}, {"srv_prefix": "/api/"},
+                     {"srv_prefix": "/a/../b/"}, {"srv_api_prefix": "/_auth/"},
+                     {"srv_upstream": "http://10.0.0.5; deny all"}, {"srv_api_upstream": "ftp://10.0.0.5"}):
+            with self.subTest(data=data), self.assertRaises(ValidationError):
+                gateway_fields(data)
+
+    def test_preview_diffs_against_the_deployed_file(self):
+        self.assertEqual(preview()[1], "")
+        self.services = GATEWAY_SERVICES[:1]
+        rendered, diff = preview()
+        self.assertIn("-  location /docs/ {", diff)
+        self.assertEqual(rendered, render_config(GATEWAY_SERVICES[:1]))
+
+    def test_deploy_skips_an_unchanged_config(self):
+        result = deploy()
+        self.assertEqual((result["applied"], result["changed"]), (False, False))
+        self.assertEqual(self.run_sudo.call_count, 1)
+
+    def test_deploy_uploads_and_swaps(self):
+        self.services = GATEWAY_SERVICES[:1]
+        result = deploy()
+        self.assertEqual((result["applied"], result["changed"]), (True, True))
+        client = self.ssh_pool.session.return_value.__enter__.return_value
+        remote_file = client.open_sftp.return_value.open.return_value.__enter__.return_value
+        self.assertEqual(remote_file.write.call_args[0][0], render_config(GATEWAY_SERVICES[:1]).encode())
+        script = self.run_sudo.call_args[0][1]
+        self.assertIn("nginx -t", script)
+        self.assertIn("mv -f /etc/nginx/conf.d/api-gateway.conf.bak /etc/nginx/conf.d/api-gateway.conf", script)
+
+    def test_failed_nginx_test_is_not_applied(self):
+        self.services = GATEWAY_SERVICES[:1]
+        self.run_sudo.side_effect = lambda client, script: (
+            self.sudo(client, script) if script.startswith("cat ") else (3, "nginx -t failed, previous configuration restored"))
+        result = deploy()
+        self.assertFalse(result["applied"])
+        self.assertIn("restored", result["output"])
+
+    def test_view_shows_the_diff(self):
+        self.services = GATEWAY_SERVICES[1:]
+        request = APIRequestFactory().get("/api/services/gateway?full=true")
+        with mock.patch("services.views.get_admin_user_from_token"):
+            response = GatewayConfig.as_view()(request)
+        self.assertTrue(response.data["changed"])
+        self.assertIn("-  location /painel/ {", response.data["diff"])
+        self.assertEqual(response.data["config"], render_config(GATEWAY_SERVICES[1:]))
+
+
+def job_row(job_status="queued", age=0):
+    created_at = datetime.now(tz=timezone.utc) - timedelta(seconds=age)
+    return ("4b0a2bd6-4a55-4bd4-9d3e-38f7d7e0ab12", "deploy", job_status, 1, {}, None, None, created_at, None, None)
+
+
+class GatewayJobTests(SimpleTestCase):
+    def setUp(self):
+        self.conn = mock.Mock()
+        self.conn.cursor.return_value.fetchone.return_value = job_row()
+
+        @contextmanager
+        def db_connection():
+            yield self.conn
+
+        self.executor = mock.Mock()
+        for target, value in (("services.jobs.db_connection", db_connection),
+                              ("services.jobs._executor", self.executor),
+                              ("services.jobs._slots", threading.BoundedSemaphore(2))):
+            patcher = mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_submit_records_and_queues_the_job(self):
+        job = submit("deploy", 1, {"force": True})
+        self.assertEqual((job["action"], job["status"]), ("deploy", "queued"))
+        self.assertEqual(job["status_url"], f"/api/v1/services/ssh/jobs/{job['id']}")
+        self.conn.commit.assert_called_once()
+        run, job_id, action, options = self.executor.submit.call_args[0]
+        self.assertEqual((run, action, options), (jobs._run, "deploy", {"force": True}))
+
+    def test_full_queue_is_a_503(self):
+        submit("test", 1)
+        submit("test", 1)
+        with self.assertRaises(GatewayJobsBusy):
+            submit("test", 1)
+        self.assertEqual(self.executor.submit.call_count, 2)
+        with self.assertRaises(ValidationError):
+            submit("reboot", 1)
+
+    def test_run_records_the_outcome_and_frees_the_slot(self):
+        updates = []
+        outcomes = {"deploy": mock.Mock(return_value=(True, {"applied": True, "output": "reloaded"}))}
+        with mock.patch("services.jobs._update", lambda job_id, **fields: updates.append(fields)), \
+                mock.patch.dict("services.jobs.ACTIONS", outcomes):
+            for outcome in (None, CommandTimeout("partial output"), GatewayUnavailable()):
+                # Taken by submit(), given back by the run whatever happens
+                jobs._slots.acquire()
+                outcomes["deploy"].side_effect = outcome
+                jobs._run("job", "deploy", {})
+        finished = [fields for fields in updates if fields["status"] != "running"]
+        self.assertEqual([(fields["status"], fields["output"]) for fields in finished],
+                         [("succeeded", "reloaded"), ("timeout", "partial output"), ("failed", "Can't connect to ssh.")])
+        self.assertEqual(finished[0]["result"], {"applied": True})
+        self.assertTrue(jobs._slots.acquire(blocking=False) and jobs._slots.acquire(blocking=False))
+
+    def test_unfinished_old_jobs_are_lost(self):
+        self.assertEqual(job_row_to_dict(job_row("running", age=10))["status"], "running")
+        self.assertEqual(job_row_to_dict(job_row("running", age=3600))["status"], "lost")
+        self.assertEqual(job_row_to_dict(job_row("failed", age=3600))["status"], "failed")
+
+    def test_get_job(self):
+        self.assertIsNone(get_job("../etc"))
+        self.conn.cursor.assert_not_called()
+        self.assertEqual(get_job("4b0a2bd6-4a55-4bd4-9d3e-38f7d7e0ab12")["action"], "deploy")
+        self.conn.cursor.return_value.fetchone.return_value = None
+        self.assertIsNone(get_job("4b0a2bd6-4a55-4bd4-9d3e-38f7d7e0ab12"))
+
+    def test_view_answers_202_with_the_job(self):
+        request = APIRequestFactory().post("/api/services/ssh", {"action": "deploy", "force": "true"}, format="json")
+        with mock.patch("services.views.get_admin_user_from_token", return_value={"user_id": 3}):
+            response = SshManager.as_view()(request)
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(self.executor.submit.call_args[0][3], {"force": True})
+
+
+class SshPoolTests(SimpleTestCase):
+    def setUp(self):
+        self.pool = SshPool(1, 30)
+        self.clients = []
+
+        def connect():
+            client = mock.Mock()
+            client.get_transport.return_value.is_active.return_value = True
+            self.clients.append(client)
+            return client
+        self.pool._connect = connect
+
+    def test_sessions_are_reused_while_alive(self):
+        with self.pool.session() as first:
+            pass
+        with self.pool.session() as second:
+            pass
+        self.assertIs(first, second)
+        first.get_transport.return_value.is_active.return_value = False
+        with self.pool.session() as third:
+            pass
+        self.assertIsNot(third, first)
+        first.close.assert_called_once()
+        self.assertEqual(self.pool.stats(), {"connects": 0, "reuses": 1, "dropped": 1, "idle": 1, "size": 1})
+
+    def test_broken_session_is_not_handed_out_again(self):
+        with self.assertRaises(OSError):
+            with self.pool.session() as client:
+                raise OSError("connection reset")
+        client.close.assert_called_once()
+        with self.pool.session() as other:
+            self.assertIsNot(other, client)
+
+    def test_busy_pool_gives_up(self):
+        with mock.patch("services.ssh.GATEWAY_SSH_TIMEOUT", 0.01), self.pool.session():
+            with self.assertRaises(GatewayUnavailable):
+                with self.pool.session():
+                    pass
+
+    def test_run_sudo_collects_output_until_the_deadline(self):
+        client = mock.Mock()
+        channel = client.get_transport.return_value.open_session.return_value
+        channel.recv.side_effect = [socket.timeout(), b"syntax is ok\n", b"test is successful\n", b""]
+        channel.recv_exit_status.return_value = 0
+        self.assertEqual(run_sudo(client, "nginx -t"), (0, "syntax is ok\ntest is successful\n"))
+        self.assertIn("sudo -S", channel.exec_command.call_args[0][0])
+        channel.close.assert_called_once()
+
+        chunks = [b"still running"]
+
+        def recv(size):
+            if chunks:
+                return chunks.pop()
+            time.sleep(0.005)
+            raise socket.timeout()
+        channel.recv.side_effect = recv
+        with self.assertRaises(CommandTimeout) as raised:
+            run_sudo(client, "sleep 600", timeout=0.01)
+        self.assertEqual(raised.exception.output, "still running")
@@ -1,9 +1,13 @@
 from django.contrib import admin
 from django.urls import path,include
-from .views import ServicesManager,ServicesManagerUpdate,SshManager
+from .views import ServicesManager,ServicesManagerUpdate,SshManager,ServiceImage,GatewayConfig,SshJobs
 
 urlpatterns = [
     path('',ServicesManager.as_view()),
     path('<int:service_id>',ServicesManagerUpdate.as_view()),
-    path('ssh',SshManager.as_view())
+    path('<int:service_id>/image',ServiceImage.as_view()),
+    path('ssh',SshManager.as_view()),
+    path('ssh/jobs',SshJobs.as_view()),
+    path('ssh/jobs/<str:job_id>',SshJobs.as_view()),
+    path('gateway',GatewayConfig.as_view())
 ]
\ No newline at end of file
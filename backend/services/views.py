@@ -1,132 +1,179 @@
 from django.shortcuts import render
+from django.http import HttpResponse,HttpResponseNotModified
+from django.utils.http import http_date,parse_http_date_safe,quote_etag,parse_etags
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.exceptions import ValidationError,APIException
 from rest_framework.request import Request
 from rest_framework import status
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated,AllowAny
 from rest_framework.parsers import MultiPartParser, FileUploadParser,FormParser # For file uploads
 
 import psycopg2
 from datetime import datetime,timedelta,timezone
 
 from .serializers import addServiceSerializer,updateServiceSerializer
+from .images import detect_image_type,image_hash,IMAGE_CACHE_MAX_AGE,IMAGE_REVALIDATE_MAX_AGE
+from .renditions import RENDITIONS,queue_renditions
+from .gateway import gateway_fields,preview
+from .jobs import submit as submit_job,get_job,recent_jobs
+from .ssh import ssh_pool
+from .catalog import catalog_cache
 from utils.database import get_db_connection
 from utils.jwt import get_admin_user_from_token
+from utils.access import grant_access
+from utils.auth_cache import decision_cache
+from utils.permissions import permission_versions,bump_permission_versions
 
 import os
-import base64
-import paramiko
-from paramiko import SSHClient
 
 class SshManager(APIView):
+    """
+    Gateway operations over the persistent SSH sessions, run as background
+    jobs. GET starts an nginx -t job, POST {"action": "test"|"reload"|"deploy"}
+    any of them, both answer 202 with the job to poll at its status_url.
+    """
+    authentication_classes = []
+    permission_classes = [AllowAny]
+
     def get(self, request: Request):
-        client = paramiko.SSHClient()
-        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        try:
-            client.connect(hostname="192.168.1.64", username="ti", password="123Mudar")
-        except:
-            print("cant connect!")
-            raise APIException("Can't connect to ssh.")
-
-        stdin, stdout, stderr = client.exec_command('echo {} | sudo -S nginx -t'.format("123Mudar"))
-        return_string = stderr.read().decode()
-        #print(return_string)
-        client.close()
-        return Response({
-            "syntax_status": False if return_string.find("nginx: the configuration file /etc/nginx/nginx.conf syntax is ok") == -1 else True,
-            "test_status": False if return_string.find("nginx: configuration file /etc/nginx/nginx.conf test is successful") == -1 else True
-            })
-        
-        
+        admin_user = get_admin_user_from_token(request)
+        job = submit_job("test", admin_user["user_id"])
+        return Response(job, status=status.HTTP_202_ACCEPTED)
+
+    def post(self, request: Request):
+        admin_user = get_admin_user_from_token(request)
+        action = request.data.get("action")
+        options = {"force": True} if action == "deploy" and _truthy(request.data.get("force")) else {}
+        job = submit_job(action, admin_user["user_id"], options)
+        return Response(job, status=status.HTTP_202_ACCEPTED)
+
+
+class SshJobs(APIView):
+    authentication_classes = []
+    permission_classes = [AllowAny]
+
+    def get(self, request: Request, job_id=None):
+        get_admin_user_from_token(request)
+        if job_id is None:
+            return Response({"jobs": recent_jobs(), "sessions": ssh_pool.stats()})
+        job = get_job(job_id)
+        if job is None:
+            return Response({"detail": "Job not found."}, status=status.HTTP_404_NOT_FOUND)
+        return Response(job)
+
+
+def _truthy(value):
+    return str(value or "").lower() in ("1", "true", "yes", "on")
+
+
+class GatewayConfig(APIView):
+    """
+    GET: the gateway config rendered from services_info and its diff against
+    the deployed file (?full=true includes the whole rendered file).
+    POST: queues a deploy job (atomic swap, nginx -t, reload), {"force": true}
+    applies even without changes.
+    """
+    authentication_classes = []
+    permission_classes = [AllowAny]
+
+    def get(self, request: Request):
+        get_admin_user_from_token(request)
+        rendered, diff = preview()
+        response = {"changed": bool(diff), "diff": diff}
+        if _truthy(request.query_params.get("full")):
+            response["config"] = rendered
+        return Response(response)
+
+    def post(self, request: Request):
+        admin_user = get_admin_user_from_token(request)
+        options = {"force": True} if _truthy(request.data.get("force")) else {}
+        job = submit_job("deploy", admin_user["user_id"], options)
+        return Response(job, status=status.HTTP_202_ACCEPTED)
+
 
 class ServicesManager(APIView):
     permission_classes = [IsAuthenticated]
     
     def get(self, request: Request):
-        
-        user_id = request.user.id
-        conn = get_db_connection()
-        cur = conn.cursor()
-        print(user_id)
+        # Service ids at the user's current permission version, usually from the
+        # access snapshot, then the catalog shared by everyone with the same set
         try:
-            cur.execute("SELECT usr_access FROM usr_info ui WHERE ui.usr_id = %s", (user_id,))
-            result = cur.fetchone()
-            user_services = result[0]
-
-            cur.execute(f"SELECT * FROM services_info si WHERE si.srv_id IN ({user_services})")
-            result = cur.fetchall()
-            services_list = [
-            {
-                "srv_id": row[0],
-                "srv_image": base64.b64encode(row[1]).decode('utf-8') if row[1] else None,
-                "srv_name": row[2],
-                "srv_ip": row[3],
-                "srv_desc": row[4]
-            } for row in result
-        ]
-            resp = Response({"message": "success", "content": services_list})
-            return resp
-            
-        
-        finally:
-            cur.close()
-            conn.close()
+            identity = request.user.identity
+            etag, body = catalog_cache.get(identity["service_ids"])
+        except psycopg2.Error as e:
+            raise APIException(f"Service list query failed: {e}")
+
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache", "Vary": "Authorization"}
+        # Weak comparison, a compressing proxy sends our tag back as W/"..."
+        if_none_match = parse_etags(request.headers.get("If-None-Match", ""))
+        if "*" in if_none_match or etag in {tag.removeprefix("W/") for tag in if_none_match}:
+            return HttpResponseNotModified(headers=headers)
+        return HttpResponse(body, content_type="application/json", headers=headers)
 
         
     def post(self,request:Request):
         try:
-            get_admin_user_from_token(request)
+            admin_user = get_admin_user_from_token(request)
         except APIException as e:
             return Response({"detail": e.detail}, status=e.status_code)
         
-        conn = get_db_connection()
-        cur = conn.cursor()
-        conn.autocommit = False
         user_id = request.user.id
-        print(request.data)
 
         srv_name = request.data.get('srv_name')
         srv_ip = request.data.get('srv_ip')
         srv_desc = request.data.get('srv_desc')
         srv_image_file = request.FILES.get('srv_image')
+        gw_fields, gw_values = gateway_fields(request.data)
 
 
         uploaded_file = srv_image_file
+        if not uploaded_file:
+            raise ValidationError({"detail": "Missing 'srv_image' file."})
         allowed_extensions = ['.jpg', '.jpeg', '.png', '.gif']
         file_extension = os.path.splitext(uploaded_file.name.lower())
         if file_extension[1] not in allowed_extensions:
             raise ValidationError({"detail": f"File type not allowed. Allowed types: {', '.join(allowed_extensions)}"})
 
         file_bytes = uploaded_file.read()
+        content_type = detect_image_type(file_bytes)
+        if not content_type:
+            raise ValidationError({"detail": "Uploaded file is not a valid image."})
+        file_hash = image_hash(file_bytes)
+
+        conn = get_db_connection()
+        cur = conn.cursor()
+        conn.autocommit = False
         try:
-            cur.execute("insert into services_info (srv_image, srv_name, srv_ip, srv_desc) values(%s,%s,%s,%s) returning srv_id",
-                        (psycopg2.Binary(file_bytes),srv_name,srv_ip,srv_desc,))
+            cur.execute("""insert into services_info (srv_image, srv_image_hash, srv_image_type, srv_image_updated_at, srv_name, srv_ip, srv_desc)
+                           values(%s,%s,%s,%s,%s,%s,%s) returning srv_id""",
+                        (psycopg2.Binary(file_bytes),file_hash,content_type,datetime.now(tz=timezone.utc),srv_name,srv_ip,srv_desc,))
             result = cur.fetchone()
             _service_id = result[0]
-            cur.execute("SELECT usr_access FROM usr_info WHERE usr_id = %s", (user_id,))
-            _result_user_access = cur.fetchone()[0]
-            
-            if not _result_user_access:
-                return Response({"detail": "User not found"}, status=status.HTTP_401_UNAUTHORIZED)
-
-            allowed_services = _result_user_access.split(",")
-            if _service_id not in allowed_services:
-                _result_user_access = f"{_result_user_access},{result[0]}"
-                cur.execute("update usr_info set usr_access = %s WHERE usr_id = %s", (_result_user_access,user_id,))
+            if gw_fields:
+                cur.execute(f"UPDATE services_info SET {', '.join(gw_fields)} WHERE srv_id = %s", (*gw_values, _service_id))
+            # The admin creating the service gets access to it
+            grant_access(cur, user_id, _service_id)
+            versions = bump_permission_versions(cur, [user_id])
             conn.commit()
-        
         except psycopg2.Error as e:
             conn.rollback()
-            print(e)
+            print(f"Service insert failed: {e}")
             raise APIException(f"Insert failed. {e}")
-        except Exception as e:
-            print(e)
         finally:
             cur.close()
             conn.close()
 
-        return Response({"message":"Success","id":result[0]})
+        # Committed, the caches follow
+        decision_cache.invalidate_user(user_id)
+        permission_versions.update(versions)
+        catalog_cache.clear()
+        queue_renditions(_service_id, file_hash, file_bytes)
+
+        response = {"message":"Success","id":_service_id}
+        if _truthy(request.data.get('deploy_gateway')):
+            response["gateway_job"] = submit_job("deploy", admin_user["user_id"])
+        return Response(response)
     
     
     
@@ -136,14 +183,10 @@ class ServicesManagerUpdate(APIView):
 
     def put(self, request: Request, service_id: int):
         try:
-            get_admin_user_from_token(request)
+            admin_user = get_admin_user_from_token(request)
         except APIException as e:
             return Response({"detail": e.detail}, status=e.status_code)
 
-        conn = get_db_connection()
-        cur = conn.cursor()
-        conn.autocommit = False
-
         srv_name = request.data.get('srv_name')
         srv_ip = request.data.get('srv_ip')
         srv_desc = request.data.get('srv_desc')
@@ -157,14 +200,21 @@ class ServicesManagerUpdate(APIView):
             allowed_extensions = ['.jpg', '.jpeg', '.png', '.gif']
             file_extension = os.path.splitext(srv_image_file.name.lower())[1]
             if file_extension not in allowed_extensions:
-                conn.rollback() # Rollback before raising
-                cur.close()
-                conn.close()
                 raise ValidationError({"detail": f"File type not allowed. Allowed types: {', '.join(allowed_extensions)}"})
 
             file_bytes = srv_image_file.read()
+            content_type = detect_image_type(file_bytes)
+            if not content_type:
+                raise ValidationError({"detail": "Uploaded file is not a valid image."})
             fields.append("srv_image = %s")
             values.append(psycopg2.Binary(file_bytes)) # Store as binary
+            file_hash = image_hash(file_bytes)
+            fields.append("srv_image_hash = %s")
+            values.append(file_hash)
+            fields.append("srv_image_type = %s")
+            values.append(content_type)
+            fields.append("srv_image_updated_at = %s")
+            values.append(datetime.now(tz=timezone.utc))
 
         if srv_name:
             fields.append("srv_name = %s")
@@ -178,18 +228,25 @@ class ServicesManagerUpdate(APIView):
             fields.append("srv_desc = %s")
             values.append(srv_desc)
 
+        gw_fields, gw_values = gateway_fields(request.data)
+        fields += gw_fields
+        values += gw_values
+
         if not fields:
-            cur.close() # Close cursor and connection
-            conn.close()
             return Response({"detail": "No fields to update."}, status=status.HTTP_400_BAD_REQUEST)
 
         query += ", ".join(fields) + " WHERE srv_id = %s"
         values.append(service_id)
 
+        conn = get_db_connection()
+        cur = conn.cursor()
+        conn.autocommit = False
         try:
             cur.execute(query, values)
             conn.commit()
-            
+            catalog_cache.clear()
+            if srv_image_file:
+                queue_renditions(service_id, file_hash, file_bytes)
 
         except psycopg2.Error as e:
             conn.rollback()
@@ -198,7 +255,10 @@ class ServicesManagerUpdate(APIView):
             cur.close()
             conn.close()
 
-        return Response({"message": "Success", "id": service_id})
+        response = {"message": "Success", "id": service_id}
+        if _truthy(request.data.get('deploy_gateway')):
+            response["gateway_job"] = submit_job("deploy", admin_user["user_id"])
+        return Response(response)
     
     
     def delete(self, request: Request, service_id: int):
@@ -219,9 +279,14 @@ class ServicesManagerUpdate(APIView):
                 conn.close()
                 return Response({"detail": "Service not found."}, status=status.HTTP_404_NOT_FOUND)
 
-            # Proceed to delete
+            # Proceed to delete, access rows go away with the service (on delete cascade)
+            cur.execute("SELECT usr_id FROM user_service_access WHERE srv_id = %s", (service_id,))
+            versions = bump_permission_versions(cur, [row[0] for row in cur.fetchall()])
             cur.execute("DELETE FROM services_info WHERE srv_id = %s", (service_id,))
             conn.commit()
+            decision_cache.invalidate_service(service_id)
+            catalog_cache.clear()
+            permission_versions.update(versions)
 
         except psycopg2.Error as e:
             conn.rollback()
@@ -231,4 +296,83 @@ class ServicesManagerUpdate(APIView):
             conn.close()
 
         return Response({"message": "Service deleted successfully", "id": service_id}, status=status.HTTP_200_OK)
-    
\ No newline at end of file
+
+
+class ServiceImage(APIView):
+    # Loaded by <img> tags, which can't send the Bearer header. Instead the
+    # URL has to carry the image's hash (?v=, 64 bits), which only the
+    # catalog of a user with access to the service hands out, so the tiles
+    # can't be enumerated by service id and stay cacheable by anyone.
+    authentication_classes = []
+    permission_classes = [AllowAny]
+
+    def get(self, request: Request, service_id: int):
+        rendition = request.GET.get("r")
+        if rendition is not None and rendition not in RENDITIONS:
+            return HttpResponse(status=status.HTTP_404_NOT_FOUND)
+        etag_header = request.headers.get("If-None-Match", "")
+        version = request.GET.get("v", "")
+        if len(version) != 16:
+            return HttpResponse(status=status.HTTP_404_NOT_FOUND)
+
+        conn = get_db_connection()
+        cur = conn.cursor()
+        try:
+            row = None
+            if rendition:
+                # Smallest rendition the client accepts, built from the current original
+                accept = request.headers.get("Accept", "")
+                content_types = [content_type for content_type, _, _ in RENDITIONS[rendition]
+                                 if content_type != "image/webp" or "image/webp" in accept]
+                cur.execute("""
+                    SELECT r.image_hash, r.content_type, r.created_at, si.srv_image_hash,
+                           CASE WHEN position(r.image_hash in %s) > 0 THEN NULL ELSE r.data END
+                    FROM service_image_renditions r
+                    JOIN services_info si ON si.srv_id = r.srv_id AND si.srv_image_hash = r.source_hash
+                    WHERE r.srv_id = %s AND left(si.srv_image_hash, 16) = %s
+                      AND r.rendition = %s AND r.content_type = ANY(%s)
+                    ORDER BY r.bytes LIMIT 1
+                """, (etag_header, service_id, version, rendition, content_types))
+                row = cur.fetchone()
+
+            if row:
+                etag_hash, content_type, updated_at, source_hash, data = row
+                immutable = True
+            else:
+                # Original upload, skip reading the bytea when the client already has it
+                cur.execute("""
+                    SELECT srv_image_hash, srv_image_type, srv_image_updated_at,
+                           CASE WHEN position(srv_image_hash in %s) > 0 THEN NULL ELSE srv_image END
+                    FROM services_info WHERE srv_id = %s AND left(srv_image_hash, 16) = %s
+                """, (etag_header, service_id, version))
+                row = cur.fetchone()
+                if not row:
+                    return HttpResponse(status=status.HTTP_404_NOT_FOUND)
+                etag_hash, content_type, updated_at, data = row
+                # A rendition URL answered with the original must not be cached for good
+                immutable = not rendition
+                if rendition and data is not None:
+                    queue_renditions(service_id, etag_hash, bytes(data))
+        except psycopg2.Error as e:
+            raise APIException(f"Image query failed: {e}")
+        finally:
+            cur.close()
+            conn.close()
+
+        headers = {
+            "ETag": quote_etag(etag_hash),
+            "Cache-Control": f"public, max-age={IMAGE_CACHE_MAX_AGE}, immutable" if immutable
+                             else f"public, max-age={IMAGE_REVALIDATE_MAX_AGE}",
+        }
+        if rendition:
+            headers["Vary"] = "Accept"
+        if updated_at:
+            headers["Last-Modified"] = http_date(updated_at.timestamp())
+
+        if data is None:
+            return HttpResponseNotModified(headers=headers)
+        if_modified_since = parse_http_date_safe(request.headers.get("If-Modified-Since", ""))
+        if not etag_header and updated_at and if_modified_since and int(updated_at.timestamp()) <= if_modified_since:
+            return HttpResponseNotModified(headers=headers)
+
+        return HttpResponse(bytes(data), content_type=content_type or "application/octet-stream", headers=headers)
@@ -3,34 +3,46 @@ from rest_framework.authentication import BaseAuthentication
 from rest_framework.exceptions import AuthenticationFailed
 import jwt
 
-SECRET_KEY = "testkey"
+from utils.jwt import token_payload,get_request_identity,request_is_admin,TokenRevoked
 
 class CustomUser:
-    def __init__(self, user_id, username):
+    def __init__(self, user_id, username, request=None):
         self.id = user_id
         self.username = username
         self.is_authenticated = True  # Required for DRF permission checks
+        self._request = request
+
+    @property
+    def identity(self):
+        """Admin flag and access, looked up on first use and shared with get_admin_user_from_token."""
+        return get_request_identity(self._request)
+
+    @property
+    def is_admin(self):
+        return request_is_admin(self._request, self.identity["user_id"])
 
 class JWTCustomAuth(BaseAuthentication):
     def authenticate(self, request):
         auth_header = request.headers.get('Authorization')
         if not auth_header or not auth_header.startswith("Bearer "):
             return None
-        
+
         token = auth_header.split(" ")[1]
 
         try:
-            payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
+            # Decoded once per request, admin views reuse it
+            payload = token_payload(request, token)
         except jwt.ExpiredSignatureError:
             raise AuthenticationFailed("Token expired.")
+        except TokenRevoked:
+            raise AuthenticationFailed("Token revoked.")
         except jwt.InvalidTokenError:
             raise AuthenticationFailed("Invalid token.")
 
         user_id = payload.get("user_id")
         username = payload.get("user_name")
-        
+
         if not user_id or not username:
             raise AuthenticationFailed("Invalid token payload.")
 
-        # You could validate against the DB here again, but optional
-        return (CustomUser(user_id, username), None)
+        return (CustomUser(user_id, username, request), payload)
@@ -0,0 +1,216 @@
+"""
+Bulk user import/export for the admin API.
+
+Import: rows are validated in Python (same rules as a single create), the
+valid ones are COPY'd into a temporary staging table and merged into usr_info
+and user_service_access in one transaction. Export: COPY ... TO STDOUT
+streamed through a bounded queue so the whole table is never in memory
+(async iterators, a sync one would be read into a list under ASGI).
+"""
+from rest_framework.exceptions import ValidationError
+from asgiref.sync import sync_to_async
+
+from datetime import datetime,timezone
+import threading
+import queue
+import json
+import csv
+import io
+
+from utils.access import ACCESS_LIST_SQL,parse_access
+from utils.database import get_db_connection,stream_rows
+from utils.passwords import hash_passwords
+from utils.change_feed import suppress_row_notifications,publish
+from .listing import user_row_to_dict
+
+BULK_IMPORT_MAX_ROWS = 50000
+EXPORT_QUEUE_CHUNKS = 64
+
+EXPORT_COLUMNS_SQL = f"usr_id, usr_login, usr_admin, {ACCESS_LIST_SQL} AS access, created_at, jwt_expiration"
+
+
+def _truthy(value):
+    if isinstance(value, bool):
+        return value
+    return str(value or "").strip().lower() in ("1", "true", "yes", "t")
+
+
+def read_rows(uploaded_file):
+    """(line number, dict) for every row of a CSV (with header) or JSONL upload."""
+    text = io.TextIOWrapper(uploaded_file.file, encoding="utf-8-sig", newline="")
+    if uploaded_file.name.lower().endswith((".jsonl", ".ndjson")):
+        for line_number, line in enumerate(text, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                yield line_number, None
+                continue
+            yield line_number, row if isinstance(row, dict) else None
+    else:
+        reader = csv.DictReader(text)
+        for row in reader:
+            yield reader.line_num, row
+
+
+def validate_rows(rows, validate_password):
+    """Splits the upload into valid rows (ready for COPY) and per-row errors."""
+    valid = []
+    errors = []
+    seen = set()
+    for line_number, row in rows:
+        if len(valid) + len(errors) >= BULK_IMPORT_MAX_ROWS:
+            raise ValidationError({"detail": f"Import is limited to {BULK_IMPORT_MAX_ROWS} rows."})
+        if row is None:
+            errors.append({"line": line_number, "user_name": None, "detail": "Malformed row."})
+            continue
+
+        user_name = str(row.get("user_name") or "").strip().lower()
+        user_pass = row.get("user_pass") or ""
+        try:
+            if not user_name:
+                raise ValidationError({"detail": "Missing 'user_name' field."})
+            if not user_pass:
+                raise ValidationError({"detail": "Missing 'user_pass' field."})
+            if user_name in seen:
+                raise ValidationError({"detail": f"Username '{user_name}' repeated in the file."})
+            validate_password(user_pass)
+            service_ids = parse_access(row.get("access"))
+        except ValidationError as e:
+            detail = e.detail.get("detail") if isinstance(e.detail, dict) else e.detail
+            errors.append({"line": line_number, "user_name": user_name or None, "detail": str(detail)})
+            continue
+
+        seen.add(user_name)
+        jwt_expiration = row.get("jwt_expiration")
+        valid.append((line_number, user_name, user_pass, _truthy(row.get("is_admin")),
+                      "{" + ",".join(map(str, service_ids)) + "}",
+                      None if jwt_expiration in (None, "") else str(jwt_expiration)))
+    return valid, errors
+
+
+def hash_row_passwords(valid_rows):
+    """Same rows with the passwords hashed, done before taking a connection."""
+    hashes = hash_passwords(row[2] for row in valid_rows)
+    return [row[:2] + (password_hash,) + row[3:] for row, password_hash in zip(valid_rows, hashes)]
+
+
+def import_users(cur, valid_rows):
+    """
+    COPY the validated rows into a staging table and merge them, inside the
+    caller's transaction. Returns {line: usr_id} for the created users (rows
+    missing from it hit an existing login) and their [usr_id, version] pairs.
+    The per-row triggers are off, a single BULK event announces the users
+    when the caller commits.
+    """
+    suppress_row_notifications(cur)
+    cur.execute("""
+        CREATE TEMP TABLE usr_import (
+            line integer, usr_login text, usr_password text, usr_admin boolean,
+            access integer[], jwt_expiration text
+        ) ON COMMIT DROP
+    """)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerows(valid_rows)
+    buffer.seek(0)
+    cur.copy_expert("COPY usr_import FROM STDIN WITH (FORMAT csv)", buffer)
+
+    cur.execute("""
+        INSERT INTO usr_info (usr_login, usr_password, usr_admin, created_at, jwt_expiration)
+        SELECT usr_login, usr_password, usr_admin, %s, jwt_expiration FROM usr_import ORDER BY line
+        ON CONFLICT (usr_login) DO NOTHING
+        RETURNING usr_id, usr_login, usr_perm_version
+    """, (datetime.now(tz=timezone.utc),))
+    inserted = cur.fetchall()
+    created_logins = dict((login, user_id) for user_id, login, _ in inserted)
+    versions = [(user_id, version) for user_id, _, version in inserted]
+
+    cur.execute("""
+        INSERT INTO user_service_access (usr_id, srv_id)
+        SELECT u.usr_id, a.srv_id
+        FROM usr_import i
+        JOIN usr_info u ON u.usr_login = i.usr_login AND u.usr_id = ANY(%s)
+        CROSS JOIN LATERAL unnest(i.access) AS a (srv_id)
+        JOIN services_info si ON si.srv_id = a.srv_id
+        ON CONFLICT DO NOTHING
+    """, (list(created_logins.values()),))
+
+    if versions:
+        publish(cur, {"table": "usr_info", "op": "BULK", "users": versions})
+    created = {line: created_logins[login] for line, login, *_ in valid_rows if login in created_logins}
+    return created, versions
+
+
+class _QueueWriter:
+    # File-like target for copy_expert that hands chunks to the response
+    def __init__(self, chunks, cancelled):
+        self.chunks = chunks
+        self.cancelled = cancelled
+
+    def write(self, data):
+        data = data.encode() if isinstance(data, str) else data
+        while True:
+            try:
+                self.chunks.put(data, timeout=1)
+                return
+            except queue.Full:
+                # Client went away, make COPY fail instead of blocking forever
+                if self.cancelled.is_set():
+                    raise IOError("export cancelled")
+
+
+def _next_chunk(chunks):
+    # Short timeout so the worker thread is free again soon after a disconnect
+    try:
+        return chunks.get(timeout=1)
+    except queue.Empty:
+        return None
+
+
+async def stream_export_csv():
+    """CSV export of usr_info (no passwords) straight from COPY TO STDOUT."""
+    chunks = queue.Queue(maxsize=EXPORT_QUEUE_CHUNKS)
+    cancelled = threading.Event()
+    done = object()
+    failure = []
+
+    def run_copy():
+        conn = get_db_connection()
+        cur = conn.cursor()
+        try:
+            cur.copy_expert(f"COPY (SELECT {EXPORT_COLUMNS_SQL} FROM usr_info ORDER BY usr_id) TO STDOUT WITH (FORMAT csv, HEADER)",
+                            _QueueWriter(chunks, cancelled))
+        except Exception as e:
+            failure.append(e)
+        finally:
+            cur.close()
+            conn.close()
+            while not cancelled.is_set():
+                try:
+                    chunks.put(done, timeout=1)
+                    break
+                except queue.Full:
+                    pass
+
+    threading.Thread(target=run_copy, name="user-export", daemon=True).start()
+    next_chunk = sync_to_async(_next_chunk, thread_sensitive=False)
+    try:
+        while True:
+            chunk = await next_chunk(chunks)
+            if chunk is None:
+                continue
+            if chunk is done:
+                break
+            yield chunk
+    finally:
+        cancelled.set()
+    if failure:
+        print(f"User export failed: {failure[0]}")
+
+
+async def stream_export_jsonl():
+    """JSON lines export of usr_info (no passwords) from a server-side cursor."""
+    async for rows in stream_rows("user_export", f"SELECT {EXPORT_COLUMNS_SQL} FROM usr_info ORDER BY usr_id"):
+        yield b"".join(json.dumps(user_row_to_dict(row)).encode() + b"\n" for row in rows)
@@ -0,0 +1,142 @@
+"""
+ASGI fast path for the nginx auth_request subrequest.
+
+/api/v1/users/validate is answered here without going through Django
+middleware, DRF or the sync thread pool, the access lookup uses an asyncpg
+pool. Same contract as users.views.ValidateToken: Bearer token in
+Authorization, optional X-Service-ID, 200 with user_id/user_name or 401,
+with the same gateway caching and identity headers (and the same metrics).
+Every other request is handed to the Django application.
+
+TokenCheck runs on the event loop, so everything it reads has to be in
+memory: the decision cache, the permission versions, the revocation list,
+the signing keys and the snapshot map are all refreshed by background
+threads, never inline. The database lookup is bounded by
+ASYNC_DB_ACQUIRE_TIMEOUT and ASYNC_DB_QUERY_TIMEOUT: when the pool is
+exhausted or the database stalls nginx gets a 503 right away instead of
+every auth_request hanging.
+"""
+import asyncio
+import json
+import time
+import os
+
+import asyncpg
+
+from utils import database
+from utils.access import has_access_async
+from utils.signing_keys import SigningKeysUnavailable
+from utils.metrics import DB_ACQUIRE_TIME,DB_QUERY_TIME,record_decision,record_request,timed
+from .validation import TokenCheck,NO_STORE_HEADERS
+
+VALIDATE_PATH = "/api/v1/users/validate"
+VALIDATE_ENDPOINT = "api/v1/users/validate"  # URL pattern label, same as when Django serves it
+
+ASYNC_DB_POOL_MIN_SIZE = int(os.environ.get("ASYNC_DB_POOL_MIN_SIZE", 2))
+ASYNC_DB_POOL_MAX_SIZE = int(os.environ.get("ASYNC_DB_POOL_MAX_SIZE", 20))
+ASYNC_DB_ACQUIRE_TIMEOUT = float(os.environ.get("ASYNC_DB_ACQUIRE_TIMEOUT", 1))   # seconds waiting for a pooled connection
+ASYNC_DB_QUERY_TIMEOUT = float(os.environ.get("ASYNC_DB_QUERY_TIMEOUT", 2))       # seconds per access lookup
+
+
+def _json(status_code, body, headers=NO_STORE_HEADERS):
+    return status_code, json.dumps(body).encode(), headers
+
+
+class FastValidateApp:
+    def __init__(self, django_app):
+        self.django_app = django_app
+        self.pool = None
+        self._pool_lock = asyncio.Lock()
+
+    async def get_pool(self):
+        if self.pool is None:
+            async with self._pool_lock:
+                if self.pool is None:
+                    self.pool = await asyncpg.create_pool(
+                        host=database.DB_HOST,
+                        database=database.DB_NAME,
+                        user=database.DB_USER,
+                        password=database.DB_PASSWORD,
+                        min_size=ASYNC_DB_POOL_MIN_SIZE,
+                        max_size=ASYNC_DB_POOL_MAX_SIZE,
+                        max_inactive_connection_lifetime=database.DB_POOL_MAX_AGE,
+                        timeout=database.DB_CONNECT_TIMEOUT,
+                        command_timeout=ASYNC_DB_QUERY_TIMEOUT,
+                    )
+        return self.pool
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "http" and scope["path"] == VALIDATE_PATH and scope["method"] in ("GET", "HEAD"):
+            started = time.perf_counter()
+            status_code, body, extra_headers = await self.validate(scope)
+            await send({
+                "type": "http.response.start",
+                "status": status_code,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode()),
+                ] + [(name.lower().encode(), value.encode("latin-1")) for name, value in extra_headers],
+            })
+            await send({"type": "http.response.body", "body": b"" if scope["method"] == "HEAD" else body})
+            record_request(VALIDATE_ENDPOINT, scope["method"], status_code, time.perf_counter() - started)
+        else:
+            await self.django_app(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        # Django's handler doesn't speak lifespan, so it's handled here
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                try:
+                    await self.get_pool()
+                except Exception as e:
+                    # Don't keep the worker down, the pool is retried on first use
+                    print(f"Async database pool startup failed: {e}")
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self.pool is not None:
+                    await self.pool.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def validate(self, scope):
+        auth = ""
+        service_id = None
+        for name, value in scope["headers"]:
+            if name == b"authorization":
+                auth = value.decode("latin-1")
+            elif name == b"x-service-id":
+                service_id = value.decode("latin-1")
+
+        if not auth.startswith("Bearer ") or len(auth.split()) != 2:
+            record_decision(401, {"detail": "No token provided"}, service_id)
+            return _json(401, {"detail": "No token provided"})
+
+        try:
+            check = TokenCheck(auth.split()[1], service_id)
+        except SigningKeysUnavailable as e:
+            record_decision(503, None, service_id)
+            return _json(503, {"detail": str(e.detail)})
+        if check.needs_access_check:
+            try:
+                pool = await self.get_pool()
+                with timed(DB_ACQUIRE_TIME.labels("asyncpg")):
+                    conn = await pool.acquire(timeout=ASYNC_DB_ACQUIRE_TIMEOUT)
+                try:
+                    with timed(DB_QUERY_TIME.labels("asyncpg")):
+                        allowed = await has_access_async(conn, check.user_id, check.srv_id)
+                finally:
+                    await pool.release(conn)
+                check.finish(allowed)
+            except (OSError, asyncio.TimeoutError):
+                # Pool exhausted, database stalled or unreachable
+                record_decision(503, None, service_id)
+                return _json(503, {"detail": database.DatabaseUnavailable.default_detail})
+            except asyncpg.PostgresError:
+                record_decision(500, None, service_id)
+                return _json(500, {"detail": "Database query error!"})
+
+        record_decision(*check.result, service_id)
+        return _json(*check.result, check.headers())
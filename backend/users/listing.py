@@ -0,0 +1,105 @@
+from rest_framework.exceptions import ValidationError
+
+from datetime import datetime
+
+from utils.access import ACCESS_LIST_SQL
+
+USER_LIST_MAX_LIMIT = 1000
+USER_STREAM_BATCH_SIZE = 500
+
+USER_COLUMNS_SQL = f"usr_id, usr_login, usr_admin, {ACCESS_LIST_SQL}, created_at, jwt_expiration"
+
+
+def user_row_to_dict(row):
+    return {
+        "id": row[0],
+        "username": row[1],
+        "is_admin": row[2],
+        "access": row[3],
+        "created_at": row[4].isoformat() if row[4] else None,
+        "jwt_expiration": row[5]
+    }
+
+
+def _int_param(params, name, minimum=0):
+    value = params.get(name)
+    if value in (None, ""):
+        return None
+    try:
+        value = int(value)
+    except (TypeError, ValueError):  # JSON bodies can hold lists and objects
+        raise ValidationError({"detail": f"'{name}' must be an integer."})
+    if value < minimum:
+        raise ValidationError({"detail": f"'{name}' must be at least {minimum}."})
+    return value
+
+
+def bool_param(params, name):
+    """True/False/None (absent) from a query param or a JSON body field."""
+    value = params.get(name)
+    if value in (None, ""):
+        return None
+    if isinstance(value, bool):  # JSON bodies
+        return value
+    value = str(value).lower()
+    if value in ("1", "true", "yes"):
+        return True
+    if value in ("0", "false", "no"):
+        return False
+    raise ValidationError({"detail": f"'{name}' must be true or false."})
+
+
+def _datetime_param(params, name):
+    value = params.get(name)
+    if value in (None, ""):
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise ValidationError({"detail": f"'{name}' must be an ISO 8601 date/time."})
+
+
+def build_user_filters(params):
+    """
+    WHERE clause (without the keyset condition) and its values for the admin
+    user listing. Supported query params: is_admin, service, created_from,
+    created_to, login_prefix.
+    """
+    conditions = []
+    values = []
+
+    is_admin = bool_param(params, "is_admin")
+    if is_admin is not None:
+        conditions.append("usr_admin = %s")
+        values.append(is_admin)
+
+    service_id = _int_param(params, "service")
+    if service_id is not None:
+        conditions.append("EXISTS (SELECT 1 FROM user_service_access f WHERE f.usr_id = usr_info.usr_id AND f.srv_id = %s)")
+        values.append(service_id)
+
+    created_from = _datetime_param(params, "created_from")
+    if created_from is not None:
+        conditions.append("created_at >= %s")
+        values.append(created_from)
+
+    created_to = _datetime_param(params, "created_to")
+    if created_to is not None:
+        conditions.append("created_at < %s")
+        values.append(created_to)
+
+    login_prefix = params.get("login_prefix")
+    if login_prefix:
+        # Logins are stored lowercase, escape LIKE wildcards in the prefix
+        escaped = str(login_prefix).lower().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        conditions.append("usr_login LIKE %s")
+        values.append(escaped + "%")
+
+    return conditions, values
+
+
+def parse_page_params(params):
+    limit = _int_param(params, "limit", minimum=1)
+    if limit is not None:
+        limit = min(limit, USER_LIST_MAX_LIMIT)
+    return limit, _int_param(params, "after")
@@ -1,3 +1,1503 @@
-from django.test import TestCase
+from django.test import RequestFactory,SimpleTestCase
+from django.http import HttpResponse
+from rest_framework.test import APIRequestFactory
+from rest_framework.exceptions import AuthenticationFailed,ValidationError
+from rest_framework import status
+from django.core.files.uploadedfile import SimpleUploadedFile
 
-# Create your tests here.
+from datetime import datetime,timedelta,timezone
+from contextlib import contextmanager
+from psycopg2 import extensions
+from prometheus_client import REGISTRY
+from unittest import mock
+import ipaddress
+import tempfile
+import psycopg2
+import threading
+import asyncio
+import random
+import json
+import csv
+import io
+import time
+import gc
+import jwt
+import os
+
+from utils.access import has_access,has_access_many,parse_access,services_to_bitset
+from utils.access_snapshot import AccessSnapshot,SnapshotFile,write_snapshot,private_directory
+from utils.database import ConnectionPool,DatabaseUnavailable,PooledConnection
+from utils.auth_cache import DecisionCache,decision_cache,token_digest
+from utils import auth_cache
+from utils.change_feed import ChangeFeed,CHANGE_FEED_MAX_PAYLOAD,publish,suppress_row_notifications
+from utils.jwt import bitset_has_service,create_token,decode_token,encode_service_bitset,get_admin_user_from_token
+from utils.metrics import record_decision,service_label
+from utils.query_stats import QueryStatsMiddleware,current_queries,record_acquire,record_query
+from utils.passwords import HashingPool,PasswordHashingBusy,make_hash,check_hash
+from utils.throttle import MemoryBackend,client_ip
+from utils.permissions import PermissionVersions,permission_versions,_on_change
+from utils.revocation import BloomFilter,RevocationList,revocation_list,revoke_user_tokens,_State
+from utils.signing_keys import KeyRing,SigningKey,SigningKeysUnavailable,generate_private_pem,key_ring
+from benchmarks import loadtest
+from .validation import TokenCheck,VALIDATE_CACHE_TTL,VALIDATE_NEGATIVE_CACHE_TTL
+from .bulk import import_users,read_rows,stream_export_csv,stream_export_jsonl,validate_rows
+from .listing import build_user_filters,bool_param,parse_page_params
+from .views import AdminAllUsersOperations,AdminBulkAccess,AdminBulkImportUsers,ValidateToken,ValidateTokenBatch,validate_password,AdminSingleUserOperations
+from .fast_validate import FastValidateApp,VALIDATE_PATH
+
+
+class FakeClock:
+    """Stands in for time.monotonic()/time.time(), moved by hand."""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def make_signing_key(kid="test-kid", activates_at=None, alg="EdDSA"):
+    activates_at = activates_at or datetime.now(tz=timezone.utc) - timedelta(days=1)
+    with mock.patch("utils.signing_keys.JWT_KEY_PASSPHRASE", b"test"):
+        return SigningKey(kid, alg, generate_private_pem(alg), activates_at)
+
+
+class SigningKeyMixin:
+    """Signs and verifies with an in-memory EdDSA key instead of jwt_signing_keys."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.signing_key = make_signing_key()
+
+    def setUp(self):
+        super().setUp()
+        for patcher in (
+            mock.patch.multiple(key_ring, _keys={self.signing_key.kid: self.signing_key},
+                                _loaded_at=time.monotonic(), _started=True),
+            mock.patch("utils.signing_keys.JWT_SIGNING_ALG", "EdDSA"),
+            mock.patch("utils.jwt.JWT_SIGNING_ALG", "EdDSA"),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+class FakePgConnection:
+    """The parts of a psycopg2 connection the pool touches."""
+
+    def __init__(self):
+        self.closed = 0
+        self.autocommit = False
+        self.status = extensions.TRANSACTION_STATUS_IDLE
+        self.rollbacks = 0
+
+    def get_transaction_status(self):
+        return self.status
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.status = extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+
+class ConnectionPoolTests(SimpleTestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch("utils.database.psycopg2.connect", side_effect=lambda **kwargs: FakePgConnection())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def pool(self, max_size=1, acquire_timeout=0.05, max_age=60):
+        return ConnectionPool(0, max_size, acquire_timeout, max_age, check_idle_after=30)
+
+    def test_acquire_times_out_when_the_pool_is_exhausted(self):
+        pool = self.pool()
+        pool.acquire()
+        with self.assertRaises(DatabaseUnavailable):
+            pool.acquire()
+        self.assertEqual(pool.stats()["timeouts"], 1)
+
+    def test_waiting_thread_gets_the_released_connection(self):
+        pool = self.pool(acquire_timeout=5)
+        conn = pool.acquire()
+        threading.Timer(0.05, pool.release, (conn,)).start()
+        self.assertIs(pool.acquire(), conn)
+        self.assertEqual(pool.stats()["waits"], 1)
+
+    def test_release_rolls_back_and_resets_autocommit(self):
+        pool = self.pool()
+        conn = pool.acquire()
+        conn.status = extensions.TRANSACTION_STATUS_INTRANS
+        conn.autocommit = True
+        pool.release(conn)
+        self.assertEqual((conn.rollbacks, conn.autocommit), (1, False))
+        self.assertIs(pool.acquire(), conn)
+
+    def test_old_connections_are_recycled(self):
+        pool = self.pool(max_age=60)
+        with mock.patch("utils.database.time.monotonic", self.clock):
+            conn = pool.acquire()
+            self.clock.now += 61
+            pool.release(conn)
+        self.assertTrue(conn.closed)
+        stats = pool.stats()
+        self.assertEqual((stats["recycled"], stats["size"], stats["idle"]), (1, 0, 0))
+        self.assertIsNot(pool.acquire(), conn)
+
+    def test_broken_connection_is_not_reused(self):
+        pool = self.pool()
+        conn = pool.acquire()
+        conn.closed = 2
+        pool.release(conn)
+        self.assertEqual(pool.stats()["size"], 0)
+        self.assertIsNot(pool.acquire(), conn)
+
+    def test_dropped_wrapper_is_reclaimed_and_reset(self):
+        pool = self.pool()
+        conn = pool.acquire()
+        conn.status = extensions.TRANSACTION_STATUS_INTRANS
+        with mock.patch("builtins.print"):
+            PooledConnection(pool, conn)
+            gc.collect()
+        self.assertIs(pool.acquire(), conn)
+        self.assertEqual(conn.rollbacks, 1)
+        self.assertEqual(pool.stats()["leaked"], 1)
+
+
+class DecisionCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch("utils.auth_cache.time.monotonic", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache = DecisionCache(max_entries=3, ttl=60, negative_ttl=300)
+
+    def test_entry_expires_after_ttl(self):
+        self.cache.set(("a", "1"), 200, {"user_id": 1}, user_id=1)
+        self.assertEqual(self.cache.get(("a", "1")), (200, {"user_id": 1}, 60))
+        self.clock.now += 59
+        self.assertEqual(self.cache.get(("a", "1"))[2], 1)
+        self.clock.now += 1
+        self.assertIsNone(self.cache.get(("a", "1")))
+
+    def test_negative_entries_use_their_own_ttl(self):
+        self.cache.set(("bad", None), 401, {"detail": "Invalid token"}, negative=True)
+        self.clock.now += 299
+        self.assertIsNotNone(self.cache.get(("bad", None)))
+        self.clock.now += 1
+        self.assertIsNone(self.cache.get(("bad", None)))
+
+    def test_entry_never_outlives_the_token(self):
+        expiration = datetime.now(tz=timezone.utc) + timedelta(seconds=10)
+        self.cache.set(("a", "1"), 200, {}, user_id=1, token_expiration=expiration)
+        self.assertLessEqual(self.cache.get(("a", "1"))[2], 10)
+        self.cache.set(("b", "1"), 200, {}, user_id=1, token_expiration=expiration - timedelta(seconds=20))
+        self.assertIsNone(self.cache.get(("b", "1")))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        for name in ("a", "b", "c"):
+            self.cache.set((name, "1"), 200, {}, user_id=1)
+        self.cache.get(("a", "1"))
+        self.cache.set(("d", "1"), 200, {}, user_id=2)
+        self.assertIsNone(self.cache.get(("b", "1")))
+        for name in ("a", "c", "d"):
+            self.assertIsNotNone(self.cache.get((name, "1")))
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+
+    def test_invalidate_user_drops_only_that_users_entries(self):
+        self.cache.set(("a", "1"), 200, {}, user_id=1)
+        self.cache.set(("a", "2"), 401, {}, user_id=1)
+        self.cache.set(("b", "1"), 200, {}, user_id=2)
+        self.cache.invalidate_user(1)
+        self.assertIsNone(self.cache.get(("a", "1")))
+        self.assertIsNone(self.cache.get(("a", "2")))
+        self.assertIsNotNone(self.cache.get(("b", "1")))
+        # Evicting after an invalidation must not trip over the dropped keys
+        for name in ("c", "d", "e"):
+            self.cache.set((name, "1"), 200, {}, user_id=1)
+        self.assertEqual(self.cache.stats()["entries"], 3)
+
+
+class TokenCheckTests(SigningKeyMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        decision_cache.clear()
+        self.addCleanup(decision_cache.clear)
+        for patcher in (
+            mock.patch.multiple(permission_versions, _versions={7: 2}, _loaded=True, _thread=mock.Mock()),
+            mock.patch.object(revocation_list, "_state", _State(BloomFilter(100, 0.01), set(), {})),
+            mock.patch("utils.jwt.TOKEN_EMBED_SCOPES", True),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_valid_token_with_current_scopes_is_allowed(self):
+        token = create_token(7, "ana", 1, services=[3, 5], perm_version=2)
+        check = TokenCheck(token, "3")
+        self.assertEqual(check.result, (status.HTTP_200_OK, {"user_id": 7, "user_name": "ana"}))
+        self.assertFalse(check.needs_access_check)
+        self.assertEqual(TokenCheck(token, "4").result[1], {"detail": "Access denied to this service"})
+
+    def test_expired_token_is_denied(self):
+        token = create_token(7, "ana", -1)
+        check = TokenCheck(token, "3")
+        self.assertEqual(check.result, (status.HTTP_401_UNAUTHORIZED, {"detail": "Token expired"}))
+
+    def test_revoked_token_is_denied(self):
+        token = create_token(7, "ana", 1, services=[3], perm_version=2)
+        revocation_list.add_token(jwt.decode(token, options={"verify_signature": False})["jti"])
+        self.assertEqual(TokenCheck(token, "3").result, (status.HTTP_401_UNAUTHORIZED, {"detail": "Token revoked"}))
+
+    def test_outdated_permission_version_is_denied(self):
+        token = create_token(7, "ana", 1, services=[3], perm_version=1)
+        check = TokenCheck(token, "3")
+        self.assertEqual(check.result, (status.HTTP_401_UNAUTHORIZED,
+                                        {"detail": "Token permissions outdated, login again"}))
+
+    def test_newer_permission_version_goes_to_the_database(self):
+        token = create_token(7, "ana", 1, services=[3], perm_version=3)
+        check = TokenCheck(token, "3")
+        self.assertTrue(check.needs_access_check)
+        check.finish(False)
+        self.assertEqual(check.result[1], {"detail": "Access denied to this service"})
+
+    def test_decision_is_cached_per_token_and_service(self):
+        token = create_token(7, "ana", 1, services=[3], perm_version=2)
+        TokenCheck(token, "3")
+        self.assertIsNotNone(decision_cache.get((token_digest(token), "3")))
+        self.assertIsNone(decision_cache.get((token_digest(token), "4")))
+
+    def test_forged_token_is_denied(self):
+        token = create_token(7, "ana", 1)
+        forged = token[:-4] + ("AAAA" if not token.endswith("AAAA") else "BBBB")
+        self.assertEqual(TokenCheck(forged, "3").result[1], {"detail": "Invalid token"})
+
+
+class AccessTableTests(SimpleTestCase):
+    def test_has_access(self):
+        cur = mock.Mock()
+        cur.fetchone.return_value = None
+        self.assertIsNone(has_access(cur, 7, 3))
+        self.assertEqual(cur.execute.call_args[0][1], (3, 7))
+        cur.fetchone.return_value = (False,)
+        self.assertIs(has_access(cur, 7, 3), False)
+        cur.fetchone.return_value = (True,)
+        self.assertIs(has_access(cur, 7, 3), True)
+
+    def test_has_access_many_answers_every_pair(self):
+        cur = mock.Mock()
+        cur.fetchall.return_value = [(7, [3]), (8, [])]
+        answers = has_access_many(cur, [(7, 3), (7, 4), (8, 3), (9, 3), (7, 3)])
+        self.assertEqual(answers, {(7, 3): True, (7, 4): False, (8, 3): False, (9, 3): None})
+        # One statement, the ids deduplicated
+        cur.execute.assert_called_once()
+        self.assertEqual(cur.execute.call_args[0][1], ([3, 4], [7, 8, 9]))
+
+    def put(self, data, conn):
+        request = APIRequestFactory().put("/api/v1/users/admin/users/7/", data, format="json")
+        with mock.patch("users.views.get_admin_user_from_token", return_value={"user_id": 1}), \
+                mock.patch("users.views.get_db_connection", return_value=conn), \
+                mock.patch("users.views.set_user_access") as set_user_access, \
+                mock.patch("users.views.bump_permission_versions", return_value=[(7, 4)]), \
+                mock.patch("users.views.permission_versions") as versions, \
+                mock.patch("users.views.decision_cache"):
+            response = AdminSingleUserOperations.as_view()(request, target_user_id=7)
+        return response, set_user_access, versions
+
+    def test_access_list_replaces_the_users_rows(self):
+        conn = mock.Mock()
+        conn.cursor.return_value.fetchone.side_effect = [(7,), (7, "ana", False, "4,5", "1")]
+        response, set_user_access, versions = self.put({"access": "5, 4,4", "is_admin": False}, conn)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        set_user_access.assert_called_once_with(conn.cursor.return_value, 7, [4, 5])
+        versions.update.assert_called_once_with([(7, 4)])
+        self.assertEqual(response.data["user"]["access"], "4,5")
+
+    def test_malformed_access_list_is_rejected_before_the_database(self):
+        conn = mock.Mock()
+        response, set_user_access, _ = self.put({"access": "4,x"}, conn)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        conn.cursor.assert_not_called()
+        set_user_access.assert_not_called()
+
+
+class PermissionVersionsTests(SimpleTestCase):
+    def setUp(self):
+        self.versions = PermissionVersions(30)
+        self.versions._thread = mock.Mock()
+
+    def reload(self, rows, during=None):
+        conn = mock.MagicMock()
+        cur = conn.cursor.return_value
+
+        def fetchall():
+            if during:
+                during()
+            return rows
+        cur.fetchall.side_effect = fetchall
+
+        @contextmanager
+        def db_connection():
+            yield conn
+        with mock.patch("utils.permissions.database.db_connection", db_connection):
+            self.versions.reload()
+
+    def test_reload_never_moves_a_version_back(self):
+        self.versions.update([(7, 5)])
+        self.reload([(7, 4), (8, 1)])
+        self.assertTrue(self.versions.loaded)
+        self.assertEqual(self.versions.get(7), 5)
+        self.assertEqual(self.versions.get(8), 1)
+        self.assertIsNone(self.versions.get(9))
+
+    def test_changes_made_during_a_reload_are_replayed(self):
+        self.reload([(7, 1), (8, 1)], during=lambda: (self.versions.update([(7, 2)]), self.versions.remove(8)))
+        self.assertEqual(self.versions.get(7), 2)
+        self.assertIsNone(self.versions.get(8))
+
+    def test_change_feed_events(self):
+        with mock.patch("utils.permissions.permission_versions", self.versions):
+            _on_change({"table": "usr_info", "op": "UPDATE", "usr_id": 7, "pv": 3})
+            _on_change({"table": "usr_info", "op": "BULK", "users": [(8, 2), (9, 1)]})
+            _on_change({"table": "srv_info", "op": "UPDATE", "usr_id": 9, "pv": 5})
+            _on_change({"table": "usr_info", "op": "DELETE", "usr_id": 9})
+        self.assertEqual((self.versions.get(7), self.versions.get(8), self.versions.get(9)), (3, 2, None))
+
+
+class ServiceScopeTests(SigningKeyMixin, SimpleTestCase):
+    def test_bitset_round_trip(self):
+        bitset = encode_service_bitset([0, 3, 9, 64])
+        self.assertEqual([n for n in range(80) if bitset_has_service(bitset, n)], [0, 3, 9, 64])
+        self.assertFalse(bitset_has_service(bitset, -1))
+        self.assertFalse(bitset_has_service(encode_service_bitset([]), 0))
+
+    def test_scopes_are_only_embedded_when_enabled(self):
+        with mock.patch("utils.jwt.TOKEN_EMBED_SCOPES", False):
+            payload = jwt.decode(create_token(7, "ana", 1, services=[3], perm_version=2),
+                                 options={"verify_signature": False})
+        self.assertNotIn("srv", payload)
+        with mock.patch("utils.jwt.TOKEN_EMBED_SCOPES", True):
+            payload = jwt.decode(create_token(7, "ana", 1, services=[3], perm_version=2),
+                                 options={"verify_signature": False})
+            self.assertNotIn("srv", jwt.decode(create_token(7, "ana", 1), options={"verify_signature": False}))
+        self.assertEqual(payload["pv"], 2)
+        self.assertTrue(bitset_has_service(payload["srv"], 3))
+
+
+class ChangeFeedTests(SimpleTestCase):
+    def setUp(self):
+        self.feed = ChangeFeed("auth_changes")
+        self.changes = mock.Mock()
+        self.resyncs = mock.Mock()
+        self.feed.subscribe(self.changes, self.resyncs)
+
+    def test_events_reach_every_handler(self):
+        failing = mock.Mock(side_effect=RuntimeError("boom"))
+        feed = ChangeFeed("auth_changes")
+        feed.subscribe(failing, mock.Mock())
+        feed.subscribe(self.changes, self.resyncs)
+        with mock.patch("builtins.print"):
+            feed.dispatch({"table": "usr_info", "op": "UPDATE", "usr_id": 3, "pv": 7})
+        self.changes.assert_called_once_with({"table": "usr_info", "op": "UPDATE", "usr_id": 3, "pv": 7})
+        self.resyncs.assert_not_called()
+
+    def test_resync_event_resyncs_instead_of_dispatching(self):
+        self.feed.dispatch({"resync": True})
+        self.changes.assert_not_called()
+        self.resyncs.assert_called_once_with()
+        self.assertEqual(self.feed.stats["resyncs"], 1)
+
+    def test_listener_dispatches_notifications_and_pings_when_quiet(self):
+        conn = mock.Mock()
+        conn.notifies = [mock.Mock(payload='{"table":"services_info","op":"DELETE","srv_id":5}'),
+                         mock.Mock(payload="not json")]
+
+        class Stop(Exception):
+            pass
+        with mock.patch("utils.change_feed.select.select", side_effect=[([conn], [], []), ([], [], []), Stop]):
+            with self.assertRaises(Stop):
+                self.feed._listen(conn)
+        self.changes.assert_called_once_with({"table": "services_info", "op": "DELETE", "srv_id": 5})
+        self.assertEqual(self.feed.stats["received"], 2)
+        conn.cursor.return_value.execute.assert_called_once_with("SELECT 1")
+
+    def test_oversized_bulk_event_becomes_a_resync(self):
+        cur = mock.Mock()
+        publish(cur, {"table": "usr_info", "op": "BULK", "users": [[3, 7]]})
+        self.assertEqual(json.loads(cur.execute.call_args[0][1][1]),
+                         {"table": "usr_info", "op": "BULK", "users": [[3, 7]]})
+        users = [[user_id, 1] for user_id in range(CHANGE_FEED_MAX_PAYLOAD)]
+        publish(cur, {"table": "usr_info", "op": "BULK", "users": users})
+        self.assertEqual(cur.execute.call_args[0][1], ("auth_changes", '{"resync": true}'))
+
+    def test_suppression_is_scoped_to_the_transaction(self):
+        cur = mock.Mock()
+        suppress_row_notifications(cur)
+        cur.execute.assert_called_once_with("SET LOCAL serviceauth.bulk_change = 'on'")
+
+    def test_decision_cache_follows_the_events(self):
+        decisions = DecisionCache(100, 60, 60)
+        for user_id, srv in ((3, "1"), (4, "1"), (5, "2")):
+            decisions.set((b"token%d" % user_id, srv), 200, {}, user_id=user_id)
+        with mock.patch("utils.auth_cache.decision_cache", decisions):
+            auth_cache._on_change({"table": "usr_info", "op": "BULK", "users": [[3, 7]]})
+            self.assertIsNone(decisions.get((b"token3", "1")))
+            self.assertIsNotNone(decisions.get((b"token4", "1")))
+            auth_cache._on_change({"table": "services_info", "op": "DELETE", "srv_id": 2})
+            self.assertIsNone(decisions.get((b"token5", "2")))
+            self.assertIsNotNone(decisions.get((b"token4", "1")))
+
+
+class FakeAsyncPool:
+    """asyncpg pool whose connections answer the access lookup with allowed."""
+
+    def __init__(self, allowed=True, acquire_error=None):
+        self.allowed = allowed
+        self.acquire_error = acquire_error
+        self.acquire_kwargs = None
+        self.released = 0
+
+    async def acquire(self, **kwargs):
+        self.acquire_kwargs = kwargs
+        if self.acquire_error:
+            raise self.acquire_error
+        conn = mock.Mock()
+        conn.fetchrow = mock.AsyncMock(return_value=None if self.allowed is None else (self.allowed,))
+        return conn
+
+    async def release(self, conn):
+        self.released += 1
+
+
+class FastValidateTests(SigningKeyMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        decision_cache.clear()
+        self.addCleanup(decision_cache.clear)
+        for patcher in (
+            mock.patch.multiple(permission_versions, _versions={7: 2}, _loaded=True, _thread=mock.Mock()),
+            mock.patch.object(revocation_list, "_state", _State(BloomFilter(100, 0.01), set(), {})),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.django_app = mock.AsyncMock()
+        self.app = FastValidateApp(self.django_app)
+
+    def call(self, token=None, service_id=None, method="GET", path=VALIDATE_PATH):
+        headers = []
+        if token:
+            headers.append((b"authorization", f"Bearer {token}".encode()))
+        if service_id:
+            headers.append((b"x-service-id", service_id.encode()))
+        scope = {"type": "http", "path": path, "method": method, "headers": headers}
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        asyncio.run(self.app(scope, mock.AsyncMock(), send))
+        if not sent:
+            return None
+        return sent[0]["status"], dict(sent[0]["headers"]), json.loads(sent[1]["body"] or "null")
+
+    def test_missing_token_is_401(self):
+        status_code, headers, body = self.call()
+        self.assertEqual((status_code, body), (401, {"detail": "No token provided"}))
+        self.assertEqual(headers[b"cache-control"], b"no-store")
+
+    def test_allowed_with_identity_headers(self):
+        self.app.pool = FakeAsyncPool(allowed=True)
+        status_code, headers, body = self.call(create_token(7, "ana", 1), "3")
+        self.assertEqual((status_code, body), (200, {"user_id": 7, "user_name": "ana"}))
+        self.assertEqual(headers[b"x-auth-user-id"], b"7")
+        self.assertEqual(self.app.pool.released, 1)
+
+    def test_denied_by_the_access_lookup(self):
+        self.app.pool = FakeAsyncPool(allowed=False)
+        status_code, _, body = self.call(create_token(7, "ana", 1), "3")
+        self.assertEqual((status_code, body), (401, {"detail": "Access denied to this service"}))
+
+    def test_exhausted_pool_is_a_503_not_a_hang(self):
+        self.app.pool = FakeAsyncPool(acquire_error=asyncio.TimeoutError())
+        with mock.patch("users.fast_validate.ASYNC_DB_ACQUIRE_TIMEOUT", 0.5):
+            status_code, headers, _ = self.call(create_token(7, "ana", 1), "3")
+        self.assertEqual(status_code, 503)
+        self.assertEqual(self.app.pool.acquire_kwargs, {"timeout": 0.5})
+        self.assertEqual(headers[b"x-accel-expires"], b"0")
+
+    def test_head_has_no_body(self):
+        status_code, _, body = self.call(create_token(7, "ana", 1), method="HEAD")
+        self.assertEqual((status_code, body), (200, None))
+
+    def test_other_requests_go_to_django(self):
+        self.assertIsNone(self.call(path="/api/v1/users/login/"))
+        self.django_app.assert_awaited_once()
+
+
+class AdminCheckTests(SimpleTestCase):
+    def setUp(self):
+        self.request = mock.Mock(spec=["_request"])
+        self.request._request = mock.Mock(spec=[])
+        # The snapshot still says admin
+        patcher = mock.patch("utils.jwt.get_request_identity",
+                             return_value={"user_id": 7, "user_name": "ana", "is_admin": True})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def usr_admin(self, value):
+        conn = mock.Mock()
+        conn.cursor.return_value.fetchone.return_value = (value,) if value is not None else None
+        return mock.patch("utils.jwt.database.get_db_connection", return_value=conn)
+
+    def test_admin_flag_is_read_from_the_database(self):
+        with self.usr_admin(True) as get_db_connection:
+            self.assertTrue(get_admin_user_from_token(self.request)["is_admin"])
+            get_admin_user_from_token(self.request)
+        # Once per request
+        self.assertEqual(get_db_connection.call_count, 1)
+
+    def test_user_demoted_in_sql_is_refused(self):
+        with self.usr_admin(False):
+            with self.assertRaises(AuthenticationFailed):
+                get_admin_user_from_token(self.request)
+
+    def test_deleted_user_is_refused(self):
+        with self.usr_admin(None):
+            with self.assertRaises(AuthenticationFailed):
+                get_admin_user_from_token(self.request)
+
+
+class AccessListTests(SimpleTestCase):
+    def test_parse_access(self):
+        self.assertEqual(parse_access("7, 4,5,,4"), [4, 5, 7])
+        self.assertEqual(parse_access([3, "1"]), [1, 3])
+        self.assertEqual(parse_access(None), [])
+        self.assertEqual(parse_access(""), [])
+        for value in ("4,x", "-1", ["1.5"]):
+            with self.assertRaises(ValidationError):
+                parse_access(value)
+
+    def test_services_to_bitset(self):
+        self.assertEqual(services_to_bitset([]), b"")
+        self.assertEqual(services_to_bitset([0, 3]), bytes([0b1001]))
+        self.assertEqual(services_to_bitset([9]), bytes([0, 0b10]))
+
+
+class SnapshotFileTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "snapshot", "access.snapshot")
+        private_directory(self.path)
+
+    def test_write_read_round_trip(self):
+        write_snapshot(self.path, {
+            12: (3, True, services_to_bitset([1, 20])),
+            5: (0, False, services_to_bitset([])),
+            40: (7, False, services_to_bitset([2])),
+        }, generation=9)
+        snapshot = SnapshotFile(self.path)
+        self.assertEqual((snapshot.generation, snapshot.count), (9, 3))
+
+        entry = snapshot.lookup(12)
+        self.assertEqual((entry.user_id, entry.perm_version, entry.is_admin), (12, 3, True))
+        self.assertEqual(entry.service_ids(), [1, 20])
+        self.assertTrue(entry.has_service(20))
+        self.assertFalse(entry.has_service(2))
+        self.assertFalse(entry.has_service(1000))
+        self.assertEqual(snapshot.lookup(5).service_ids(), [])
+        self.assertEqual(snapshot.lookup(40).service_ids(), [2])
+        for user_id in (1, 6, 41):
+            self.assertIsNone(snapshot.lookup(user_id))
+
+    def test_rejects_other_files(self):
+        with open(self.path, "wb") as f:
+            f.write(b"not a snapshot at all, just some bytes")
+        with self.assertRaises(ValueError):
+            SnapshotFile(self.path)
+
+    def test_directory_writable_by_others_is_refused(self):
+        os.chmod(os.path.dirname(self.path), 0o777)
+        with self.assertRaises(PermissionError):
+            private_directory(self.path)
+
+
+class AccessSnapshotRebuildTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.snapshot = AccessSnapshot(os.path.join(directory.name, "access.snapshot"), 5, 0)
+        self.snapshot._started = True
+        self.queries = []
+
+    def rebuild(self, users):
+        """users: {usr_id: (usr_perm_version, usr_admin, service ids)}, as usr_info holds them."""
+        conn = mock.MagicMock()
+        cur = conn.cursor.return_value
+
+        def execute(query, values=None):
+            self.queries.append(query)
+            if values is None:
+                cur.fetchall.return_value = [(user_id, version, admin) for user_id, (version, admin, _) in users.items()]
+            else:
+                cur.fetchall.return_value = [(user_id, *users[user_id]) for user_id in values[0]]
+        cur.execute.side_effect = execute
+
+        @contextmanager
+        def db_connection():
+            yield conn
+
+        self.queries.clear()
+        with mock.patch("utils.access_snapshot.database.db_connection", db_connection):
+            return self.snapshot.rebuild()
+
+    def test_unchanged_users_are_not_re_read(self):
+        self.assertTrue(self.rebuild({1: (3, False, [2]), 2: (1, False, [])}))
+        self.assertFalse(self.rebuild({1: (3, False, [2]), 2: (1, False, [])}))
+        self.assertEqual(len(self.queries), 1)
+
+    def test_access_change_moves_the_version(self):
+        self.rebuild({1: (3, False, [2])})
+        self.assertTrue(self.rebuild({1: (4, False, [2, 5])}))
+        entry = self.snapshot.get(1)
+        self.assertEqual((entry.perm_version, entry.service_ids()), (4, [2, 5]))
+
+    def test_admin_demoted_in_sql_loses_the_flag(self):
+        self.rebuild({1: (3, True, [2])})
+        self.assertTrue(self.snapshot.get(1).is_admin)
+        # UPDATE usr_info SET usr_admin = false, on a database without the version trigger
+        self.assertTrue(self.rebuild({1: (3, False, [2])}))
+        self.assertFalse(self.snapshot.get(1).is_admin)
+
+    def test_deleted_users_are_dropped(self):
+        self.rebuild({1: (3, False, [2]), 2: (1, False, [])})
+        self.rebuild({1: (3, False, [2])})
+        self.assertIsNone(self.snapshot.get(2))
+
+
+class UserListingTests(SimpleTestCase):
+    def setUp(self):
+        self.conn = mock.Mock()
+        self.cur = self.conn.cursor.return_value
+        for patcher in (mock.patch("users.views.get_admin_user_from_token", return_value={"user_id": 1}),
+                        mock.patch("users.views.get_db_connection", return_value=self.conn)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def get(self, query):
+        request = APIRequestFactory().get("/api/v1/users/admin/users/?" + query)
+        return AdminAllUsersOperations.as_view()(request)
+
+    def rows(self, *ids):
+        return [(user_id, f"user{user_id}", False, "", None, "1") for user_id in ids]
+
+    def test_filters(self):
+        conditions, values = build_user_filters({"is_admin": "false", "service": "4", "created_from": "2026-01-01",
+                                                 "login_prefix": "An_a%"})
+        self.assertEqual(len(conditions), 4)
+        self.assertEqual(values[:2], [False, 4])
+        self.assertEqual(values[2], datetime(2026, 1, 1))
+        self.assertEqual(values[3], "an\\_a\\%%")
+        self.assertEqual(build_user_filters({}), ([], []))
+
+    def test_bad_params_are_rejected(self):
+        for params in ({"is_admin": "maybe"}, {"service": "x"}, {"service": ["1"]}, {"created_to": "yesterday"},
+                       {"limit": "0"}, {"after": "-1"}):
+            with self.subTest(params=params), self.assertRaises(ValidationError):
+                build_user_filters(params)
+                parse_page_params(params)
+        self.assertIs(bool_param({"stream": True}, "stream"), True)
+        self.assertEqual(parse_page_params({"limit": "5000"}), (1000, None))
+        self.assertEqual(self.get("service=abc").status_code, status.HTTP_400_BAD_REQUEST)
+        self.conn.cursor.assert_not_called()
+
+    def test_keyset_page(self):
+        self.cur.fetchall.return_value = self.rows(6, 9)
+        response = self.get("limit=2&after=5&is_admin=false")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        query, values = self.cur.execute.call_args[0]
+        self.assertIn("WHERE usr_admin = %s AND usr_id > %s ORDER BY usr_id LIMIT %s", query)
+        self.assertEqual(values, (False, 5, 2))
+        self.assertEqual([user["id"] for user in response.data["results"]], [6, 9])
+        self.assertEqual(response.data["next_after"], 9)
+
+    def test_last_page_has_no_next_and_count_ignores_the_keyset(self):
+        self.cur.fetchall.return_value = self.rows(12)
+        self.cur.fetchone.return_value = (7,)
+        response = self.get("limit=2&after=9&count=true&service=3")
+        self.assertIsNone(response.data["next_after"])
+        self.assertEqual(response.data["count"], 7)
+        count_query, count_values = self.cur.execute.call_args[0]
+        self.assertTrue(count_query.startswith("SELECT count(*) FROM usr_info WHERE EXISTS"))
+        self.assertEqual(count_values, (3,))
+
+    def test_no_paging_params_returns_the_plain_list(self):
+        self.cur.fetchall.return_value = self.rows(1, 2)
+        response = self.get("")
+        self.assertEqual([user["id"] for user in response.data], [1, 2])
+        self.assertEqual(self.cur.execute.call_args[0][1], ())
+
+
+EXPORTED_USERS = [
+    (1, "ana", True, "3,5", datetime(2026, 1, 2, tzinfo=timezone.utc), "1"),
+    (2, "bruno", False, "", None, "inf"),
+]
+
+
+class BulkUsersTests(SimpleTestCase):
+    def setUp(self):
+        self.conn = mock.Mock()
+        self.cur = self.conn.cursor.return_value
+        self.staged = []
+        self.cur.copy_expert.side_effect = self.copy_expert
+
+    def copy_expert(self, sql, file):
+        if "TO STDOUT" in sql:
+            # What COPY (...) TO STDOUT WITH (FORMAT csv, HEADER) writes, a few rows per chunk
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(["usr_id", "usr_login", "usr_admin", "access", "created_at", "jwt_expiration"])
+            file.write(buffer.getvalue())
+            for user_id, login, admin, access, created_at, expiration in EXPORTED_USERS:
+                buffer = io.StringIO()
+                csv.writer(buffer).writerow([user_id, login, "t" if admin else "f", access,
+                                             created_at.isoformat() if created_at else "", expiration])
+                file.write(buffer.getvalue())
+        else:
+            self.staged.extend(csv.reader(io.StringIO(file.read())))
+
+    def collect(self, stream):
+        async def run():
+            return [chunk async for chunk in stream]
+        return asyncio.run(run())
+
+    def upload(self, name, content):
+        request = APIRequestFactory().post("/api/v1/users/admin/users/import/",
+                                           {"file": SimpleUploadedFile(name, content)}, format="multipart")
+        return AdminBulkImportUsers.as_view()(request)
+
+    def test_rows_are_validated_like_a_single_create(self):
+        upload = SimpleUploadedFile("users.csv", b"user_name,user_pass,access,is_admin\n"
+                                                 b"Ana,abc12345,\"5,3\",yes\n"
+                                                 b"ana,abc12345,,\n"
+                                                 b"bo,short,,\n"
+                                                 b"cris,abc12345,x,\n")
+        valid, errors = validate_rows(read_rows(upload), validate_password)
+        self.assertEqual(valid, [(2, "ana", "abc12345", True, "{3,5}", None)])
+        self.assertEqual([(error["line"], error["user_name"]) for error in errors],
+                         [(3, "ana"), (4, "bo"), (5, "cris")])
+
+        upload = SimpleUploadedFile("users.jsonl", b'{"user_name": "ana", "user_pass": "abc12345", "jwt_expiration": "inf"}\n'
+                                                   b"\n[1]\n{oops\n")
+        valid, errors = validate_rows(read_rows(upload), validate_password)
+        self.assertEqual(valid, [(1, "ana", "abc12345", False, "{}", "inf")])
+        self.assertEqual([error["line"] for error in errors], [3, 4])
+
+    def test_staging_copy_round_trip(self):
+        rows = [(2, "ana", "scrypt$x", True, "{3,5}", None), (4, "o'brien, jr", "scrypt$y", False, "{}", "inf")]
+        self.cur.fetchall.return_value = [(10, "ana", 1)]
+        created, versions = import_users(self.cur, rows)
+        # Strings COPY parses back into the original values, NULL as an unquoted empty field
+        self.assertEqual(self.staged, [["2", "ana", "scrypt$x", "True", "{3,5}", ""],
+                                       ["4", "o'brien, jr", "scrypt$y", "False", "{}", "inf"]])
+        self.assertEqual(created, {2: 10})
+        self.assertEqual(versions, [(10, 1)])
+        statements = [call[0][0] for call in self.cur.execute.call_args_list]
+        self.assertEqual(statements[0], "SET LOCAL serviceauth.bulk_change = 'on'")
+        self.assertEqual(self.cur.execute.call_args[0][1], ("auth_changes", '{"table":"usr_info","op":"BULK","users":[[10,1]]}'))
+
+    def test_import_reports_existing_logins(self):
+        self.cur.fetchall.return_value = [(10, "ana", 1)]
+        with mock.patch("users.views.get_admin_user_from_token", return_value={"user_id": 1}), \
+                mock.patch("users.views.get_db_connection", return_value=self.conn), \
+                mock.patch("users.bulk.hash_passwords", lambda passwords: ["hash:" + p for p in passwords]), \
+                mock.patch("users.views.permission_versions") as versions, \
+                mock.patch("users.views.decision_cache"):
+            response = self.upload("users.csv", b"user_name,user_pass\nana,abc12345\nbruno,abc12345\nx,\n")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual((response.data["created"], response.data["failed"]), (1, 2))
+        self.assertEqual([error["line"] for error in response.data["errors"]], [3, 4])
+        self.assertEqual([row[2] for row in self.staged], ["hash:abc12345", "hash:abc12345"])
+        self.conn.commit.assert_called_once()
+        versions.update.assert_called_once_with([(10, 1)])
+
+    def test_csv_export_streams_every_chunk(self):
+        with mock.patch("users.bulk.get_db_connection", return_value=self.conn):
+            chunks = self.collect(stream_export_csv())
+        self.assertEqual(len(chunks), 3)
+        exported = list(csv.DictReader(io.StringIO(b"".join(chunks).decode())))
+        self.assertEqual([(row["usr_login"], row["usr_admin"], row["access"]) for row in exported],
+                         [("ana", "t", "3,5"), ("bruno", "f", "")])
+        self.conn.close.assert_called_once()
+
+    def test_failed_csv_export_ends_the_stream(self):
+        self.cur.copy_expert.side_effect = psycopg2.OperationalError("connection lost")
+        with mock.patch("users.bulk.get_db_connection", return_value=self.conn), mock.patch("builtins.print") as log:
+            self.assertEqual(self.collect(stream_export_csv()), [])
+        self.assertIn("connection lost", log.call_args[0][0])
+        self.conn.close.assert_called_once()
+
+    def test_jsonl_export_round_trips_through_the_importer(self):
+        async def stream_rows(name, query, values=(), batch_size=1000):
+            for row in EXPORTED_USERS:
+                yield [row]
+        with mock.patch("users.bulk.stream_rows", stream_rows):
+            exported = b"".join(self.collect(stream_export_jsonl()))
+        users = [json.loads(line) for line in exported.splitlines()]
+        self.assertEqual([user["username"] for user in users], ["ana", "bruno"])
+        self.assertEqual(users[0]["created_at"], "2026-01-02T00:00:00+00:00")
+
+        # Same users back in, with a password added to each line
+        lines = [json.dumps({"user_name": user["username"], "user_pass": "abc12345", "is_admin": user["is_admin"],
+                             "access": user["access"], "jwt_expiration": user["jwt_expiration"]}) for user in users]
+        valid, errors = validate_rows(read_rows(SimpleUploadedFile("users.jsonl", "\n".join(lines).encode())),
+                                      validate_password)
+        self.assertEqual(errors, [])
+        self.assertEqual([row[1:2] + row[3:] for row in valid],
+                         [("ana", True, "{3,5}", "1"), ("bruno", False, "{}", "inf")])
+
+
+class BulkAccessTests(SimpleTestCase):
+    def setUp(self):
+        self.conn = mock.Mock()
+        self.cur = self.conn.cursor.return_value
+        self.cur.fetchone.return_value = (3, 2, 1, [[7, 4], [8, 2]])
+        self.decisions = DecisionCache(100, 60, 60)
+        self.versions = mock.Mock()
+        for patcher in (mock.patch("users.views.get_admin_user_from_token", return_value={"user_id": 1}),
+                        mock.patch("users.views.get_db_connection", return_value=self.conn),
+                        mock.patch("users.views.decision_cache", self.decisions),
+                        mock.patch("users.views.permission_versions", self.versions)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def post(self, data):
+        request = APIRequestFactory().post("/api/v1/users/admin/access/", data, format="json")
+        return AdminBulkAccess.as_view()(request)
+
+    def test_change_for_a_user_list(self):
+        self.decisions.set((b"token7", "4"), 200, {}, user_id=7)
+        self.decisions.set((b"token9", "4"), 200, {}, user_id=9)
+        response = self.post({"user_ids": [7, "8", 9], "add": "4,5", "remove": "2"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual({key: response.data[key] for key in ("matched", "changed", "granted", "revoked")},
+                         {"matched": 3, "changed": 2, "granted": 2, "revoked": 1})
+
+        statements = self.cur.execute.call_args_list
+        self.assertEqual(statements[0][0][0], "SET LOCAL serviceauth.bulk_change = 'on'")
+        query, values = statements[1][0]
+        self.assertIn("SELECT usr_id FROM usr_info WHERE usr_id = ANY(%s)", query)
+        self.assertEqual(values, ([7, 8, 9], [2], [4, 5]))
+        self.assertEqual(json.loads(statements[2][0][1][1]), {"table": "usr_info", "op": "BULK", "users": [[7, 4], [8, 2]]})
+        self.conn.commit.assert_called_once()
+
+        self.versions.update.assert_called_once_with([(7, 4), (8, 2)])
+        self.assertIsNone(self.decisions.get((b"token7", "4")))
+        self.assertIsNotNone(self.decisions.get((b"token9", "4")))
+
+    def test_change_for_a_filter(self):
+        self.cur.fetchone.return_value = (5, 0, 0, [])
+        response = self.post({"filter": {"service": 3, "is_admin": False}, "remove": "3"})
+        self.assertEqual(response.data["changed"], 0)
+        query, values = self.cur.execute.call_args_list[1][0]
+        self.assertIn("WHERE usr_admin = %s AND EXISTS", query)
+        self.assertEqual(values, (False, 3, [3], []))
+        # Nothing changed, nothing to announce
+        self.assertEqual(self.cur.execute.call_count, 2)
+
+    def test_bad_requests_never_reach_the_database(self):
+        for data in ({"user_ids": [7]},
+                     {"user_ids": [7], "add": "4", "remove": "4"},
+                     {"add": "4"},
+                     {"user_ids": [7], "filter": {"service": 3}, "add": "4"},
+                     {"user_ids": [], "add": "4"},
+                     {"user_ids": ["x"], "add": "4"},
+                     {"filter": {}, "add": "4"},
+                     {"filter": "everyone", "add": "4"},
+                     {"user_ids": [7], "add": "4,x"}):
+            with self.subTest(data=data):
+                self.assertEqual(self.post(data).status_code, status.HTTP_400_BAD_REQUEST)
+        self.conn.cursor.assert_not_called()
+
+    def test_database_error_rolls_back(self):
+        self.cur.fetchone.side_effect = psycopg2.errors.SerializationFailure("could not serialize access")
+        response = self.post({"user_ids": [7], "add": "4"})
+        self.assertEqual(response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        self.conn.rollback.assert_called_once()
+        self.conn.commit.assert_not_called()
+        self.versions.update.assert_not_called()
+
+
+class GatewayCacheHeaderTests(SigningKeyMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        decision_cache.clear()
+        self.addCleanup(decision_cache.clear)
+        for patcher in (
+            mock.patch.multiple(permission_versions, _versions={7: 2}, _loaded=True, _thread=mock.Mock()),
+            mock.patch.object(revocation_list, "_state", _State(BloomFilter(100, 0.01), set(), {})),
+            mock.patch("utils.jwt.TOKEN_EMBED_SCOPES", True),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_allowed_decision_carries_the_identity(self):
+        token = create_token(7, "zé ana", 1, services=[3], perm_version=2)
+        headers = dict(TokenCheck(token, "3").headers())
+        self.assertEqual(headers["X-Accel-Expires"], str(VALIDATE_CACHE_TTL))
+        self.assertEqual(headers["Cache-Control"], f"private, max-age={VALIDATE_CACHE_TTL}")
+        self.assertEqual(headers["X-Auth-User-Id"], "7")
+        self.assertEqual(headers["X-Auth-User-Name"], "z%C3%A9%20ana")
+
+    def test_denials_have_no_identity(self):
+        token = create_token(7, "ana", 1, services=[3], perm_version=2)
+        headers = dict(TokenCheck(token, "4").headers())
+        self.assertEqual(headers["X-Accel-Expires"], str(VALIDATE_CACHE_TTL))
+        self.assertNotIn("X-Auth-User-Id", headers)
+        # Garbage is cached longer, it will never become valid
+        headers = dict(TokenCheck("not a token", "3").headers())
+        self.assertEqual(headers["X-Accel-Expires"], str(VALIDATE_NEGATIVE_CACHE_TTL))
+
+    def test_gateway_copy_never_outlives_the_token(self):
+        token = create_token(7, "ana", 5 / 86400, services=[3], perm_version=2)
+        check = TokenCheck(token, "3")
+        self.assertEqual(check.result[0], status.HTTP_200_OK)
+        self.assertLessEqual(check.max_age, 5)
+        # Same bound when the decision comes from the cache
+        self.assertLessEqual(TokenCheck(token, "3").max_age, 5)
+
+    def test_view_sends_the_headers(self):
+        factory = RequestFactory()
+        token = create_token(7, "ana", 1, services=[3], perm_version=2)
+        response = ValidateToken.as_view()(factory.get("/api/v1/users/validate/", HTTP_AUTHORIZATION=f"Bearer {token}",
+                                                       HTTP_X_SERVICE_ID="3"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["X-Auth-User-Id"], "7")
+        self.assertEqual(response["X-Accel-Expires"], str(VALIDATE_CACHE_TTL))
+
+        response = ValidateToken.as_view()(factory.get("/api/v1/users/validate/", HTTP_X_SERVICE_ID="3"))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual((response["Cache-Control"], response["X-Accel-Expires"]), ("no-store", "0"))
+
+
+class LoadTestHarnessTests(SimpleTestCase):
+    def setUp(self):
+        self.fixtures = mock.Mock(
+            sessions=[{"access_token": "a1", "refresh_token": "r1", "allowed": [1, 2], "denied": [3]}],
+            logins=["loadtest_9"], user_ids=[9], services=[1, 2, 3], admin_token="adm")
+
+    def test_requests_follow_the_seed(self):
+        requests = [loadtest.build_request(kind, self.fixtures, random.Random(5))
+                    for kind in ("validate", "validate_denied", "admin_write")]
+        self.assertEqual(requests, [loadtest.build_request(kind, self.fixtures, random.Random(5))
+                                    for kind in ("validate", "validate_denied", "admin_write")])
+        method, path, query, headers, body = requests[1]
+        self.assertEqual((method, path), ("GET", "/api/v1/users/validate"))
+        self.assertIn((b"x-service-id", b"3"), headers)
+        self.assertIn((b"authorization", b"Bearer a1"), headers)
+        method, path, query, headers, body = requests[2]
+        self.assertEqual((method, path), ("PUT", "/api/v1/users/admin/9/"))
+        self.assertEqual(len(json.loads(body)["access"]), 3)
+        with self.assertRaises(ValueError):
+            loadtest.build_request("delete_everything", self.fixtures, random.Random(5))
+
+    def test_call_returns_the_status(self):
+        async def app(scope, receive, send):
+            message = await receive()
+            self.assertEqual((scope["method"], scope["query_string"], message["body"]), ("POST", b"x=1", b"{}"))
+            await send({"type": "http.response.start", "status": 201, "headers": []})
+            await send({"type": "http.response.body", "body": b""})
+        self.assertEqual(asyncio.run(loadtest.call(app, "POST", "/p", "x=1", [], b"{}")), 201)
+
+    def test_summary_counts_unexpected_statuses_as_errors(self):
+        recorder = loadtest.Recorder()
+        recorder.record("login", 200, 1.0)
+        recorder.measuring = True
+        for latency, status_code in ((0.004, 200), (0.002, 200), (0.010, 429), (0.001, 200)):
+            recorder.record("login", status_code, latency)
+        recorder.record("validate_denied", 401, 0.001)
+        endpoints, throughput = loadtest.summarize(recorder, 2)
+        self.assertEqual(throughput, 2.5)
+        login = endpoints["login"]
+        self.assertEqual((login["requests"], login["errors"], login["status"]), (4, 1, {"200": 3, "429": 1}))
+        self.assertEqual((login["latency_ms"]["p50"], login["latency_ms"]["max"]), (2.0, 10.0))
+        self.assertEqual(endpoints["validate_denied"]["errors"], 0)
+        self.assertIsNone(loadtest.percentile([], 0.5))
+
+    def test_closed_loop_only_sends_the_mix(self):
+        seen = []
+
+        async def app(scope, receive, send):
+            seen.append(scope["path"])
+            await send({"type": "http.response.start", "status": 200, "headers": []})
+            await send({"type": "http.response.body", "body": b""})
+        recorder = loadtest.Recorder()
+        recorder.measuring = True
+        args = mock.Mock(seed=1, concurrency=2)
+        asyncio.run(loadtest.closed_loop(app, args, self.fixtures, ["validate", "refresh"], [1, 1], recorder,
+                                         time.perf_counter() + 0.05))
+        self.assertEqual(set(seen), {"/api/v1/users/validate", "/api/v1/users/refresh/"})
+        self.assertEqual(sum(len(samples) for samples in recorder.samples.values()), len(seen))
+
+
+class MetricsTests(SimpleTestCase):
+    def sample(self, name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_decisions_by_reason_and_service(self):
+        deny = {"decision": "deny", "reason": "expired", "service": "3"}
+        allow = {"decision": "allow", "reason": "ok", "service": "other"}
+        before = (self.sample("auth_validate_decisions_total", **deny), self.sample("auth_validate_decisions_total", **allow))
+        record_decision(401, {"detail": "Token expired"}, "3")
+        record_decision(200, {"user_id": 7}, "99999")
+        after = (self.sample("auth_validate_decisions_total", **deny), self.sample("auth_validate_decisions_total", **allow))
+        self.assertEqual((after[0] - before[0], after[1] - before[1]), (1, 1))
+
+    def test_service_labels_stay_bounded(self):
+        self.assertEqual([service_label(value) for value in (None, " ", "007", "1001", "3; drop", "-1")],
+                         ["none", "none", "7", "other", "invalid", "invalid"])
+
+    def test_scrape_with_the_request_latency_by_route(self):
+        labels = {"endpoint": "metrics", "method": "GET", "status": "200"}
+        before = self.sample("http_request_duration_seconds_count", **labels)
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"auth_validate_decisions_total", response.content)
+        self.assertEqual(self.sample("http_request_duration_seconds_count", **labels) - before, 1)
+
+    def test_scrape_token(self):
+        with mock.patch("utils.metrics.METRICS_TOKEN", "s3cret"):
+            self.assertEqual(self.client.get("/metrics").status_code, 401)
+            self.assertEqual(self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer nope").status_code, 401)
+            self.assertEqual(self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer s3cret").status_code, 200)
+
+
+class QueryStatsTests(SimpleTestCase):
+    def serve(self, queries):
+        def view(request):
+            record_acquire(0.002)
+            for statement, duration, rows in queries:
+                record_query(statement, duration, rows)
+            self.seen = current_queries()
+            return HttpResponse()
+        return QueryStatsMiddleware(view)(RequestFactory().get("/api/v1/users/admin/"))
+
+    def test_slow_statements_are_logged_without_parameters(self):
+        with mock.patch("utils.query_stats.DB_SLOW_QUERY_MS", 100), mock.patch("builtins.print") as log:
+            record_query("SELECT usr_id\n   FROM usr_info WHERE usr_login = %s", 0.25, 1)
+            record_query("SELECT 1", 0.01, 1)
+        log.assert_called_once_with("Slow query (250.0 ms, 1 rows): SELECT usr_id FROM usr_info WHERE usr_login = %s")
+        self.assertIsNone(current_queries())
+
+    def test_request_totals_in_server_timing(self):
+        with mock.patch("builtins.print") as log:
+            response = self.serve([("SELECT 1", 0.001, 1), ("SELECT 2", 0.003, 4)])
+        log.assert_not_called()
+        self.assertEqual((self.seen.count, self.seen.rows), (2, 5))
+        self.assertEqual(response["Server-Timing"], 'db;dur=4.00;desc="2 queries, 5 rows", db-acquire;dur=2.00')
+        self.assertIsNone(current_queries())
+
+    def test_over_budget_request_logs_its_statements(self):
+        before = REGISTRY.get_sample_value("db_query_budget_exceeded_total", {"endpoint": "unmatched"}) or 0
+        with mock.patch("utils.query_stats.DB_QUERY_BUDGET", 2), mock.patch("builtins.print") as log:
+            self.serve([(f"SELECT {n}", 0.001, 1) for n in range(3)])
+        message = log.call_args[0][0]
+        self.assertIn("GET /api/v1/users/admin/ made 3 queries (budget 2", message)
+        self.assertIn("SELECT 2", message)
+        self.assertEqual(REGISTRY.get_sample_value("db_query_budget_exceeded_total", {"endpoint": "unmatched"}) - before, 1)
+
+
+class BatchValidationTests(SigningKeyMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        decision_cache.clear()
+        self.addCleanup(decision_cache.clear)
+        self.conn = mock.Mock()
+        for patcher in (
+            mock.patch.multiple(permission_versions, _versions={7: 2}, _loaded=True, _thread=mock.Mock()),
+            mock.patch.object(revocation_list, "_state", _State(BloomFilter(100, 0.01), set(), {})),
+            mock.patch("users.validation.access_snapshot", mock.Mock(**{"get.return_value": None})),
+            mock.patch("utils.jwt.TOKEN_EMBED_SCOPES", True),
+            mock.patch("users.views.get_db_connection", return_value=self.conn),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.scoped = create_token(7, "ana", 1, services=[3], perm_version=2)
+        self.plain = create_token(8, "bia", 1)
+
+    def post(self, data):
+        request = APIRequestFactory().post("/api/v1/users/validate/batch", data, format="json")
+        return ValidateTokenBatch.as_view()(request)
+
+    def test_items_share_one_database_lookup(self):
+        with mock.patch("users.views.has_access_many", return_value={(8, 3): True, (8, 4): False}) as lookup:
+            response = self.post({"items": [{"token": self.scoped, "service_id": 3},
+                                             {"token": self.plain, "service_id": "3"},
+                                             {"token": self.plain, "service_id": 4},
+                                             {"token": "garbage", "service_id": 3},
+                                             {"token": self.scoped, "service_id": 4}]})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Cache-Control"], "no-store")
+        lookup.assert_called_once_with(self.conn.cursor.return_value, [(8, 3), (8, 4)])
+        results = response.data["results"]
+        self.assertEqual([(result["index"], result["status"]) for result in results],
+                         [(0, 200), (1, 200), (2, 401), (3, 401), (4, 401)])
+        self.assertEqual(results[1]["user_name"], "bia")
+        self.assertEqual(results[3]["detail"], "Invalid token")
+        self.assertEqual(results[0]["max_age"], VALIDATE_CACHE_TTL)
+
+    def test_every_token_against_every_service(self):
+        with mock.patch("users.validation.decode_token", wraps=decode_token) as decode:
+            response = self.post({"tokens": [self.scoped, "garbage"], "service_ids": [3, None]})
+        self.assertEqual(decode.call_count, 2)
+        self.assertEqual([(result["token_index"], result["service_id"], result["status"])
+                          for result in response.data["results"]],
+                         [(0, "3", 200), (0, None, 200), (1, "3", 401), (1, None, 401)])
+        self.conn.cursor.assert_not_called()
+
+    def test_bad_batches(self):
+        with mock.patch("users.views.VALIDATE_BATCH_MAX_ITEMS", 3):
+            for data in ({}, {"items": [], "tokens": []}, {"items": []}, {"items": ["token"]},
+                         {"items": [{"token": self.scoped, "service_id": 1.5}]},
+                         {"items": [{"token": "", "service_id": 3}]},
+                         {"tokens": [self.scoped], "service_ids": []},
+                         {"tokens": [self.scoped, self.plain], "service_ids": [1, 2]}):
+                with self.subTest(data=data):
+                    self.assertEqual(self.post(data).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_database_error(self):
+        self.conn.cursor.return_value.execute.side_effect = psycopg2.OperationalError("gone")
+        response = self.post({"items": [{"token": self.plain, "service_id": 3}]})
+        self.assertEqual(response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        self.conn.close.assert_called_once()
+
+
+# Cheap scrypt parameters, the tests are about the format not the cost
+@mock.patch.multiple("utils.passwords", PASSWORD_HASH_N=16, PASSWORD_HASH_R=1, PASSWORD_HASH_P=1)
+class PasswordHashTests(SimpleTestCase):
+    def test_round_trip(self):
+        stored = make_hash("s3cret")
+        self.assertTrue(stored.startswith("scrypt$16$1$1$"))
+        self.assertEqual(check_hash("s3cret", stored), (True, False))
+        self.assertEqual(check_hash("s3cret!", stored), (False, False))
+
+    def test_hashes_are_salted(self):
+        self.assertNotEqual(make_hash("s3cret"), make_hash("s3cret"))
+
+    def test_older_cost_parameters_need_a_rehash(self):
+        stored = make_hash("s3cret", n=32, r=1, p=1)
+        self.assertEqual(check_hash("s3cret", stored), (True, True))
+        self.assertEqual(check_hash("wrong1", stored), (False, True))
+
+    def test_legacy_plaintext_passwords(self):
+        self.assertEqual(check_hash("s3cret", "s3cret"), (True, True))
+        self.assertEqual(check_hash("s3cret", "other1"), (False, True))
+
+    def test_malformed_hash_never_matches(self):
+        for stored in ("scrypt$", "scrypt$16$1$1$salt", "scrypt$x$1$1$AAAA$AAAA", "scrypt$16$1$1$!!$!!"):
+            self.assertEqual(check_hash("s3cret", stored), (False, False))
+
+    def test_out_of_range_parameters_never_match(self):
+        # Not a power of two, zero r, and far past the memory limit
+        for params in ("15$1$1", "16$0$1", f"{2 ** 40}$8$1", f"{2 ** 70}$1$1"):
+            self.assertEqual(check_hash("s3cret", f"scrypt${params}$AAAAAAAA$AAAAAAAA"), (False, False))
+
+
+class HashingPoolTests(SimpleTestCase):
+    def test_bulk_work_leaves_half_the_workers_free(self):
+        pool = HashingPool(4, 0)
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def work(item):
+            with lock:
+                running.append(item)
+                peak.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.remove(item)
+            return item * 2
+
+        self.assertEqual(pool.map(work, list(range(9))), [item * 2 for item in range(9)])
+        self.assertEqual(max(peak), 2)
+
+    def test_bulk_work_gives_up_when_no_slot_frees(self):
+        pool = HashingPool(1, 0)
+        release = threading.Event()
+        pool._submit(release.wait)
+        self.addCleanup(release.set)
+        with mock.patch("utils.passwords.PASSWORD_HASH_TIMEOUT", 0.05):
+            with self.assertRaises(PasswordHashingBusy):
+                pool.map(str, [1, 2])
+            # Logins don't wait at all
+            with self.assertRaises(PasswordHashingBusy):
+                pool.run(str, 1)
+
+
+@mock.patch("utils.throttle.TRUSTED_PROXIES", [ipaddress.ip_network("172.28.0.1/32"), ipaddress.ip_network("10.1.0.0/16")])
+class ClientIpTests(SimpleTestCase):
+    def request(self, remote_addr, real_ip=None):
+        headers = {"HTTP_X_REAL_IP": real_ip} if real_ip else {}
+        return RequestFactory().post("/api/v1/users/login/", REMOTE_ADDR=remote_addr, **headers)
+
+    def test_trusted_proxy_passes_the_client_address(self):
+        self.assertEqual(client_ip(self.request("172.28.0.1", "203.0.113.9")), "203.0.113.9")
+        self.assertEqual(client_ip(self.request("10.1.4.2", "203.0.113.9")), "203.0.113.9")
+
+    def test_untrusted_peer_cannot_choose_its_address(self):
+        with mock.patch("builtins.print") as warn:
+            self.assertEqual(client_ip(self.request("198.51.100.7", "203.0.113.9")), "198.51.100.7")
+            client_ip(self.request("198.51.100.7", "203.0.113.10"))
+        # Loud, but once per peer
+        self.assertEqual(warn.call_count, 1)
+
+    def test_without_the_header_the_peer_counts(self):
+        self.assertEqual(client_ip(self.request("172.28.0.1")), "172.28.0.1")
+
+
+class MemoryThrottleTests(SimpleTestCase):
+    WINDOW = 60
+
+    def setUp(self):
+        self.backend = MemoryBackend(shards=4, max_keys=100)
+        for patcher in (
+            mock.patch("utils.throttle.LOGIN_LOCKOUT_BASE", 30),
+            mock.patch("utils.throttle.LOGIN_LOCKOUT_MAX", 3600),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def hit(self, now, key=("ip", "10.0.0.1"), limit=3):
+        return self.backend.hit(key, limit, self.WINDOW, now)
+
+    def test_attempts_under_the_limit_pass(self):
+        for second in range(3):
+            self.assertIsNone(self.hit(6000 + second))
+
+    def test_going_over_the_limit_locks_out(self):
+        for second in range(3):
+            self.hit(6000 + second)
+        self.assertEqual(self.hit(6003), 30)
+        # Still locked, counted from the lockout
+        self.assertEqual(self.hit(6013), 20)
+        # Other keys are not affected
+        self.assertIsNone(self.hit(6013, key=("ip", "10.0.0.2")))
+
+    def test_sliding_window_weights_the_previous_window(self):
+        # 3 attempts at the end of one window
+        for second in range(3):
+            self.hit(6057 + second)
+        # Half way into the next one they still count for about half: 1.5 + 0, 1.45 + 1, then 1.4 + 2
+        self.assertIsNone(self.hit(6090))
+        self.assertIsNone(self.hit(6091))
+        self.assertEqual(self.hit(6092), 30)
+
+    def test_old_windows_are_forgotten(self):
+        for second in range(3):
+            self.hit(6000 + second)
+        self.assertIsNone(self.hit(6000 + 2 * self.WINDOW))
+
+    def test_repeat_offences_double_the_lockout(self):
+        now = 6000
+        for expected in (30, 60, 120):
+            for _ in range(3):
+                self.hit(now)
+            self.assertEqual(self.hit(now), expected)
+            now += expected + 2 * self.WINDOW
+
+    def test_reset_clears_the_key(self):
+        for second in range(3):
+            self.hit(6000 + second)
+        self.backend.reset(("ip", "10.0.0.1"))
+        self.assertIsNone(self.hit(6003))
+
+
+class FakeKeysCursor:
+    def __init__(self, rows, inf_users):
+        self.rows = rows
+        self.inf_users = inf_users
+
+    def execute(self, query, values=None):
+        pass
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchone(self):
+        # SELECT EXISTS (... jwt_expiration = 'inf')
+        return (self.inf_users,)
+
+    def close(self):
+        pass
+
+
+class FakeKeysConnection:
+    def __init__(self, rows, inf_users=False):
+        self.rows = rows
+        self.inf_users = inf_users
+
+    def cursor(self):
+        return FakeKeysCursor(self.rows, self.inf_users)
+
+    def commit(self):
+        pass
+
+
+@mock.patch.multiple("utils.signing_keys", JWT_SIGNING_ALG="EdDSA", JWT_KEY_RETAIN_DAYS=120, JWT_KEY_PASSPHRASE=b"test")
+class KeyRingTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        now = datetime.now(tz=timezone.utc)
+        with mock.patch("utils.signing_keys.JWT_KEY_PASSPHRASE", b"test"):
+            cls.rows = [
+                ("dropped", "EdDSA", generate_private_pem("EdDSA"), now - timedelta(days=300)),
+                ("retired", "EdDSA", generate_private_pem("EdDSA"), now - timedelta(days=200)),
+                ("current", "EdDSA", generate_private_pem("EdDSA"), now - timedelta(days=10)),
+                ("next", "EdDSA", generate_private_pem("EdDSA"), now + timedelta(hours=1)),
+            ]
+
+    def load(self, ring, rows=None, inf_users=False):
+        @contextmanager
+        def db_connection():
+            yield FakeKeysConnection(rows or self.rows, inf_users)
+
+        with mock.patch("utils.signing_keys.database.db_connection", db_connection), \
+                mock.patch.object(KeyRing, "_rotate_if_due"):
+            ring.reload()
+
+    def test_replaced_keys_verify_for_the_retention_window(self):
+        ring = KeyRing()
+        self.load(ring)
+        # "dropped" was replaced 200 days ago, "retired" 10 days ago
+        self.assertIsNone(ring._keys.get("dropped"))
+        self.assertEqual(ring.verification_key("retired").kid, "retired")
+        self.assertEqual([key["kid"] for key in ring.jwks()["keys"]], ["retired", "current", "next"])
+
+    def test_newest_activated_key_signs(self):
+        ring = KeyRing()
+        self.load(ring)
+        # "next" is published ahead but not active yet
+        self.assertEqual(ring.signing_key().kid, "current")
+
+    def test_started_ring_never_reloads_inline(self):
+        ring = KeyRing()
+        self.load(ring)
+        ring._started = True
+        with mock.patch.object(ring, "_load") as load:
+            self.assertIsNone(ring.verification_key("unknown"))
+            load.assert_not_called()
+        self.assertTrue(ring._wake.is_set())
+
+    def test_keys_are_kept_while_inf_tokens_can_exist(self):
+        ring = KeyRing()
+        self.load(ring, inf_users=True)
+        self.assertEqual(ring.verification_key("dropped").kid, "dropped")
+
+    def test_key_of_another_algorithm_doesnt_retire_the_signing_key(self):
+        now = datetime.now(tz=timezone.utc)
+        with mock.patch("utils.signing_keys.JWT_KEY_PASSPHRASE", b"test"):
+            rows = [
+                ("eddsa", "EdDSA", generate_private_pem("EdDSA"), now - timedelta(days=300)),
+                ("es256", "ES256", generate_private_pem("ES256"), now - timedelta(days=200)),
+            ]
+        ring = KeyRing()
+        self.load(ring, rows)
+        self.assertIsNone(ring._keys["eddsa"].retired_at)
+        self.assertEqual(ring.signing_key().kid, "eddsa")
+        # Switching JWT_SIGNING_ALG retires the EdDSA key once ES256 took over
+        with mock.patch("utils.signing_keys.JWT_SIGNING_ALG", "ES256"):
+            self.load(ring, rows)
+        self.assertIsNone(ring._keys.get("eddsa"))
+
+    def test_started_ring_never_creates_a_signing_key_inline(self):
+        ring = KeyRing()
+        self.load(ring)
+        ring._started = True
+        with mock.patch("utils.signing_keys.JWT_SIGNING_ALG", "ES256"), \
+                mock.patch.object(ring, "_load") as load:
+            with self.assertRaises(SigningKeysUnavailable):
+                ring.signing_key()
+            load.assert_not_called()
+        self.assertTrue(ring._wake.is_set())
+
+    def test_started_ring_without_keys_is_unavailable(self):
+        ring = KeyRing()
+        ring._started = True
+        with mock.patch.object(ring, "_load") as load:
+            with self.assertRaises(SigningKeysUnavailable):
+                ring.verification_key("current")
+            load.assert_not_called()
+
+
+class BloomFilterTests(SimpleTestCase):
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(1000, 0.01)
+        values = [f"jti-{n}" for n in range(1000)]
+        for value in values:
+            bloom.add(value)
+        self.assertTrue(all(value in bloom for value in values))
+
+    def test_false_positive_rate_is_about_the_configured_one(self):
+        bloom = BloomFilter(1000, 0.01)
+        for n in range(1000):
+            bloom.add(f"jti-{n}")
+        false_positives = sum(f"other-{n}" in bloom for n in range(10000))
+        self.assertLess(false_positives, 300)
+
+
+class RevocationListTests(SimpleTestCase):
+    def setUp(self):
+        self.revocations = RevocationList()
+        self.revocations._state = _State(BloomFilter(100, 0.01), set(), {})
+
+    def test_nothing_is_revoked_before_the_first_load(self):
+        self.assertFalse(RevocationList().is_revoked({"user_id": 1, "jti": "a", "iat": 1.0}))
+
+    def test_revoked_jti(self):
+        self.revocations.add_token("a")
+        self.assertTrue(self.revocations.is_revoked({"user_id": 1, "jti": "a", "iat": 1.0}))
+        self.assertFalse(self.revocations.is_revoked({"user_id": 1, "jti": "b", "iat": 1.0}))
+
+    def test_not_before_cut_off(self):
+        self.revocations.set_not_before("1", 1000.0)
+        self.assertTrue(self.revocations.is_revoked({"user_id": 1, "jti": "a", "iat": 999.999}))
+        self.assertFalse(self.revocations.is_revoked({"user_id": 1, "jti": "b", "iat": 1000.0}))
+        # Tokens from before iat existed are caught too, other users are not
+        self.assertTrue(self.revocations.is_revoked({"user_id": "1"}))
+        self.assertFalse(self.revocations.is_revoked({"user_id": 2, "jti": "c", "iat": 1.0}))
+
+    def test_not_before_can_be_lifted(self):
+        self.revocations.set_not_before(1, 1000.0)
+        self.revocations.set_not_before(1, None)
+        self.assertFalse(self.revocations.is_revoked({"user_id": 1, "iat": 1.0}))
+
+    def test_changes_during_a_reload_are_replayed(self):
+        revocations = RevocationList()
+
+        @contextmanager
+        def db_connection():
+            # Revocation committed after the reload's SELECT
+            revocations.add_token("late")
+            conn = mock.MagicMock()
+            conn.cursor.return_value.fetchall.return_value = []
+            yield conn
+
+        with mock.patch("utils.revocation.database.db_connection", db_connection):
+            revocations.reload()
+        self.assertTrue(revocations.is_revoked({"user_id": 1, "jti": "late", "iat": 1.0}))
+
+    def test_user_revocation_covers_tokens_from_hosts_running_ahead(self):
+        cur = mock.Mock()
+        with mock.patch("utils.revocation.REVOCATION_CLOCK_SKEW", 2), \
+                mock.patch("utils.revocation.time.time", return_value=1000.0):
+            not_before = revoke_user_tokens(cur, 1)
+        self.assertEqual(not_before, 1002.0)
+        self.assertEqual(cur.execute.call_args[0][1], (1002.0, 1))
+        self.revocations.set_not_before(1, not_before)
+        # Minted just before the change, on a host 1.5s ahead
+        self.assertTrue(self.revocations.is_revoked({"user_id": 1, "jti": "a", "iat": 1001.5}))
+        self.assertFalse(self.revocations.is_revoked({"user_id": 1, "jti": "b", "iat": 1002.0}))
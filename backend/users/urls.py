@@ -1,15 +1,20 @@
 from django.contrib import admin
 from django.urls import path,include
 
-from .views import UserRegister,UserLogin,ValidateToken,RefreshToken,UserLogout,AdminAllUsersOperations, AdminSingleUserOperations,AdminListAllServicesView
+from .views import UserRegister,UserLogin,ValidateToken,ValidateTokenBatch,RefreshToken,UserLogout,AdminAllUsersOperations, AdminSingleUserOperations,AdminListAllServicesView,AdminDatabasePoolStats,AdminBulkImportUsers,AdminBulkExportUsers,AdminBulkAccess
 
 urlpatterns = [
     #path('register/',UserRegister.as_view()),
     path('login/',UserLogin.as_view()),
     path('logout',UserLogout.as_view()),
     path('validate',ValidateToken.as_view()),
+    path('validate/batch',ValidateTokenBatch.as_view()),
     path('refresh/', RefreshToken.as_view()),
     path('admin/', AdminAllUsersOperations.as_view(), name='admin-users-list-create'),
+    path('admin/import/', AdminBulkImportUsers.as_view(), name='admin-users-import'),
+    path('admin/export/', AdminBulkExportUsers.as_view(), name='admin-users-export'),
+    path('admin/access/', AdminBulkAccess.as_view(), name='admin-users-access'),
     path('admin/<int:target_user_id>/', AdminSingleUserOperations.as_view(), name='admin-user-detail-operations'),
      path('admin/services/all/', AdminListAllServicesView.as_view(), name='admin-list-all-services'),
+    path('admin/db/pool/', AdminDatabasePoolStats.as_view(), name='admin-db-pool-stats'),
 ]
@@ -0,0 +1,199 @@
+from rest_framework import status
+
+from datetime import datetime,timezone
+from urllib.parse import quote
+import math
+import time
+import jwt
+import os
+
+from utils.jwt import decode_token,bitset_has_service,TokenRevoked
+from utils.permissions import permission_versions
+from utils.access_snapshot import access_snapshot
+from utils.auth_cache import decision_cache,token_digest
+from utils.access import parse_service_id
+
+# How long nginx may reuse a decision (X-Accel-Expires), also the longest an
+# admin change can take to reach requests answered from the gateway cache
+VALIDATE_CACHE_TTL = int(os.environ.get("VALIDATE_CACHE_TTL", 10))
+VALIDATE_NEGATIVE_CACHE_TTL = int(os.environ.get("VALIDATE_NEGATIVE_CACHE_TTL", 60))  # garbage/forged/expired tokens
+
+VALIDATE_BATCH_MAX_ITEMS = int(os.environ.get("VALIDATE_BATCH_MAX_ITEMS", 1000))   # (token, service) pairs per batch call
+
+# For responses that must never be reused (no token, database errors)
+NO_STORE_HEADERS = [("Cache-Control", "no-store"), ("X-Accel-Expires", "0")]
+
+
+def _decode(token, decoded):
+    # decoded: token -> payload or the decoding error, shared by a batch so
+    # a token checked against several services is only verified once
+    if decoded is None:
+        return decode_token(token)
+    if token not in decoded:
+        try:
+            decoded[token] = decode_token(token)
+        except jwt.InvalidTokenError as e:
+            decoded[token] = e
+    if isinstance(decoded[token], Exception):
+        raise decoded[token]
+    return decoded[token]
+
+
+class TokenCheck:
+    """
+    ValidateToken decision for one (token, X-Service-ID) pair, shared by the
+    DRF view and the ASGI fast path. Everything that doesn't need the database
+    happens in the constructor; when needs_access_check is True the caller
+    runs the access lookup (sync or async) and passes the answer to finish().
+    The final (status code, body) ends up in self.result and in the cache,
+    headers() has the gateway caching and identity headers that go with it.
+    """
+
+    def __init__(self, token, service_id, decoded=None):
+        self.cache_key = (token_digest(token), service_id)
+        self.result = None
+        self.payload = None
+        self.user_id = None
+        self.srv_id = None
+        self.expiration = None
+        self.max_age = 0
+
+        cached = decision_cache.get(self.cache_key)
+        if cached:
+            status_code, body, expires_in = cached
+            self.result = (status_code, body)
+            # The cached entry never outlives the token, neither does the gateway's copy
+            self.max_age = min(VALIDATE_CACHE_TTL, math.floor(expires_in))
+            return
+
+        try:
+            payload = _decode(token, decoded)
+            if(payload["expiration"] != "inf"):
+                self.expiration = datetime.fromisoformat(payload["expiration"])
+                if self.expiration < datetime.now(timezone.utc):
+                    self.deny("Token expired", negative=True)
+                    return
+            self.user_id = int(payload["user_id"])
+            payload["user_name"]
+        except jwt.ExpiredSignatureError:
+            self.deny("Token expired", negative=True)
+            return
+        except TokenRevoked:
+            # Revocation is final, cache it like a bad token
+            self.deny("Token revoked", negative=True)
+            return
+        except (jwt.InvalidTokenError, KeyError, ValueError, TypeError):
+            # Garbage, forged or malformed payloads, cached so floods stay cheap
+            self.deny("Invalid token", negative=True)
+            return
+
+        self.payload = payload
+        if service_id:
+            self.srv_id = parse_service_id(service_id)
+            if self.srv_id is None:
+                self.deny("Access denied to this service")
+                return
+            if "srv" in payload and "pv" in payload and permission_versions.loaded:
+                self.check_scopes()
+            if self.result is None:
+                self.check_snapshot()
+        else:
+            self.allow()
+
+    def check_scopes(self):
+        # Stateless path, the token carries its services and the permission
+        # version they were issued at. Anything newer than this worker's
+        # version table (new user, or an admin change seen by another worker
+        # first) is left to the database lookup.
+        token_version = self.payload["pv"]
+        if not isinstance(token_version, int):
+            self.deny("Invalid token", negative=True)
+            return
+        current = permission_versions.get(self.user_id)
+        if current is None or token_version > current:
+            return
+        if token_version < current:
+            self.deny("Token permissions outdated, login again")
+        else:
+            try:
+                self.finish(bitset_has_service(self.payload["srv"], self.srv_id))
+            except (ValueError, TypeError):
+                self.deny("Invalid token")
+
+    def check_snapshot(self):
+        # Shared access snapshot, only trusted when it agrees with this
+        # worker's permission version (so not before the versions are
+        # loaded, nor for users it has but which were deleted since)
+        entry = access_snapshot.get(self.user_id)
+        if entry is None:
+            return
+        if permission_versions.get(self.user_id) != entry.perm_version:
+            return
+        self.finish(entry.has_service(self.srv_id))
+
+    @property
+    def needs_access_check(self):
+        return self.result is None
+
+    def finish(self, allowed):
+        """allowed is what utils.access.has_access returned."""
+        if allowed is None:
+            self.deny("User not found")
+        elif not allowed:
+            self.deny("Access denied to this service")
+        else:
+            self.allow()
+
+    def _set_max_age(self, ttl, negative):
+        if self.expiration is not None and not negative:
+            ttl = min(ttl, math.floor(self.expiration.timestamp() - time.time()))
+        self.max_age = max(ttl, 0)
+
+    def allow(self):
+        body = {"user_id": self.payload["user_id"],
+                "user_name": self.payload["user_name"]}
+        self.result = (status.HTTP_200_OK, body)
+        self._set_max_age(VALIDATE_CACHE_TTL, False)
+        decision_cache.set(self.cache_key, status.HTTP_200_OK, body, self.user_id, self.expiration)
+
+    def deny(self, detail, negative=False):
+        body = {"detail": detail}
+        self.result = (status.HTTP_401_UNAUTHORIZED, body)
+        self._set_max_age(VALIDATE_NEGATIVE_CACHE_TTL if negative else VALIDATE_CACHE_TTL, negative)
+        decision_cache.set(self.cache_key, status.HTTP_401_UNAUTHORIZED, body,
+                           self.user_id, self.expiration, negative)
+
+    def headers(self):
+        """
+        X-Accel-Expires/Cache-Control for nginx's proxy_cache on /_auth (cache
+        key: token cookie + service id, see extra/api-gateway.conf) and, on
+        success, the identity for auth_request_set. The user name is
+        percent-encoded since header values are latin-1.
+        """
+        status_code, body = self.result
+        headers = [("X-Accel-Expires", str(self.max_age)),
+                   ("Cache-Control", f"private, max-age={self.max_age}" if self.max_age else "no-store")]
+        if status_code == status.HTTP_200_OK:
+            headers.append(("X-Auth-User-Id", str(body["user_id"])))
+            headers.append(("X-Auth-User-Name", quote(str(body["user_name"]), safe="@.-_+")))
+        return headers
+
+
+def check_many(pairs, lookup):
+    """
+    TokenCheck for every (token, service id) pair, in order. Repeated pairs
+    share a check, tokens are decoded once, and the pairs that need the
+    database go to lookup() together: it gets a list of (user id, service id)
+    and returns has_access_many()'s mapping.
+    """
+    decoded = {}
+    checks = {}
+    for pair in pairs:
+        if pair not in checks:
+            checks[pair] = TokenCheck(*pair, decoded=decoded)
+    pending = [check for check in checks.values() if check.needs_access_check]
+    if pending:
+        answers = lookup([(check.user_id, check.srv_id) for check in pending])
+        for check in pending:
+            check.finish(answers[(check.user_id, check.srv_id)])
+    return [checks[pair] for pair in pairs]
@@ -4,19 +4,34 @@ from rest_framework.response import Response
 from rest_framework.exceptions import ValidationError,APIException,AuthenticationFailed
 from rest_framework_simplejwt.authentication import JWTAuthentication
 from rest_framework.permissions import AllowAny
+from rest_framework.parsers import MultiPartParser,FormParser
 from rest_framework.authentication import get_authorization_header
 from rest_framework import status
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
+from django.http import StreamingHttpResponse
 
 from datetime import datetime,timedelta,timezone
 import jwt
 import psycopg2
+import json
+import csv
 import re
 
 from .serializers import SumInputSerializer
-from utils.jwt import create_token,decode_token,get_admin_user_from_token
-from utils.database import get_db_connection
+from utils.jwt import create_token,decode_token,get_admin_user_from_token,TokenRevoked
+from utils.database import get_db_connection,get_pool_stats,stream_rows
+from utils.auth_cache import decision_cache
+from utils.access import ACCESS_LIST_SQL,ACCESS_ARRAY_SQL,parse_access,has_access,has_access_many,set_user_access,change_access
+from utils.permissions import permission_versions,bump_permission_versions
+from utils.change_feed import suppress_row_notifications,publish
+from utils.passwords import PasswordHashingBusy,hash_password,verify_password
+from utils.throttle import login_throttle
+from utils.revocation import revocation_list,revoke_token,revoke_user_tokens
+from utils.metrics import record_decision
+from .validation import TokenCheck,NO_STORE_HEADERS,VALIDATE_BATCH_MAX_ITEMS,check_many
+from .bulk import read_rows,validate_rows,hash_row_passwords,import_users,stream_export_csv,stream_export_jsonl
+from .listing import USER_COLUMNS_SQL,USER_STREAM_BATCH_SIZE,build_user_filters,parse_page_params,user_row_to_dict,bool_param
 
 PASSWORD_REGEX = re.compile(r'^(?=.*[A-Za-z])(?=.*\d).+$')  # At least one letter and one number
 MIN_PASSWORD_LENGTH = 6
@@ -32,12 +47,29 @@ def validate_password(password):
     return True
 
 
+def upgrade_password_hash(user_id, stored, user_pass):
+    """Replaces a plaintext (or outdated) password after a successful login."""
+    try:
+        new_hash = hash_password(user_pass)
+    except PasswordHashingBusy:
+        return # Next login will try again
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        # Only if the password didn't change in the meantime
+        cur.execute("UPDATE usr_info SET usr_password = %s WHERE usr_id = %s AND usr_password = %s",
+                    (new_hash, user_id, stored))
+        conn.commit()
+    except psycopg2.Error as e:
+        conn.rollback()
+        print(f"Password rehash for user {user_id} failed: {e}")
+    finally:
+        cur.close()
+        conn.close()
+
+
 class UserRegister(APIView):
     def post(self, request):
-        conn = get_db_connection()
-        cur = conn.cursor()
-        conn.autocommit = False
-
         if not request.data.get('user_name'):
             raise ValidationError({"detail":"Missing 'user_name' field."})
         if not request.data.get('user_pass'):
@@ -49,6 +81,12 @@ class UserRegister(APIView):
         user_name = user_name.lower()
         user_pass = request.data.get('user_pass')
         jwt_expiration = request.data.get('jwt_expiration')
+        # Hashed before borrowing a connection, it takes a while
+        user_pass_hash = hash_password(user_pass)
+
+        conn = get_db_connection()
+        cur = conn.cursor()
+        conn.autocommit = False
 
         # --- credentials validation ---
         try:
@@ -60,7 +98,7 @@ class UserRegister(APIView):
             cur.execute("""
                 INSERT INTO usr_info (usr_login, usr_password, usr_access, usr_admin, created_at, jwt_expiration) 
                 VALUES (%s, %s, %s, %s, %s,%s)
-            """, (user_name, user_pass, "0", False, datetime.now(tz=timezone.utc),jwt_expiration))
+            """, (user_name, user_pass_hash, "0", False, datetime.now(tz=timezone.utc),jwt_expiration))
 
             conn.commit()
         except psycopg2.Error:
@@ -78,25 +116,25 @@ class UserLogin(APIView):
     permission_classes = [AllowAny]
 
     def post(self, request):
-        conn = get_db_connection()
-        cur = conn.cursor()
-
         if not request.data.get('user_name'):
             raise ValidationError({"detail":"Missing 'user_name' field."})
         if not request.data.get('user_pass'):
             raise ValidationError({"detail":"Missing 'user_pass' field."})
-        else:
-            validate_password(request.data.get('user_pass'))
 
         user_name = request.data.get('user_name')
         user_name = user_name.lower()
         user_pass = request.data.get('user_pass')
 
+        login_throttle.check(request, user_name) # 429 before any database work
+        validate_password(user_pass)
+
+        conn = get_db_connection()
+        cur = conn.cursor()
         try:
-            cur.execute("""
-                SELECT usr_id, usr_admin, jwt_expiration FROM usr_info 
-                WHERE usr_login = %s AND usr_password = %s
-            """, (user_name, user_pass,))
+            cur.execute(f"""
+                SELECT usr_id, usr_admin, jwt_expiration, usr_perm_version, {ACCESS_ARRAY_SQL}, usr_password FROM usr_info 
+                WHERE usr_login = %s
+            """, (user_name,))
             user = cur.fetchone()
             
         except psycopg2.Error:
@@ -105,10 +143,15 @@ class UserLogin(APIView):
             cur.close()
             conn.close()
 
-        if not user:
+        # Hashing runs on the password pool, no database connection held meanwhile
+        matches, needs_rehash = verify_password(user_pass, user[5] if user else None)
+        if not matches:
             raise ValidationError({"detail":"User not found or invalid credentials."})
+        if needs_rehash:
+            upgrade_password_hash(user[0], user[5], user_pass)
+        login_throttle.success(user_name)
 
-        access_token = create_token(user[0], user_name, "inf" if user[2]=="inf" else int(user[2]))
+        access_token = create_token(user[0], user_name, "inf" if user[2]=="inf" else int(user[2]), user[4], user[3])
         refresh_token = create_token(user[0], user_name, 90)
 
         resp = Response({
@@ -133,7 +176,64 @@ class UserLogin(APIView):
 
     
 class UserLogout(APIView):
+    """
+    Deletes the cookie and revokes the access token (cookie or Authorization
+    header) server side. POST can also revoke the refresh token
+    ({"refresh_token": ...}); ?all=true / {"all": true} revokes every token
+    the user holds, on every device.
+    """
+    # A revoked or expired token must still be able to log out
+    authentication_classes = []
+    permission_classes = [AllowAny]
+
     def get(self,request):
+        return self.logout(request, [], bool(bool_param(request.query_params, 'all')))
+
+    def post(self,request):
+        refresh_token = request.data.get('refresh_token')
+        everywhere = bool(bool_param(request.data, 'all') or bool_param(request.query_params, 'all'))
+        return self.logout(request, [refresh_token] if refresh_token else [], everywhere)
+
+    def logout(self, request, tokens, everywhere):
+        auth = get_authorization_header(request).decode()
+        if auth.startswith("Bearer ") and len(auth.split()) == 2:
+            tokens.append(auth.split()[1])
+        if request.COOKIES.get('token'):
+            tokens.append(request.COOKIES['token'])
+
+        payloads = []
+        for token in tokens:
+            try:
+                payloads.append(decode_token(token))
+            except jwt.InvalidTokenError:
+                continue  # expired, forged or already revoked: nothing left to revoke
+
+        if payloads:
+            revoked_users = set()
+            conn = get_db_connection()
+            cur = conn.cursor()
+            try:
+                for payload in payloads:
+                    revoke_token(cur, payload)
+                if everywhere:
+                    for user_id in {int(payload["user_id"]) for payload in payloads}:
+                        revoked_users.add((user_id, revoke_user_tokens(cur, user_id)))
+                conn.commit()
+            except psycopg2.Error:
+                conn.rollback()
+                raise APIException({"detail":'Database query error!'})
+            finally:
+                cur.close()
+                conn.close()
+
+            # This worker rejects them right away, the others when the change feed arrives
+            for payload in payloads:
+                if isinstance(payload.get("jti"), str):
+                    revocation_list.add_token(payload["jti"])
+                decision_cache.invalidate_user(payload["user_id"])
+            for user_id, not_before in revoked_users:
+                revocation_list.set_not_before(user_id, not_before)
+
         response = Response({'message': 'Logged out'})
         response.delete_cookie('token')  # This must match the cookie name you set
         return response
@@ -146,53 +246,98 @@ class ValidateToken(APIView):
     def get(self, request):
         auth = get_authorization_header(request).decode()
         service_id = request.headers.get("X-Service-ID")
-        print(auth,service_id)
-        if not auth.startswith("Bearer "):
+        if not auth.startswith("Bearer ") or len(auth.split()) != 2:
+            record_decision(status.HTTP_401_UNAUTHORIZED, {"detail": "No token provided"}, service_id)
             return Response({"detail": "No token provided"}, 
-                            status=status.HTTP_401_UNAUTHORIZED)
+                            status=status.HTTP_401_UNAUTHORIZED, headers=dict(NO_STORE_HEADERS))
 
         token = auth.split()[1]
-        try:
-            payload = decode_token(token)
-            print(payload)
-            if(payload["expiration"] != "inf"):
-                expiration = datetime.fromisoformat(payload["expiration"])
-                if expiration < datetime.now(timezone.utc):
-                    return Response({"detail":"Token expired"},status=status.HTTP_401_UNAUTHORIZED)
-                
-            user_id = payload["user_id"]
-
-            if service_id:
-                conn = get_db_connection()
-                cur = conn.cursor()
-                try:
-                    cur.execute("SELECT usr_access FROM usr_info WHERE usr_id = %s", (user_id,))
-                    result = cur.fetchone()
-                    if not result:
-                        return Response({"detail": "User not found"}, status=status.HTTP_401_UNAUTHORIZED)
-
-                    allowed_services = result[0].split(",")
-                    if service_id not in allowed_services:
-                        return Response({"detail": "Access denied to this service"},
-                                        status=status.HTTP_401_UNAUTHORIZED)
-                except psycopg2.Error:
-                    raise APIException({"detail":'Database query error!'})
-                finally:
-                    cur.close()
-                    conn.close()
-
-            return Response({"user_id": payload["user_id"],
-                             "user_name": payload["user_name"]},
-                            status=status.HTTP_200_OK)
-        except jwt.ExpiredSignatureError:
-            return Response({"detail":"Token expired"},
-                            status=status.HTTP_401_UNAUTHORIZED)
-        except jwt.InvalidTokenError:
-            return Response({"detail":"Invalid token"},
-                            status=status.HTTP_401_UNAUTHORIZED)
-        except Exception as e:
-            return Response({"detail": str(e)},
-                            status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        check = TokenCheck(token, service_id)
+        if check.needs_access_check:
+            conn = get_db_connection()
+            cur = conn.cursor()
+            try:
+                check.finish(has_access(cur, check.user_id, check.srv_id))
+            except psycopg2.Error:
+                record_decision(status.HTTP_500_INTERNAL_SERVER_ERROR, None, service_id)
+                raise APIException({"detail":'Database query error!'})
+            finally:
+                cur.close()
+                conn.close()
+
+        status_code, body = check.result
+        record_decision(status_code, body, service_id)
+        return Response(body, status=status_code, headers=dict(check.headers()))
+
+
+def _batch_service_id(value):
+    # Same shape as the X-Service-ID header value so the decision cache is shared
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValidationError({"detail":"Service ids must be integers, strings or null."})
+    return str(value)
+
+
+class ValidateTokenBatch(APIView):
+    """
+    ValidateToken for many (token, service) pairs in one call, for services
+    that re-check a lot of sessions at once. Body is either
+    {"items": [{"token": ..., "service_id": ...}, ...]} or
+    {"tokens": [...], "service_ids": [...]} for every token against every
+    service (token-major order). Each result has the ValidateToken status and
+    body plus how long it may be reused (max_age).
+    """
+    permission_classes = [AllowAny]
+    authentication_classes = []
+
+    def post(self, request):
+        data = request.data
+        items = data.get('items')
+        tokens = data.get('tokens')
+        if (items is None) == (tokens is None):
+            raise ValidationError({"detail":"Provide either 'items' or 'tokens'."})
+
+        if items is not None:
+            if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+                raise ValidationError({"detail":"'items' must be a list of objects."})
+            pairs = [(item.get('token'), _batch_service_id(item.get('service_id'))) for item in items]
+        else:
+            service_ids = data.get('service_ids', [None])
+            if not isinstance(tokens, list) or not isinstance(service_ids, list) or not service_ids:
+                raise ValidationError({"detail":"'tokens' and 'service_ids' must be lists."})
+            service_ids = [_batch_service_id(service_id) for service_id in service_ids]
+            pairs = [(token, service_id) for token in tokens for service_id in service_ids]
+
+        if not pairs:
+            raise ValidationError({"detail":"Nothing to validate."})
+        if len(pairs) > VALIDATE_BATCH_MAX_ITEMS:
+            raise ValidationError({"detail":f"At most {VALIDATE_BATCH_MAX_ITEMS} checks per request."})
+        if not all(isinstance(token, str) and token for token, _ in pairs):
+            raise ValidationError({"detail":"Every token must be a non-empty string."})
+
+        def lookup(access_pairs):
+            conn = get_db_connection()
+            cur = conn.cursor()
+            try:
+                return has_access_many(cur, access_pairs)
+            except psycopg2.Error:
+                raise APIException({"detail":'Database query error!'})
+            finally:
+                cur.close()
+                conn.close()
+
+        results = []
+        for index, ((token, service_id), check) in enumerate(zip(pairs, check_many(pairs, lookup))):
+            status_code, body = check.result
+            record_decision(status_code, body, service_id)
+            result = {"index": index, "service_id": service_id, "status": status_code, "max_age": check.max_age}
+            if tokens is not None:
+                result["token_index"] = index // len(service_ids)
+            result.update(body)
+            results.append(result)
+
+        return Response({"results": results}, status=status.HTTP_200_OK, headers=dict(NO_STORE_HEADERS))
             
             
 class RefreshToken(APIView):
@@ -212,8 +357,24 @@ class RefreshToken(APIView):
                 if expiration < datetime.now(timezone.utc):
                     return Response({"detail": "Refresh token expired"}, status=status.HTTP_401_UNAUTHORIZED)
 
-            # Issue a new access token
-            new_access_token = create_token(payload["user_id"],payload["user_name"],payload["expiration"])
+            # Issue a new access token with the user's current expiration and services
+            conn = get_db_connection()
+            cur = conn.cursor()
+            try:
+                cur.execute(f"SELECT jwt_expiration, usr_perm_version, {ACCESS_ARRAY_SQL} FROM usr_info WHERE usr_id = %s",
+                            (payload["user_id"],))
+                user = cur.fetchone()
+            except psycopg2.Error:
+                raise APIException({"detail":'Database query error!'})
+            finally:
+                cur.close()
+                conn.close()
+
+            if not user:
+                return Response({"detail": "User not found"}, status=status.HTTP_401_UNAUTHORIZED)
+
+            new_access_token = create_token(payload["user_id"],payload["user_name"],
+                                            "inf" if user[0]=="inf" else int(user[0]), user[2], user[1])
 
             return Response({
                 "access_token": f"Bearer {new_access_token}"
@@ -221,41 +382,85 @@ class RefreshToken(APIView):
 
         except jwt.ExpiredSignatureError:
             return Response({"detail": "Token expired"}, status=status.HTTP_401_UNAUTHORIZED)
+        except TokenRevoked:
+            return Response({"detail": "Token revoked"}, status=status.HTTP_401_UNAUTHORIZED)
         except jwt.InvalidTokenError:
             return Response({"detail": "Invalid token"}, status=status.HTTP_401_UNAUTHORIZED)
         except Exception as e:
             return Response({"detail": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+async def stream_users(where, values):
+    # Server-side cursor, rows go out in batches instead of one big fetchall()
+    opening = b"["
+    async for rows in stream_rows("admin_user_stream", f"SELECT {USER_COLUMNS_SQL} FROM usr_info {where} ORDER BY usr_id",
+                                  tuple(values), USER_STREAM_BATCH_SIZE):
+        yield opening + b",".join(json.dumps(user_row_to_dict(row)).encode() for row in rows)
+        opening = b","
+    yield b"[]" if opening == b"[" else b"]"
+
+
 class AdminAllUsersOperations(APIView):
     authentication_classes = []
     permission_classes = [AllowAny]
 
     def get(self, request):
+        """
+        Without limit/stream this is the whole table as a list, like the
+        dashboard expects. ?limit=N&after=<last id> pages through it by
+        usr_id (keyset), ?count=true adds the filtered total and ?stream=true
+        sends every matching row through a server-side cursor. Filters:
+        is_admin, service, created_from, created_to, login_prefix.
+        """
         admin_user = get_admin_user_from_token(request)
-        
+
+        params = request.query_params
+        conditions, values = build_user_filters(params)
+        limit, after = parse_page_params(params)
+
+        if params.get("stream", "").lower() in ("1", "true", "yes"):
+            if after is not None:
+                conditions.append("usr_id > %s")
+                values.append(after)
+            where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+            return StreamingHttpResponse(stream_users(where, values), content_type="application/json")
+
+        count_conditions, count_values = list(conditions), list(values)
+        if after is not None:
+            conditions.append("usr_id > %s")
+            values.append(after)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        query = f"SELECT {USER_COLUMNS_SQL} FROM usr_info {where} ORDER BY usr_id"
+        if limit is not None:
+            query += " LIMIT %s"
+            values.append(limit)
+
         conn = get_db_connection()
         cur = conn.cursor()
         try:
-            cur.execute("SELECT usr_id, usr_login, usr_admin, usr_access, created_at, jwt_expiration FROM usr_info ORDER BY usr_id")
-            users_data = cur.fetchall()
-            users_list = [
-                {
-                    "id": row[0], 
-                    "username": row[1], 
-                    "is_admin": row[2], 
-                    "access": row[3],
-                    "created_at": row[4].isoformat() if row[4] else None,
-                    "jwt_expiration": row[5]
-                } for row in users_data
-            ]
+            cur.execute(query, tuple(values))
+            users_list = [user_row_to_dict(row) for row in cur.fetchall()]
+
+            total = None
+            if params.get("count", "").lower() in ("1", "true", "yes"):
+                count_where = f"WHERE {' AND '.join(count_conditions)}" if count_conditions else ""
+                cur.execute(f"SELECT count(*) FROM usr_info {count_where}", tuple(count_values))
+                total = cur.fetchone()[0]
         except psycopg2.Error as e:
             raise APIException({"detail":f"Database query error: {e}"})
         finally:
             cur.close()
             conn.close()
-            
-        return Response(users_list, status=status.HTTP_200_OK)
+
+        if limit is None and total is None:
+            return Response(users_list, status=status.HTTP_200_OK)
+
+        page = {"results": users_list}
+        if limit is not None:
+            page["next_after"] = users_list[-1]["id"] if len(users_list) == limit else None
+        if total is not None:
+            page["count"] = total
+        return Response(page, status=status.HTTP_200_OK)
 
     def post(self, request):
         admin_user = get_admin_user_from_token(request) # Validate admin token
@@ -274,10 +479,10 @@ class AdminAllUsersOperations(APIView):
         
         
         validate_password(user_pass)
+        service_ids = parse_access(usr_access)
 
         user_name = user_name.lower()
-        # Note: use bcrypt in the future to not store plain text passwords
-        user_pass_processed = user_pass
+        user_pass_processed = hash_password(user_pass)
 
         conn = get_db_connection()
         cur = conn.cursor()
@@ -288,9 +493,9 @@ class AdminAllUsersOperations(APIView):
                 raise ValidationError({"detail":f"Username '{user_name}' already in use."})
 
             cur.execute("""
-                INSERT INTO usr_info (usr_login, usr_password, usr_admin, usr_access, created_at, jwt_expiration)
-                VALUES (%s, %s, %s, %s, %s, %s) RETURNING usr_id
-            """, (user_name, user_pass_processed, bool(is_admin), usr_access, datetime.now(tz=timezone.utc),jwt_expiration))
+                INSERT INTO usr_info (usr_login, usr_password, usr_admin, created_at, jwt_expiration)
+                VALUES (%s, %s, %s, %s, %s) RETURNING usr_id
+            """, (user_name, user_pass_processed, bool(is_admin), datetime.now(tz=timezone.utc),jwt_expiration))
             response = cur.fetchone()
             
             if(response and response[0]):
@@ -298,6 +503,7 @@ class AdminAllUsersOperations(APIView):
             else:
                 raise APIException({"detail":f"Error inserting values..."})
             
+            set_user_access(cur, new_user_id, service_ids)
             conn.commit()
             
         except psycopg2.Error as db_error:
@@ -312,10 +518,142 @@ class AdminAllUsersOperations(APIView):
             
         return Response({
                 "response": f"User '{user_name}' created successfully.",
-                "user": {"id": new_user_id, "username": user_name, "is_admin": bool(is_admin), "access": usr_access, "jwt_expiration":jwt_expiration}
+                "user": {"id": new_user_id, "username": user_name, "is_admin": bool(is_admin), "access": ",".join(map(str, service_ids)), "jwt_expiration":jwt_expiration}
             }, status=status.HTTP_201_CREATED)
 
 
+class AdminBulkImportUsers(APIView):
+    authentication_classes = []
+    permission_classes = [AllowAny]
+    parser_classes = [MultiPartParser, FormParser]
+
+    def post(self, request):
+        admin_user = get_admin_user_from_token(request) # Validate admin token
+
+        uploaded_file = request.FILES.get('file')
+        if not uploaded_file:
+            raise ValidationError({"detail":"Missing 'file' field."})
+
+        try:
+            valid_rows, errors = validate_rows(read_rows(uploaded_file), validate_password)
+        except (UnicodeDecodeError, csv.Error) as e:
+            raise ValidationError({"detail":f"Could not read the file: {e}"})
+
+        created = {}
+        if valid_rows:
+            valid_rows = hash_row_passwords(valid_rows)
+            conn = get_db_connection()
+            cur = conn.cursor()
+            try:
+                created, versions = import_users(cur, valid_rows)
+                conn.commit()
+            except psycopg2.Error as db_error:
+                conn.rollback()
+                raise APIException({"detail":f"Database error: {db_error}"})
+            finally:
+                cur.close()
+                conn.close()
+
+            decision_cache.invalidate_users(user_id for user_id, _ in versions)
+            permission_versions.update(versions)
+
+        for line, user_name, *_ in valid_rows:
+            if line not in created:
+                errors.append({"line": line, "user_name": user_name, "detail": f"Username '{user_name}' already in use."})
+        errors.sort(key=lambda error: error["line"])
+
+        return Response({
+            "response": f"{len(created)} users created.",
+            "created": len(created),
+            "failed": len(errors),
+            "errors": errors
+        }, status=status.HTTP_200_OK)
+
+
+class AdminBulkExportUsers(APIView):
+    authentication_classes = []
+    permission_classes = [AllowAny]
+
+    def get(self, request):
+        admin_user = get_admin_user_from_token(request) # Validate admin token
+
+        # ?export_format=, DRF already uses ?format= for content negotiation
+        export_format = request.query_params.get("export_format", "csv")
+        if export_format == "jsonl":
+            response = StreamingHttpResponse(stream_export_jsonl(), content_type="application/x-ndjson")
+        elif export_format == "csv":
+            response = StreamingHttpResponse(stream_export_csv(), content_type="text/csv")
+        else:
+            raise ValidationError({"detail":"'export_format' must be csv or jsonl."})
+        response["Content-Disposition"] = f'attachment; filename="users.{export_format}"'
+        return response
+
+
+class AdminBulkAccess(APIView):
+    authentication_classes = []
+    permission_classes = [AllowAny]
+
+    def post(self, request):
+        admin_user = get_admin_user_from_token(request) # Validate admin token
+
+        data = request.data
+        user_ids = data.get('user_ids')
+        user_filter = data.get('filter')
+        add = parse_access(data.get('add'))
+        remove = parse_access(data.get('remove'))
+
+        if not add and not remove:
+            raise ValidationError({"detail":"Nothing to do, 'add' and 'remove' are both empty."})
+        if set(add) & set(remove):
+            raise ValidationError({"detail":"A service can't be both added and removed."})
+
+        # Either an explicit list of users or the admin list filters, never "everyone" by accident
+        if (user_ids is None) == (user_filter is None):
+            raise ValidationError({"detail":"Provide either 'user_ids' or 'filter'."})
+        if user_ids is not None:
+            if not isinstance(user_ids, list) or not user_ids:
+                raise ValidationError({"detail":"'user_ids' must be a non-empty list."})
+            try:
+                user_ids = [int(user_id) for user_id in user_ids]
+            except (TypeError, ValueError):
+                raise ValidationError({"detail":"'user_ids' must contain integers."})
+            conditions, values = ["usr_id = ANY(%s)"], [user_ids]
+        else:
+            if not isinstance(user_filter, dict):
+                raise ValidationError({"detail":"'filter' must be an object."})
+            conditions, values = build_user_filters(user_filter)
+            if not conditions:
+                raise ValidationError({"detail":"'filter' must have at least one condition."})
+
+        conn = get_db_connection()
+        cur = conn.cursor()
+        try:
+            # One statement for the whole change and one notification for every worker,
+            # instead of a trigger notification per access row
+            suppress_row_notifications(cur)
+            matched, granted, revoked, versions = change_access(cur, conditions, values, add, remove)
+            if versions:
+                publish(cur, {"table": "usr_info", "op": "BULK", "users": versions})
+            conn.commit()
+        except psycopg2.Error as db_error:
+            conn.rollback()
+            raise APIException({"detail":f"Database error: {db_error}"})
+        finally:
+            cur.close()
+            conn.close()
+
+        decision_cache.invalidate_users(user_id for user_id, _ in versions)
+        permission_versions.update(versions)
+
+        return Response({
+            "response": f"Access updated for {len(versions)} users.",
+            "matched": matched,
+            "changed": len(versions),
+            "granted": granted,
+            "revoked": revoked
+        }, status=status.HTTP_200_OK)
+
+
 class AdminSingleUserOperations(APIView):
     authentication_classes = []
     permission_classes = [AllowAny]
@@ -326,7 +664,7 @@ class AdminSingleUserOperations(APIView):
         conn = get_db_connection()
         cur = conn.cursor()
         try:
-            cur.execute("SELECT usr_id, usr_login, usr_admin, usr_access, created_at, jwt_expiration FROM usr_info WHERE usr_id = %s", (target_user_id,))
+            cur.execute(f"SELECT usr_id, usr_login, usr_admin, {ACCESS_LIST_SQL}, created_at, jwt_expiration FROM usr_info WHERE usr_id = %s", (target_user_id,))
             user_data = cur.fetchone()
             if not user_data:
                 return Response({"detail": "User not found."}, status=status.HTTP_404_NOT_FOUND)
@@ -354,6 +692,7 @@ class AdminSingleUserOperations(APIView):
         is_admin = data.get('is_admin',False)
         usr_access = data.get('access')
         jwt_expiration = data.get('jwt_expiration')
+        revoke_tokens = bool(bool_param(data, 'revoke_tokens'))
 
         update_fields = []
         update_values = []
@@ -364,7 +703,7 @@ class AdminSingleUserOperations(APIView):
             validate_password(user_pass)
             
             update_fields.append("usr_password = %s")
-            update_values.append(user_pass)
+            update_values.append(hash_password(user_pass))
 
         if is_admin is not None:
             # Prevent admin from de-admining themselves if they are the one making the request
@@ -374,15 +713,15 @@ class AdminSingleUserOperations(APIView):
             update_fields.append("usr_admin = %s")
             update_values.append(bool(is_admin))
 
+        service_ids = None
         if usr_access is not None:
-            update_fields.append("usr_access = %s")
-            update_values.append(usr_access)
+            service_ids = parse_access(usr_access)
             
         if jwt_expiration is not None:
             update_fields.append("jwt_expiration = %s")
             update_values.append(jwt_expiration)
         
-        if not update_fields:
+        if not update_fields and service_ids is None and not revoke_tokens:
             return Response({"detail": "No update data provided."}, status=status.HTTP_400_BAD_REQUEST)
 
         update_values.append(target_user_id) # For the WHERE clause
@@ -396,12 +735,24 @@ class AdminSingleUserOperations(APIView):
             if not cur.fetchone():
                 return Response({"detail": "User not found."}, status=status.HTTP_404_NOT_FOUND)
 
-            query = f"UPDATE usr_info SET {', '.join(update_fields)} WHERE usr_id = %s"
-            cur.execute(query, tuple(update_values))
+            if update_fields:
+                query = f"UPDATE usr_info SET {', '.join(update_fields)} WHERE usr_id = %s"
+                cur.execute(query, tuple(update_values))
+            if service_ids is not None:
+                set_user_access(cur, target_user_id, service_ids)
+            # A new password (or an explicit request) logs the user out everywhere
+            not_before = None
+            if user_pass is not None or revoke_tokens:
+                not_before = revoke_user_tokens(cur, target_user_id)
+            versions = bump_permission_versions(cur, [target_user_id])
             conn.commit()
+            decision_cache.invalidate_user(target_user_id)
+            permission_versions.update(versions)
+            if not_before is not None:
+                revocation_list.set_not_before(target_user_id, not_before)
 
             # Fetch updated user details to return
-            cur.execute("SELECT usr_id, usr_login, usr_admin, usr_access, jwt_expiration FROM usr_info WHERE usr_id = %s", (target_user_id,))
+            cur.execute(f"SELECT usr_id, usr_login, usr_admin, {ACCESS_LIST_SQL}, jwt_expiration FROM usr_info WHERE usr_id = %s", (target_user_id,))
             updated_user = cur.fetchone()
             
         except psycopg2.Error as db_error:
@@ -444,6 +795,8 @@ class AdminSingleUserOperations(APIView):
             if cur.rowcount == 0: # Making sure at least one row got affected
                 return Response({"detail": "User not found or already deleted."}, status=status.HTTP_404_NOT_FOUND)
             conn.commit()
+            decision_cache.invalidate_user(target_user_id)
+            permission_versions.remove(target_user_id)
         except psycopg2.Error as db_error:
             conn.rollback()
             raise APIException({"detail":f"Database error: {db_error}"})
@@ -480,4 +833,13 @@ class AdminListAllServicesView(APIView):
                 } for row in services_data
             ]
         
-        return Response(services_list, status=status.HTTP_200_OK)
\ No newline at end of file
+        return Response(services_list, status=status.HTTP_200_OK)
+
+
+class AdminDatabasePoolStats(APIView):
+    authentication_classes = []
+    permission_classes = [AllowAny]
+
+    def get(self, request):
+        admin_user = get_admin_user_from_token(request) # Validate admin token
+        return Response(get_pool_stats(), status=status.HTTP_200_OK)
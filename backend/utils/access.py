@@ -0,0 +1,136 @@
+from rest_framework.exceptions import ValidationError
+
+# Comma separated list of services a user can reach, same format the frontend
+# used to get from usr_info.usr_access. Needs usr_info in the FROM clause.
+ACCESS_LIST_SQL = """(SELECT string_agg(usa.srv_id::text, ',' ORDER BY usa.srv_id)
+                      FROM user_service_access usa WHERE usa.usr_id = usr_info.usr_id)"""
+
+# Same as ACCESS_LIST_SQL as an integer array
+ACCESS_ARRAY_SQL = """ARRAY(SELECT usa.srv_id FROM user_service_access usa
+                            WHERE usa.usr_id = usr_info.usr_id ORDER BY usa.srv_id)"""
+
+
+def parse_access(value):
+    """Turns "4,5,7" (or a list) into a sorted list of unique service ids."""
+    if value is None or value == "":
+        return []
+    items = value.split(",") if isinstance(value, str) else value
+    service_ids = set()
+    for item in items:
+        item = str(item).strip()
+        if not item:
+            continue
+        if not item.isdigit():
+            raise ValidationError({"detail": f"Invalid service id '{item}' in access list."})
+        service_ids.add(int(item))
+    return sorted(service_ids)
+
+
+def services_to_bitset(service_ids):
+    """Bit n set means access to srv_id n, used by tokens and the access snapshot."""
+    bits = 0
+    for service_id in service_ids:
+        bits |= 1 << int(service_id)
+    return bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+
+
+def parse_service_id(value):
+    """X-Service-ID header value as int, None when missing or not a number."""
+    if value is None:
+        return None
+    value = str(value).strip()
+    return int(value) if value.isdigit() else None
+
+
+def has_access(cur, user_id, service_id):
+    """
+    None when the user doesn't exist, otherwise whether it can reach the
+    service. Both lookups are primary key probes.
+    """
+    cur.execute("""
+        SELECT EXISTS (SELECT 1 FROM user_service_access
+                       WHERE usr_id = usr_info.usr_id AND srv_id = %s)
+        FROM usr_info WHERE usr_id = %s
+    """, (service_id, user_id))
+    row = cur.fetchone()
+    return None if row is None else row[0]
+
+
+def has_access_many(cur, pairs):
+    """
+    has_access for many (user id, service id) pairs in one statement, returns
+    {(user_id, service_id): None | bool}.
+    """
+    user_ids = sorted({user_id for user_id, _ in pairs})
+    service_ids = sorted({service_id for _, service_id in pairs})
+    cur.execute("""
+        SELECT u.usr_id, ARRAY(SELECT a.srv_id FROM user_service_access a
+                               WHERE a.usr_id = u.usr_id AND a.srv_id = ANY(%s))
+        FROM usr_info u WHERE u.usr_id = ANY(%s)
+    """, (service_ids, user_ids))
+    granted = {usr_id: set(srv_ids) for usr_id, srv_ids in cur.fetchall()}
+    return {(user_id, service_id): None if user_id not in granted else service_id in granted[user_id]
+            for user_id, service_id in pairs}
+
+
+async def has_access_async(conn, user_id, service_id):
+    """has_access for an asyncpg connection."""
+    row = await conn.fetchrow("""
+        SELECT EXISTS (SELECT 1 FROM user_service_access
+                       WHERE usr_id = usr_info.usr_id AND srv_id = $1)
+        FROM usr_info WHERE usr_id = $2
+    """, service_id, user_id)
+    return None if row is None else row[0]
+
+
+def set_user_access(cur, user_id, service_ids):
+    """Replaces the user's access with service_ids, unknown services are ignored."""
+    cur.execute("DELETE FROM user_service_access WHERE usr_id = %s AND NOT (srv_id = ANY(%s))",
+                (user_id, list(service_ids)))
+    cur.execute("""
+        INSERT INTO user_service_access (usr_id, srv_id)
+        SELECT %s, si.srv_id FROM services_info si WHERE si.srv_id = ANY(%s)
+        ON CONFLICT DO NOTHING
+    """, (user_id, list(service_ids)))
+
+
+def grant_access(cur, user_id, service_id):
+    cur.execute("""
+        INSERT INTO user_service_access (usr_id, srv_id) VALUES (%s, %s)
+        ON CONFLICT DO NOTHING
+    """, (user_id, service_id))
+
+
+def change_access(cur, user_conditions, user_values, add, remove):
+    """
+    Grants the services in add and revokes the ones in remove for every user
+    matching user_conditions (ANDed, usr_info in scope), set-wise in a single
+    statement inside the caller's transaction. Bumps usr_perm_version once per
+    user whose access actually changed.
+    Returns (users matched, rows granted, rows revoked, [(usr_id, version)]).
+    """
+    where = " AND ".join(user_conditions) if user_conditions else "TRUE"
+    cur.execute(f"""
+        WITH targets AS (
+            SELECT usr_id FROM usr_info WHERE {where}
+        ), revoked AS (
+            DELETE FROM user_service_access usa USING targets t
+            WHERE usa.usr_id = t.usr_id AND usa.srv_id = ANY(%s)
+            RETURNING usa.usr_id
+        ), granted AS (
+            INSERT INTO user_service_access (usr_id, srv_id)
+            SELECT t.usr_id, si.srv_id FROM targets t CROSS JOIN services_info si
+            WHERE si.srv_id = ANY(%s)
+            ON CONFLICT DO NOTHING
+            RETURNING usr_id
+        ), bumped AS (
+            UPDATE usr_info u SET usr_perm_version = u.usr_perm_version + 1
+            WHERE u.usr_id IN (SELECT usr_id FROM revoked UNION SELECT usr_id FROM granted)
+            RETURNING u.usr_id, u.usr_perm_version
+        )
+        SELECT (SELECT count(*) FROM targets), (SELECT count(*) FROM granted),
+               (SELECT count(*) FROM revoked),
+               (SELECT coalesce(json_agg(json_build_array(usr_id, usr_perm_version)), '[]') FROM bumped)
+    """, (*user_values, list(remove), list(add)))
+    matched, granted, revoked, versions = cur.fetchone()
+    return matched, granted, revoked, [tuple(row) for row in versions]
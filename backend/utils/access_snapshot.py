@@ -0,0 +1,281 @@
+"""
+Shared, memory-mapped snapshot of usr_info access rights.
+
+One worker (whoever holds the lock file) rebuilds the snapshot from Postgres
+and swaps it in with os.replace(); every worker maps the current file
+read-only and looks users up in place, so there is one copy of the data per
+host and a restarted worker can authorize from the last persisted snapshot
+before it talks to the database.
+
+File layout, little-endian:
+    header   magic "SQAS", format u16, pad u16, generation u64, built_at f64, count u32
+    records  count x (usr_id u32, perm_version u32, flags u8, pad 3, bits_offset u32, bits_len u32)
+             sorted by usr_id
+    bitsets  bit n of a user's bitset means access to srv_id n
+"""
+from utils import database
+from utils.access import ACCESS_ARRAY_SQL,services_to_bitset
+from utils.change_feed import change_feed
+from utils.metrics import record_cache
+
+import tempfile
+import threading
+import struct
+import stat
+import mmap
+import time
+import os
+
+try:
+    import fcntl
+except ImportError:  # Windows dev boxes, snapshot stays disabled
+    fcntl = None
+
+def default_snapshot_dir():
+    # Per user directory, created 0700 by start(). Never a bare file in the
+    # shared temp dir, anyone could plant a snapshot (admin flags included)
+    uid = os.getuid() if hasattr(os, "getuid") else "dev"
+    return os.path.join(tempfile.gettempdir(), f"serviceauth-{uid}")
+
+ACCESS_SNAPSHOT_ENABLED = os.environ.get("ACCESS_SNAPSHOT_ENABLED", "true").lower() in ("1", "true", "yes")
+ACCESS_SNAPSHOT_PATH = os.environ.get("ACCESS_SNAPSHOT_PATH",
+                                      os.path.join(default_snapshot_dir(), "access.snapshot"))
+ACCESS_SNAPSHOT_REBUILD_INTERVAL = float(os.environ.get("ACCESS_SNAPSHOT_REBUILD_INTERVAL", 5))
+ACCESS_SNAPSHOT_CHECK_INTERVAL = float(os.environ.get("ACCESS_SNAPSHOT_CHECK_INTERVAL", 1))
+
+MAGIC = b"SQAS"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<4sHxxQdI")
+RECORD = struct.Struct("<IIB3xII")
+FLAG_ADMIN = 1
+
+
+class UserAccess:
+    __slots__ = ("user_id", "perm_version", "is_admin", "_view")
+
+    def __init__(self, user_id, perm_version, is_admin, view):
+        self.user_id = user_id
+        self.perm_version = perm_version
+        self.is_admin = is_admin
+        self._view = view
+
+    def has_service(self, service_id):
+        byte_index = service_id // 8
+        if service_id < 0 or byte_index >= len(self._view):
+            return False
+        return bool(self._view[byte_index] >> (service_id % 8) & 1)
+
+    def service_ids(self):
+        bits = int.from_bytes(self._view, "little")
+        return [service_id for service_id in range(bits.bit_length()) if bits >> service_id & 1]
+
+
+class SnapshotFile:
+    """Read-only view over one mapped snapshot file."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.stat = os.fstat(f.fileno())
+            if self.stat.st_uid != os.getuid():
+                raise ValueError(f"{path} is not owned by this user")
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+        magic, fmt, self.generation, self.built_at, self.count = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or fmt != FORMAT_VERSION:
+            raise ValueError(f"{path} is not an access snapshot")
+        if HEADER.size + self.count * RECORD.size > len(self._map):
+            raise ValueError(f"{path} is truncated")
+
+    def lookup(self, user_id):
+        # Binary search over the fixed size records, straight from the map
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            record = RECORD.unpack_from(self._map, HEADER.size + mid * RECORD.size)
+            if record[0] < user_id:
+                lo = mid + 1
+            elif record[0] > user_id:
+                hi = mid
+            else:
+                _, perm_version, flags, offset, length = record
+                return UserAccess(user_id, perm_version, bool(flags & FLAG_ADMIN),
+                                  self._view[offset:offset + length])
+        return None
+
+
+def write_snapshot(path, users, generation):
+    """users: {usr_id: (perm_version, is_admin, bitset bytes)}. Atomic swap."""
+    user_ids = sorted(users)
+    offset = HEADER.size + len(user_ids) * RECORD.size
+    records = []
+    bitsets = []
+    for user_id in user_ids:
+        perm_version, is_admin, bits = users[user_id]
+        records.append(RECORD.pack(user_id, perm_version, FLAG_ADMIN if is_admin else 0, offset, len(bits)))
+        bitsets.append(bits)
+        offset += len(bits)
+
+    directory = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(prefix=".access-", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(HEADER.pack(MAGIC, FORMAT_VERSION, generation, time.time(), len(user_ids)))
+            f.write(b"".join(records))
+            f.write(b"".join(bitsets))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def private_directory(path):
+    """Creates the directory of path (0700) and checks nobody else can write into it."""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, 0o700, exist_ok=True)
+    st = os.lstat(directory)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o022:
+        raise PermissionError(f"{directory} must be a directory of this user that others can't write to")
+
+
+class AccessSnapshot:
+    def __init__(self, path, rebuild_interval, check_interval):
+        self.path = path
+        self.rebuild_interval = rebuild_interval
+        self.check_interval = check_interval
+        self._file = None
+        self._lock = threading.Lock()
+        self._started = False
+        self._lock_fd = None
+        # Builder state, only used by the process holding the lock
+        self._users = {}
+        self._generation = 0
+        self._wake = threading.Event()
+
+    def start(self):
+        if not ACCESS_SNAPSHOT_ENABLED or fcntl is None or self._started:
+            return
+        try:
+            private_directory(self.path)
+        except OSError as e:
+            print(f"Access snapshot disabled: {e}")
+            return
+        self._started = True
+        self._reload()
+        threading.Thread(target=self._run, name="access-snapshot", daemon=True).start()
+
+    def _reload(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        current = self._file
+        if current is not None and (current.stat.st_ino, current.stat.st_mtime_ns) == (st.st_ino, st.st_mtime_ns):
+            return
+        try:
+            # Old maps are left to the GC, readers may still hold views into them
+            self._file = SnapshotFile(self.path)
+        except (OSError, ValueError) as e:
+            print(f"Access snapshot load failed: {e}")
+
+    def get(self, user_id):
+        """
+        UserAccess from the current snapshot, None when unavailable. Never
+        touches the file system (the ASGI validate path calls it on the event
+        loop), the background thread maps new snapshots.
+        """
+        if not self._started:
+            return None
+        current = self._file
+        entry = current.lookup(user_id) if current is not None else None
+        record_cache("access_snapshot", entry is not None)
+        return entry
+
+    def _try_become_builder(self):
+        if self._lock_fd is not None:
+            return True
+        fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        return True
+
+    def _run(self):
+        # Maps the snapshot another worker swapped in every check_interval,
+        # rebuilds it every rebuild_interval (or when woken) if this one builds
+        built_at = None
+        while True:
+            if built_at is None or time.monotonic() - built_at >= self.rebuild_interval:
+                built_at = time.monotonic()
+                try:
+                    if self._try_become_builder():
+                        self.rebuild()
+                except Exception as e:
+                    print(f"Access snapshot rebuild failed: {e}")
+            try:
+                with self._lock:
+                    self._reload()
+            except OSError as e:
+                print(f"Access snapshot check failed: {e}")
+            if self._wake.wait(self.check_interval):
+                self._wake.clear()
+                built_at = None
+
+    def wake(self):
+        # Rebuild now instead of at the next interval (no-op for non builders)
+        self._wake.set()
+
+    def rebuild(self):
+        """
+        Incremental: only users whose usr_perm_version or admin flag changed
+        since the last build get their access re-read. The admin flag is
+        compared too, a database without the usr_info_bump_version trigger
+        doesn't move the version when usr_admin is changed in SQL.
+        """
+        with database.db_connection() as conn:
+            cur = conn.cursor()
+            try:
+                cur.execute("SELECT usr_id, usr_perm_version, usr_admin FROM usr_info")
+                current = {user_id: (version, bool(is_admin)) for user_id, version, is_admin in cur.fetchall()}
+                changed = [user_id for user_id, state in current.items()
+                           if user_id not in self._users or self._users[user_id][:2] != state]
+                removed = [user_id for user_id in self._users if user_id not in current]
+                if not changed and not removed and self._generation:
+                    return False
+                if changed:
+                    cur.execute(f"SELECT usr_id, usr_perm_version, usr_admin, {ACCESS_ARRAY_SQL} FROM usr_info WHERE usr_id = ANY(%s)",
+                                (changed,))
+                    rows = cur.fetchall()
+                else:
+                    rows = []
+            finally:
+                cur.close()
+
+        for user_id in removed:
+            del self._users[user_id]
+        for user_id, perm_version, is_admin, service_ids in rows:
+            self._users[user_id] = (perm_version, bool(is_admin), services_to_bitset(service_ids))
+
+        self._generation += 1
+        write_snapshot(self.path, self._users, self._generation)
+        with self._lock:
+            self._reload()
+        return True
+
+
+access_snapshot = AccessSnapshot(ACCESS_SNAPSHOT_PATH, ACCESS_SNAPSHOT_REBUILD_INTERVAL, ACCESS_SNAPSHOT_CHECK_INTERVAL)
+
+
+def _on_change(event):
+    # Token revocations and image renditions don't touch access rights
+    if event.get("table") not in ("revoked_tokens", "service_image_renditions"):
+        access_snapshot.wake()
+
+change_feed.subscribe(_on_change, access_snapshot.wake)
@@ -0,0 +1,136 @@
+from collections import OrderedDict
+import threading
+import hashlib
+import time
+import os
+
+from utils.change_feed import change_feed
+from utils.metrics import record_cache
+
+# Authorization decision cache, one per worker process
+AUTH_CACHE_MAX_ENTRIES = int(os.environ.get("AUTH_CACHE_MAX_ENTRIES", 50000))
+AUTH_CACHE_TTL = float(os.environ.get("AUTH_CACHE_TTL", 60))                    # seconds for allow/deny of a valid token
+AUTH_CACHE_NEGATIVE_TTL = float(os.environ.get("AUTH_CACHE_NEGATIVE_TTL", 300))  # seconds for garbage/forged/expired tokens
+
+
+def token_digest(token):
+    # Never keep raw tokens around as dict keys
+    return hashlib.sha256(token.encode()).digest()
+
+
+class DecisionCache:
+    """
+    LRU cache of (token digest, service id) -> (status code, response body),
+    get() also returns the seconds the entry has left.
+    Entries are indexed by user id so an admin change can drop every decision
+    made for that user. Keys and values have a fixed shape, so capping the
+    number of entries caps the memory used.
+    """
+
+    def __init__(self, max_entries, ttl, negative_ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()   # key -> (expires_at, user_id, status, body)
+        self._by_user = {}              # user_id -> set of keys
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def _unlink(self, key, user_id):
+        if user_id is None:
+            return
+        keys = self._by_user.get(user_id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_user[user_id]
+
+    def get(self, key):
+        now = time.monotonic()
+        result = None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, user_id, status_code, body = entry
+                if expires_at <= now:
+                    del self._entries[key]
+                    self._unlink(key, user_id)
+                else:
+                    self._entries.move_to_end(key)
+                    result = (status_code, body, expires_at - now)
+            self._stats["hits" if result is not None else "misses"] += 1
+        record_cache("decision", result is not None)
+        return result
+
+    def set(self, key, status_code, body, user_id=None, token_expiration=None, negative=False):
+        """
+        token_expiration is the token's own expiry as an aware datetime (None
+        for "inf" tokens), the entry never outlives it.
+        """
+        ttl = self.negative_ttl if negative else self.ttl
+        if token_expiration is not None:
+            ttl = min(ttl, token_expiration.timestamp() - time.time())
+        if ttl <= 0:
+            return
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._unlink(key, old[1])
+            self._entries[key] = (time.monotonic() + ttl, user_id, status_code, body)
+            if user_id is not None:
+                self._by_user.setdefault(user_id, set()).add(key)
+
+            while len(self._entries) > self.max_entries:
+                old_key, old = self._entries.popitem(last=False)
+                self._unlink(old_key, old[1])
+                self._stats["evictions"] += 1
+
+    def invalidate_user(self, user_id):
+        self.invalidate_users([user_id])
+
+    def invalidate_users(self, user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                keys = self._by_user.pop(int(user_id), None)
+                if not keys:
+                    continue
+                for key in keys:
+                    self._entries.pop(key, None)
+                self._stats["invalidations"] += len(keys)
+
+    def invalidate_service(self, service_id):
+        service_id = str(service_id)
+        with self._lock:
+            keys = [key for key in self._entries if (key[1] or "").strip() == service_id]
+            for key in keys:
+                _, user_id, _, _ = self._entries.pop(key)
+                self._unlink(key, user_id)
+            self._stats["invalidations"] += len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._stats["invalidations"] += len(self._entries)
+            self._entries.clear()
+            self._by_user.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+        stats["max_entries"] = self.max_entries
+        return stats
+
+
+decision_cache = DecisionCache(AUTH_CACHE_MAX_ENTRIES, AUTH_CACHE_TTL, AUTH_CACHE_NEGATIVE_TTL)
+
+
+def _on_change(event):
+    if event.get("users") is not None:
+        decision_cache.invalidate_users(user_id for user_id, _ in event["users"])
+    elif event.get("usr_id") is not None:
+        decision_cache.invalidate_user(event["usr_id"])
+    elif event.get("srv_id") is not None:
+        decision_cache.invalidate_service(event["srv_id"])
+
+change_feed.subscribe(_on_change, decision_cache.clear)
@@ -0,0 +1,136 @@
+"""
+Per-worker listener for the auth_changes channel (see the triggers in
+ddl.sql). Caches register a handler for change events and a resync callback
+that drops/reloads everything, the resync runs after every (re)connect since
+notifications sent while we weren't listening are lost.
+
+Events are dicts like {"table": "usr_info", "op": "UPDATE", "usr_id": 3, "pv": 7},
+{"table": "services_info", "op": "DELETE", "srv_id": 5} or
+{"table": "user_service_access", "op": "INSERT", "usr_id": 3, "srv_id": 5}.
+Bulk writes switch the row triggers off and publish() a single
+{"table": "usr_info", "op": "BULK", "users": [[3, 7], [4, 2]]} instead, or
+{"resync": true} when that doesn't fit in a notification.
+"""
+from utils import database
+
+import threading
+import select
+import json
+import time
+import os
+
+import psycopg2
+
+CHANGE_FEED_CHANNEL = "auth_changes"
+CHANGE_FEED_ENABLED = os.environ.get("CHANGE_FEED_ENABLED", "true").lower() in ("1", "true", "yes")
+CHANGE_FEED_PING_INTERVAL = float(os.environ.get("CHANGE_FEED_PING_INTERVAL", 30))  # seconds without traffic before checking the socket
+CHANGE_FEED_MAX_BACKOFF = float(os.environ.get("CHANGE_FEED_MAX_BACKOFF", 30))
+CHANGE_FEED_MAX_PAYLOAD = 7900  # NOTIFY payloads must stay under 8000 bytes
+
+
+class ChangeFeed:
+    def __init__(self, channel):
+        self.channel = channel
+        self._handlers = []
+        self._started = False
+        self._lock = threading.Lock()
+        self.stats = {"received": 0, "reconnects": 0, "resyncs": 0, "errors": 0}
+
+    def subscribe(self, on_change, on_resync):
+        self._handlers.append((on_change, on_resync))
+
+    def start(self):
+        with self._lock:
+            if not CHANGE_FEED_ENABLED or self._started:
+                return
+            self._started = True
+        threading.Thread(target=self._run, name="change-feed", daemon=True).start()
+
+    def _connect(self):
+        # Dedicated connection, LISTEN doesn't survive going back to the pool
+        conn = psycopg2.connect(
+            host=database.DB_HOST,
+            database=database.DB_NAME,
+            user=database.DB_USER,
+            password=database.DB_PASSWORD,
+            connect_timeout=database.DB_CONNECT_TIMEOUT,
+        )
+        conn.autocommit = True
+        cur = conn.cursor()
+        cur.execute(f"LISTEN {self.channel}")
+        cur.close()
+        return conn
+
+    def _run(self):
+        backoff = 1
+        while True:
+            conn = None
+            try:
+                conn = self._connect()
+                backoff = 1
+                self.resync()
+                self._listen(conn)
+            except Exception as e:
+                self.stats["errors"] += 1
+                print(f"Change feed error, reconnecting in {backoff}s: {e}")
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except psycopg2.Error:
+                        pass
+            time.sleep(backoff)
+            backoff = min(backoff * 2, CHANGE_FEED_MAX_BACKOFF)
+            self.stats["reconnects"] += 1
+
+    def _listen(self, conn):
+        while True:
+            readable, _, _ = select.select([conn], [], [], CHANGE_FEED_PING_INTERVAL)
+            if not readable:
+                # Quiet for a while, make sure the connection is still there
+                cur = conn.cursor()
+                cur.execute("SELECT 1")
+                cur.close()
+            conn.poll()
+            while conn.notifies:
+                notify = conn.notifies.pop(0)
+                self.stats["received"] += 1
+                try:
+                    event = json.loads(notify.payload)
+                except ValueError:
+                    continue
+                self.dispatch(event)
+
+    def dispatch(self, event):
+        if event.get("resync"):
+            self.resync()
+            return
+        for on_change, _ in self._handlers:
+            try:
+                on_change(event)
+            except Exception as e:
+                print(f"Change feed handler failed: {e}")
+
+    def resync(self):
+        self.stats["resyncs"] += 1
+        for _, on_resync in self._handlers:
+            try:
+                on_resync()
+            except Exception as e:
+                print(f"Change feed resync failed: {e}")
+
+
+change_feed = ChangeFeed(CHANGE_FEED_CHANNEL)
+
+
+def suppress_row_notifications(cur):
+    """Turns the per-row triggers off for the rest of the caller's transaction."""
+    cur.execute("SET LOCAL serviceauth.bulk_change = 'on'")
+
+
+def publish(cur, event):
+    """Sends an event to every worker when the caller's transaction commits."""
+    payload = json.dumps(event, separators=(",", ":"))
+    if len(payload) > CHANGE_FEED_MAX_PAYLOAD:
+        payload = json.dumps({"resync": True})
+    cur.execute("SELECT pg_notify(%s, %s)", (CHANGE_FEED_CHANNEL, payload))
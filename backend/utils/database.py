@@ -1,20 +1,428 @@
 from rest_framework.exceptions import APIException
+from rest_framework import status
+from psycopg2 import extensions
+from asgiref.sync import sync_to_async
 import psycopg2
 
+from contextlib import contextmanager
+from collections import deque
+import threading
+import time
+import os
+
+from utils.metrics import DB_ACQUIRE_TIME,DB_QUERY_TIME
+from utils.query_stats import record_query,record_acquire
+
 DB_HOST = '192.168.1.64'
 DB_NAME = 'auth_service'
 DB_USER = 'postgres'
 DB_PASSWORD = 'postgres'
 
+# Pool settings, one pool per worker process
+DB_POOL_MIN_SIZE = int(os.environ.get("DB_POOL_MIN_SIZE", 1))
+DB_POOL_MAX_SIZE = int(os.environ.get("DB_POOL_MAX_SIZE", 10))
+DB_POOL_ACQUIRE_TIMEOUT = float(os.environ.get("DB_POOL_ACQUIRE_TIMEOUT", 5))     # seconds waiting for a free connection
+DB_POOL_MAX_AGE = float(os.environ.get("DB_POOL_MAX_AGE", 30 * 60))               # seconds before a connection is recycled
+DB_POOL_CHECK_IDLE_AFTER = float(os.environ.get("DB_POOL_CHECK_IDLE_AFTER", 30))  # ping connections idle longer than this
+DB_CONNECT_TIMEOUT = int(os.environ.get("DB_CONNECT_TIMEOUT", 5))
+
+
+class DatabaseUnavailable(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = "Database unavailable, try again later."
+
+
+class TimedCursor(extensions.cursor):
+    """
+    Cursor class of pooled connections. Times every statement for the
+    db_query_seconds histogram and hands text, duration and row count to
+    utils.query_stats (slow query log, per-request summary).
+    """
+
+    def _timed(self, statement, run, *args):
+        started = time.perf_counter()
+        try:
+            return run(*args)
+        finally:
+            duration = time.perf_counter() - started
+            DB_QUERY_TIME.labels("psycopg2").observe(duration)
+            record_query(statement, duration, max(self.rowcount, 0))
+
+    def execute(self, query, vars=None):
+        return self._timed(query, super().execute, query, vars)
+
+    def executemany(self, query, vars_list):
+        return self._timed(query, super().executemany, query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        return self._timed(sql, super().copy_expert, sql, file, size)
+
+
+class PooledConnection:
+    """
+    Thin wrapper around a psycopg2 connection borrowed from the pool.
+    close() hands the connection back instead of closing the socket, so the
+    views can keep the usual conn.cursor() / conn.close() flow.
+    """
+
+    def __init__(self, pool, raw):
+        object.__setattr__(self, "_pool", pool)
+        object.__setattr__(self, "_raw", raw)
+
+    def __getattr__(self, name):
+        raw = object.__getattribute__(self, "_raw")
+        if raw is None:
+            raise psycopg2.InterfaceError("connection already returned to the pool")
+        return getattr(raw, name)
+
+    def __setattr__(self, name, value):
+        raw = object.__getattribute__(self, "_raw")
+        if raw is None:
+            raise psycopg2.InterfaceError("connection already returned to the pool")
+        setattr(raw, name, value)
+
+    @property
+    def raw(self):
+        return object.__getattribute__(self, "_raw")
+
+    def close(self):
+        # Idempotent, some views close the connection twice on early returns
+        raw = object.__getattribute__(self, "_raw")
+        if raw is None:
+            return
+        object.__setattr__(self, "_raw", None)
+        object.__getattribute__(self, "_pool").release(raw)
+
+    def discard(self):
+        # Drop the underlying connection instead of reusing it
+        raw = object.__getattribute__(self, "_raw")
+        if raw is None:
+            return
+        object.__setattr__(self, "_raw", None)
+        object.__getattribute__(self, "_pool").release(raw, discard=True)
+
+    def __del__(self):
+        # Safety net for a view that drops the wrapper without close(), the
+        # views themselves borrow only once the request is validated
+        try:
+            raw = object.__getattribute__(self, "_raw")
+        except AttributeError:
+            return
+        if raw is not None:
+            object.__getattribute__(self, "_pool").leaked(raw)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class ConnectionPool:
+    def __init__(self, min_size, max_size, acquire_timeout, max_age, check_idle_after, **connect_kwargs):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.max_age = max_age
+        self.check_idle_after = check_idle_after
+        self.connect_kwargs = connect_kwargs
+
+        self._idle = deque()        # (conn, created_at, released_at)
+        self._leaked = deque()      # connections whose wrapper was garbage collected
+        self._created_at = {}       # id(conn) -> creation time, for borrowed connections too
+        self._size = 0
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+
+        self._stats = {
+            "acquired": 0,
+            "released": 0,
+            "created": 0,
+            "closed": 0,
+            "recycled": 0,
+            "failed_checks": 0,
+            "leaked": 0,
+            "waits": 0,
+            "timeouts": 0,
+            "wait_time_total": 0.0,
+        }
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _connect(self):
+        conn = psycopg2.connect(**self.connect_kwargs)
+        with self._lock:
+            self._created_at[id(conn)] = time.monotonic()
+            self._stats["created"] += 1
+        return conn
+
+    def _close(self, conn):
+        with self._lock:
+            self._created_at.pop(id(conn), None)
+            self._stats["closed"] += 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _is_alive(self, conn, released_at):
+        if conn.closed:
+            return False
+        if conn.get_transaction_status() == extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if time.monotonic() - released_at < self.check_idle_after:
+            return True
+        # Connection sat idle for a while, server/firewall may have dropped it
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def leaked(self, conn):
+        """Takes back a connection whose wrapper was garbage collected."""
+        print("Database connection dropped without close(), returned to the pool")
+        self._leaked.append(conn)
+        # The GC can run while this very thread holds the pool lock, so never
+        # block on it here. The next acquire() or release() picks it up instead.
+        if self._lock.acquire(blocking=False):
+            try:
+                self._reclaim_leaked()
+            finally:
+                self._lock.release()
+
+    def _reclaim_leaked(self):
+        # Caller holds the lock. Leaked connections go back to the idle list
+        # marked dirty (no release time), acquire() cleans them up outside the
+        # lock, and the threads waiting for a slot are woken.
+        reclaimed = 0
+        while self._leaked:
+            try:
+                conn = self._leaked.popleft()
+            except IndexError:
+                break
+            self._idle.appendleft((conn, self._created_at.get(id(conn), 0), None))
+            reclaimed += 1
+        if reclaimed:
+            self._stats["leaked"] += reclaimed
+            self._available.notify(reclaimed)
+
+    def _reserve_slot(self):
+        # Caller holds the lock. Waits for an idle connection or a free slot.
+        started = time.monotonic()
+        deadline = started + self.acquire_timeout
+        waited = False
+        self._reclaim_leaked()
+        while not self._idle and self._size >= self.max_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self._stats["timeouts"] += 1
+                raise DatabaseUnavailable("Database connection pool exhausted.")
+            if not waited:
+                waited = True
+                self._stats["waits"] += 1
+            self._available.wait(remaining)
+            self._reclaim_leaked()
+        if waited:
+            self._stats["wait_time_total"] += time.monotonic() - started
+        if self._idle:
+            return self._idle.pop()  # LIFO keeps the warm connections warm
+        self._size += 1
+        return None
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                entry = self._reserve_slot()
+
+            if entry is None:
+                try:
+                    conn = self._connect()
+                except psycopg2.Error:
+                    with self._lock:
+                        self._size -= 1
+                        self._available.notify()
+                    raise
+                break
+
+            conn, created_at, released_at = entry
+            if released_at is None:
+                # Leaked mid-use, may be inside a transaction or in autocommit
+                released_at = self._reset(conn)
+            now = time.monotonic()
+            if now - created_at > self.max_age:
+                self._count("recycled")
+            elif released_at is not None and self._is_alive(conn, released_at):
+                break
+            else:
+                self._count("failed_checks")
+
+            # Stale connection, drop it and try again
+            self._close(conn)
+            with self._lock:
+                self._size -= 1
+                self._available.notify()
+
+        self._count("acquired")
+        return conn
+
+    def _reset(self, conn):
+        # Leave the connection the way psycopg2.connect() hands it out.
+        # Returns the release time, None when it's broken.
+        if conn.closed:
+            return None
+        try:
+            if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+            if conn.autocommit:
+                conn.autocommit = False
+        except psycopg2.Error:
+            return None
+        return time.monotonic()
+
+    def release(self, conn, discard=False):
+        if not discard and self._reset(conn) is None:
+            discard = True
+
+        with self._lock:
+            self._stats["released"] += 1
+            created_at = self._created_at.get(id(conn), 0)
+            if not discard and time.monotonic() - created_at > self.max_age:
+                self._stats["recycled"] += 1
+                discard = True
+            if not discard:
+                self._idle.append((conn, created_at, time.monotonic()))
+                self._available.notify()
+            self._reclaim_leaked()
+        if discard:
+            self._close(conn)
+            with self._lock:
+                self._size -= 1
+                self._available.notify()
+
+    def fill(self):
+        # Open connections up to min_size, used on worker start
+        while True:
+            with self._lock:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                conn = self._connect()
+            except psycopg2.Error:
+                with self._lock:
+                    self._size -= 1
+                raise
+            with self._lock:
+                self._idle.append((conn, self._created_at[id(conn)], time.monotonic()))
+                self._available.notify()
+
+    def close_all(self):
+        with self._lock:
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+        for conn, _, _ in idle:
+            self._close(conn)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = self._size
+            stats["idle"] = len(self._idle)
+            stats["in_use"] = self._size - len(self._idle)
+        stats["min_size"] = self.min_size
+        stats["max_size"] = self.max_size
+        stats["pid"] = os.getpid()
+        return stats
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    global _pool, _pool_pid
+    pid = os.getpid()
+    if _pool is not None and _pool_pid == pid:
+        return _pool
+    with _pool_lock:
+        # Forked workers must not share sockets with the parent
+        if _pool is None or _pool_pid != pid:
+            _pool = ConnectionPool(
+                DB_POOL_MIN_SIZE,
+                DB_POOL_MAX_SIZE,
+                DB_POOL_ACQUIRE_TIMEOUT,
+                DB_POOL_MAX_AGE,
+                DB_POOL_CHECK_IDLE_AFTER,
+                host=DB_HOST,
+                database=DB_NAME,
+                user=DB_USER,
+                password=DB_PASSWORD,
+                connect_timeout=DB_CONNECT_TIMEOUT,
+                cursor_factory=TimedCursor,
+            )
+            _pool_pid = pid
+    return _pool
+
+def get_pool_stats():
+    return get_pool().stats()
+
 def get_db_connection():
     try:
-        connection = psycopg2.connect(
-            host=DB_HOST,
-            database=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD
-        )
-        return connection
+        started = time.perf_counter()
+        raw = get_pool().acquire()
+        duration = time.perf_counter() - started
+        DB_ACQUIRE_TIME.labels("psycopg2").observe(duration)
+        record_acquire(duration)
+        return PooledConnection(get_pool(), raw)
     except psycopg2.Error as e:
         print(f"Database conection error: {e}")
-        raise APIException(f"Database conection error: {e}")
\ No newline at end of file
+        raise APIException(f"Database conection error: {e}")
+
+@contextmanager
+def db_connection():
+    conn = get_db_connection()
+    try:
+        yield conn
+    except psycopg2.OperationalError:
+        # Broken socket, don't put it back
+        conn.discard()
+        raise
+    finally:
+        conn.close()
+
+
+def _close_stream(cur, conn):
+    try:
+        cur.close()
+    finally:
+        conn.close()
+
+async def stream_rows(name, query, values=(), batch_size=1000):
+    """
+    Batches of rows from a server-side cursor, for StreamingHttpResponse.
+    Under ASGI Django reads a sync iterator into a list before sending the
+    first byte, so streaming responses need an async one. Every blocking
+    call runs in a thread of its own, never on the event loop (and not on
+    the single thread sync views share).
+    """
+    def run(func, *args):
+        return sync_to_async(func, thread_sensitive=False)(*args)
+
+    conn = await run(get_db_connection)
+    cur = conn.cursor(name=name)
+    try:
+        await run(cur.execute, query, values)
+        while True:
+            rows = await run(cur.fetchmany, batch_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        await run(_close_stream, cur, conn)
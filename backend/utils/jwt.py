@@ -4,84 +4,220 @@ from rest_framework import status
 from rest_framework.authentication import get_authorization_header
 
 from utils import database
+from utils.access import ACCESS_ARRAY_SQL,services_to_bitset
+from utils.access_snapshot import access_snapshot
+from utils.permissions import permission_versions
+from utils.metrics import TOKEN_DECODE_TIME,timed
+from utils.signing_keys import JWT_SIGNING_ALG,key_ring
+from utils.revocation import revocation_list
 
 from datetime import datetime,timedelta,timezone
+import secrets
+import base64
+import math
+import time
 import jwt
 import re
+import os
 
 
-SECRET_KEY = "testkey"
+# Shared secret of the HS256 tokens issued before the asymmetric keys
+# (utils/signing_keys.py), only used when JWT_SIGNING_ALG=HS256 or to verify
+# those older tokens while JWT_ACCEPT_HS256 is on. The old built-in secret is
+# public, whoever knows it can sign any token (admin included), so HS256 is
+# off by default and should only be turned on for a short migration window
+# or with a private JWT_SECRET_KEY.
+SECRET_KEY = os.environ.get("JWT_SECRET_KEY", "testkey")
+JWT_ACCEPT_HS256 = os.environ.get("JWT_ACCEPT_HS256", "false").lower() in ("1", "true", "yes")
+HS256_ENABLED = JWT_SIGNING_ALG == "HS256" or JWT_ACCEPT_HS256
+if HS256_ENABLED and SECRET_KEY == "testkey":
+    print("WARNING: HS256 tokens are accepted with the default secret, set JWT_SECRET_KEY")
 JWT_EXPIRATION = timedelta(days=1)
+# Embed the user's services ("srv") and permission version ("pv") in issued
+# tokens so ValidateToken can authorize without a database lookup
+TOKEN_EMBED_SCOPES = os.environ.get("TOKEN_EMBED_SCOPES", "false").lower() in ("1", "true", "yes")
 
-def create_token(userid,username,timeInDays):
+def encode_service_bitset(service_ids):
+    # Bit n set means access to srv_id n, base64url without padding
+    raw = services_to_bitset(service_ids)
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+def bitset_has_service(bitset, service_id):
+    raw = base64.urlsafe_b64decode(bitset + "=" * (-len(bitset) % 4))
+    byte_index = service_id // 8
+    if service_id < 0 or byte_index >= len(raw):
+        return False
+    return bool(raw[byte_index] >> (service_id % 8) & 1)
+
+def create_token(userid,username,timeInDays,services=None,perm_version=None):
+    expiration = None if timeInDays == "inf" else datetime.now(tz=timezone.utc)+timedelta(days=timeInDays)
     payload = {
         "user_id":userid,
         "user_name":username,
-        "expiration":str("inf" if timeInDays == "inf" else datetime.now(tz=timezone.utc)+timedelta(days=timeInDays))
+        "expiration":str("inf" if expiration is None else expiration)
         # Expiration for testing with 1 min duration
         #"expiration":str("inf" if timeInDays == "inf" else datetime.now(tz=timezone.utc)+timedelta(minutes=timeInDays))
         }
-    
-    token = jwt.encode(payload,SECRET_KEY,algorithm="HS256")
-    return token
+    # Token id and issue time (ms, never rounded up) for revocation, see utils/revocation.py
+    payload["jti"] = secrets.token_urlsafe(16)
+    payload["iat"] = math.floor(time.time() * 1000) / 1000
+    if expiration is not None:
+        # Standard claim too, so services verifying locally with any JWT library enforce it
+        payload["exp"] = int(expiration.timestamp())
+    if TOKEN_EMBED_SCOPES and services is not None and perm_version is not None:
+        payload["srv"] = encode_service_bitset(services)
+        payload["pv"] = perm_version
+
+    if JWT_SIGNING_ALG == "HS256":
+        return jwt.encode(payload,SECRET_KEY,algorithm="HS256")
+    key = key_ring.signing_key()
+    return jwt.encode(payload,key.private_key,algorithm=key.alg,headers={"kid":key.kid})
+
+def _verify(token):
+    header = jwt.get_unverified_header(token)
+    kid = header.get("kid")
+    if kid is None:
+        if not HS256_ENABLED:
+            raise jwt.InvalidTokenError("HS256 tokens are no longer accepted")
+        return jwt.decode(token,SECRET_KEY,algorithms=['HS256'])
+    if not isinstance(kid, str):
+        raise jwt.InvalidTokenError("Invalid kid")
+    key = key_ring.verification_key(kid)
+    if key is None:
+        raise jwt.InvalidTokenError("Unknown signing key")
+    # The key decides the algorithm, never the token header
+    return jwt.decode(token,key.public_key,algorithms=[key.alg])
+
+class TokenRevoked(jwt.InvalidTokenError):
+    pass
 
 def decode_token(token):
-    payload = jwt.decode(token,SECRET_KEY,algorithms=['HS256'])
+    with timed(TOKEN_DECODE_TIME):
+        payload = _verify(token)
+        if revocation_list.is_revoked(payload):
+            raise TokenRevoked("Token revoked")
     return payload
 
 
 
-def get_admin_user_from_token(request):
+def request_token(request):
+    """Bearer token from the Authorization header, else the 'token' cookie set by UserLogin."""
     auth = get_authorization_header(request).decode()
-    if not auth.startswith("Bearer "):
-        # Try to get token from cookie if not in header (for potential browser direct access, though API usually uses Header)
-        token_from_cookie = request.COOKIES.get('token') # Assuming 'token' is the cookie name used in UserLogin
-        if not token_from_cookie:
-            raise APIException("Authentication credentials were not provided.")
-        token = token_from_cookie
-    else:
-        token = auth.split(" ")[1]
+    if auth.startswith("Bearer "):
+        return auth.split(" ")[1]
+    return request.COOKIES.get('token')
+
+def _request_state(request):
+    # DRF's Request wraps Django's HttpRequest, keep the memos on the latter so
+    # the authentication class, permission checks and the view all share them
+    return getattr(request, "_request", request)
+
+def token_payload(request, token=None):
+    """
+    The request's decoded and checked token, decoded once per request
+    whoever asks first (JWTCustomAuth, get_admin_user_from_token).
+    """
+    state = _request_state(request)
+    token = token or request_token(request)
+    if not token:
+        raise APIException("Authentication credentials were not provided.")
+    cached = getattr(state, "_token_payload", None)
+    if cached is not None and cached[0] == token:
+        return cached[1]
+
+    payload = decode_token(token)
+    expiration_str = payload.get("expiration")
+    if not expiration_str:
+        raise AuthenticationFailed("Invalid token: Missing expiration.")
+    if(expiration_str != "inf"):
+        expiration = datetime.fromisoformat(expiration_str)
+        if expiration < datetime.now(timezone.utc):
+            raise AuthenticationFailed("Token expired")
+    if not payload.get("user_id"):
+        raise AuthenticationFailed("Invalid token: Missing user_id.")
 
+    state._token_payload = (token, payload)
+    return payload
+
+def load_identity(user_id, user_name):
+    """
+    Admin flag, permission version and service ids of a user, from the shared
+    snapshot when it matches this worker's permission version, else one
+    usr_info query. None when the user doesn't exist. The admin flag here is
+    informational, admin checks go through request_is_admin().
+    """
+    snapshot_entry = access_snapshot.get(user_id)
+    if snapshot_entry and permission_versions.get(user_id) == snapshot_entry.perm_version:
+        return {"user_id": user_id, "user_name": user_name, "is_admin": snapshot_entry.is_admin,
+                "perm_version": snapshot_entry.perm_version, "service_ids": snapshot_entry.service_ids()}
+
+    conn = database.get_db_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute(f"SELECT usr_admin, usr_login, usr_perm_version, {ACCESS_ARRAY_SQL} FROM usr_info WHERE usr_id = %s",
+                    (user_id,))
+        user_record = cur.fetchone()
+    finally:
+        cur.close()
+        conn.close()
+    if not user_record:
+        return None
+    return {"user_id": user_id, "user_name": user_record[1], "is_admin": bool(user_record[0]),
+            "perm_version": user_record[2], "service_ids": list(user_record[3])}
+
+def get_request_identity(request):
+    """
+    The authenticated user of this request as a dict (user_id, user_name,
+    is_admin, perm_version, service_ids), resolved once per request.
+    """
+    state = _request_state(request)
+    payload = token_payload(request)
+    cached = getattr(state, "_identity", None)
+    if cached is not None and cached[0] is payload:
+        return cached[1]
+    identity = load_identity(int(payload["user_id"]), payload.get("user_name"))
+    if identity is None:
+        raise AuthenticationFailed("User not found")
+    state._identity = (payload, identity)
+    return identity
+
+def request_is_admin(request, user_id):
+    """
+    usr_admin straight from the database, once per request. Admin rights
+    never come from the snapshot or a cached identity: a demotion, even one
+    made in SQL, applies from the next request on.
+    """
+    state = _request_state(request)
+    cached = getattr(state, "_admin_flag", None)
+    if cached is not None and cached[0] == user_id:
+        return cached[1]
+    conn = database.get_db_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT usr_admin FROM usr_info WHERE usr_id = %s", (user_id,))
+        row = cur.fetchone()
+    finally:
+        cur.close()
+        conn.close()
+    is_admin = bool(row and row[0])
+    state._admin_flag = (user_id, is_admin)
+    return is_admin
+
+def get_admin_user_from_token(request):
     try:
-        payload = decode_token(token) # extractToken should handle expired/invalid internally if needed, or raise
-        expiration_str = payload.get("expiration")
-        if not expiration_str:
-            raise AuthenticationFailed("Invalid token: Missing expiration.")
-        
-        if(expiration_str != "inf"):
-            expiration = datetime.fromisoformat(expiration_str)
-            if expiration < datetime.now(timezone.utc):
-                raise AuthenticationFailed("Token expired")
-
-        user_id = payload.get("user_id")
-        if not user_id:
-            raise AuthenticationFailed("Invalid token: Missing user_id.")
-
-        conn = database.get_db_connection()
-        cur = conn.cursor()
-        try:
-            cur.execute("SELECT usr_admin, usr_login FROM usr_info WHERE usr_id = %s", (user_id,))
-            user_record = cur.fetchone()
-            if not user_record:
-                raise AuthenticationFailed("User not found")
-            
-            is_admin = user_record[0]
-            user_name = user_record[1]
-
-            if not is_admin:
-                raise AuthenticationFailed("Admin privileges required.")
-            
-            return {"user_id": user_id, "user_name": user_name, "is_admin": True}
-        finally:
-            cur.close()
-            conn.close()
+        identity = get_request_identity(request)
+        if not request_is_admin(request, identity["user_id"]):
+            raise AuthenticationFailed("Admin privileges required.")
+        return {**identity, "is_admin": True}
     except jwt.ExpiredSignatureError:
         raise AuthenticationFailed("Token expired")
+    except TokenRevoked:
+        raise AuthenticationFailed("Token revoked")
     except jwt.InvalidTokenError:
         raise AuthenticationFailed("Invalid token")
-    except AuthenticationFailed as e: # Re-raise APIExceptions with their status codes
+    except APIException as e: # Re-raise APIExceptions with their status codes
         raise e
     except Exception as e:
         # It's good practice to log the actual error `e` here
         print(f"Admin Auth Error: {e}")
-        raise APIException("An error occurred during token validation.")
\ No newline at end of file
+        raise APIException("An error occurred during token validation.")
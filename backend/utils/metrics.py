@@ -0,0 +1,143 @@
+"""
+Prometheus metrics, served on /metrics.
+
+uvicorn --workers runs separate processes, each with its own counters. When
+PROMETHEUS_MULTIPROC_DIR is set (it has to be in the environment before the
+workers start, and emptied on every start, see the Dockerfile) every process
+writes its values to files in that directory and /metrics adds them up across
+the workers, whichever one answers the scrape. Without it the metrics are the
+answering process's only.
+
+Label values are kept to small, fixed sets: endpoints are URL patterns, not
+paths, and service ids come from a header anyone can set, so ids above
+METRICS_MAX_SERVICE_ID are reported as "other".
+"""
+from django.http import HttpResponse
+
+from contextlib import contextmanager
+import hmac
+import time
+import os
+
+from prometheus_client import (CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram,
+                               REGISTRY, generate_latest, multiprocess)
+
+PROMETHEUS_MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")  # when set, scrapes need "Authorization: Bearer <token>"
+METRICS_MAX_SERVICE_ID = int(os.environ.get("METRICS_MAX_SERVICE_ID", 1000))
+
+# Most of what's measured here is sub-millisecond to a few hundred ms
+LATENCY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+HTTP_METHODS = {"GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"}
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "Request latency by endpoint (URL pattern)",
+    ["endpoint", "method", "status"], buckets=LATENCY_BUCKETS)
+
+VALIDATE_DECISIONS = Counter(
+    "auth_validate_decisions_total", "ValidateToken answers by decision, reason and X-Service-ID",
+    ["decision", "reason", "service"])
+
+DB_ACQUIRE_TIME = Histogram(
+    "db_pool_acquire_seconds", "Time to get a connection from the pool",
+    ["pool"], buckets=LATENCY_BUCKETS)
+
+DB_QUERY_TIME = Histogram(
+    "db_query_seconds", "Statement execution time",
+    ["pool"], buckets=LATENCY_BUCKETS)
+
+DB_QUERIES_PER_REQUEST = Histogram(
+    "db_queries_per_request", "Statements a request ran, by endpoint",
+    ["endpoint"], buckets=(0, 1, 2, 3, 4, 6, 8, 12, 16, 32, 64))
+
+DB_QUERY_BUDGET_EXCEEDED = Counter(
+    "db_query_budget_exceeded_total", "Requests that ran more statements than DB_QUERY_BUDGET",
+    ["endpoint"])
+
+TOKEN_DECODE_TIME = Histogram(
+    "jwt_decode_seconds", "Token signature check and payload decode time",
+    buckets=(.00001, .000025, .00005, .0001, .00025, .0005, .001, .0025, .005))
+
+CACHE_LOOKUPS = Counter(
+    "cache_lookups_total", "Cache lookups by cache and result (hit/miss)",
+    ["cache", "result"])
+
+# ValidateToken detail -> reason label
+DENY_REASONS = {
+    "No token provided": "no_token",
+    "Invalid token": "invalid_token",
+    "Token expired": "expired",
+    "Token revoked": "revoked",
+    "Access denied to this service": "no_access",
+    "User not found": "unknown_user",
+    "Token permissions outdated, login again": "outdated_permissions",
+}
+
+
+def service_label(service_id):
+    if service_id is None or not str(service_id).strip():
+        return "none"
+    value = str(service_id).strip()
+    if not value.isdigit():
+        return "invalid"
+    return str(int(value)) if int(value) <= METRICS_MAX_SERVICE_ID else "other"
+
+
+def record_decision(status_code, body, service_id):
+    if status_code == 200:
+        VALIDATE_DECISIONS.labels("allow", "ok", service_label(service_id)).inc()
+    elif status_code == 401:
+        VALIDATE_DECISIONS.labels("deny", DENY_REASONS.get(body.get("detail"), "other"),
+                                  service_label(service_id)).inc()
+    else:
+        VALIDATE_DECISIONS.labels("error", "database", service_label(service_id)).inc()
+
+
+def record_cache(cache, hit):
+    CACHE_LOOKUPS.labels(cache, "hit" if hit else "miss").inc()
+
+
+def record_request(endpoint, method, status_code, duration):
+    REQUEST_LATENCY.labels(endpoint, method if method in HTTP_METHODS else "other",
+                           str(status_code)).observe(duration)
+
+
+@contextmanager
+def timed(histogram):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - started)
+
+
+class RequestMetricsMiddleware:
+    """Latency of every request Django serves, labelled with the matched URL pattern."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        response = self.get_response(request)
+        match = request.resolver_match
+        endpoint = match.route if match is not None and match.route else "unmatched"
+        record_request(endpoint, request.method, response.status_code, time.perf_counter() - started)
+        return response
+
+
+def _registry():
+    if not PROMETHEUS_MULTIPROC_DIR:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def metrics_view(request):
+    if METRICS_TOKEN:
+        auth = request.headers.get("Authorization", "")
+        if not hmac.compare_digest(auth.encode(), f"Bearer {METRICS_TOKEN}".encode()):
+            return HttpResponse("Unauthorized\n", status=401, content_type="text/plain")
+    return HttpResponse(generate_latest(_registry()), content_type=CONTENT_TYPE_LATEST)
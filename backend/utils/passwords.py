@@ -0,0 +1,149 @@
+"""
+Salted scrypt password hashes, stored as scrypt$<n>$<r>$<p>$<salt>$<hash>
+(base64 salt and hash) in usr_info.usr_password.
+
+scrypt is deliberately slow and memory hungry (128 * n * r bytes per hash),
+so every hash/verify runs on a small dedicated thread pool: at most
+PASSWORD_HASH_WORKERS run at once (hashlib releases the GIL while hashing)
+and at most PASSWORD_HASH_QUEUE more wait for a slot, past that callers get a
+503 instead of piling up behind each other. Bulk hashing (imports) takes
+the same slots and timeout, and never more than half the workers, so logins
+keep running next to a large import. Rows still holding a legacy
+plaintext password (or a hash with older cost parameters) verify fine and are
+reported as needing a rehash, UserLogin upgrades them on the next login.
+"""
+from rest_framework.exceptions import APIException
+from rest_framework import status
+
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import hashlib
+import base64
+import hmac
+import os
+
+PASSWORD_HASH_N = int(os.environ.get("PASSWORD_HASH_N", 2 ** 14))
+PASSWORD_HASH_R = int(os.environ.get("PASSWORD_HASH_R", 8))
+PASSWORD_HASH_P = int(os.environ.get("PASSWORD_HASH_P", 1))
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", os.cpu_count() or 1))
+PASSWORD_HASH_QUEUE = int(os.environ.get("PASSWORD_HASH_QUEUE", 64))
+PASSWORD_HASH_TIMEOUT = float(os.environ.get("PASSWORD_HASH_TIMEOUT", 10))  # seconds waiting for a slot and the hash
+
+PASSWORD_SALT_BYTES = 16
+PASSWORD_HASH_BYTES = 32
+PASSWORD_HASH_PREFIX = "scrypt$"
+
+
+class PasswordHashingBusy(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = "Too many logins in progress, try again shortly."
+    default_code = "password_hashing_busy"
+
+
+def _b64encode(data):
+    return base64.b64encode(data).decode().rstrip("=")
+
+
+def _b64decode(data):
+    return base64.b64decode(data + "=" * (-len(data) % 4))
+
+
+def _scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p,
+                          maxmem=256 * n * r * p, dklen=PASSWORD_HASH_BYTES)
+
+
+def make_hash(password, n=None, r=None, p=None):
+    """Hashes in the calling thread, use hash_password() from request code."""
+    n, r, p = n or PASSWORD_HASH_N, r or PASSWORD_HASH_R, p or PASSWORD_HASH_P
+    salt = os.urandom(PASSWORD_SALT_BYTES)
+    return f"{PASSWORD_HASH_PREFIX}{n}${r}${p}${_b64encode(salt)}${_b64encode(_scrypt(password, salt, n, r, p))}"
+
+
+def is_hashed(stored):
+    return stored.startswith(PASSWORD_HASH_PREFIX)
+
+
+def check_hash(password, stored):
+    """
+    (matches, needs_rehash) in the calling thread. Anything that isn't one of
+    our hashes is a legacy plaintext password.
+    """
+    if not is_hashed(stored):
+        return hmac.compare_digest(password.encode(), stored.encode()), True
+    try:
+        _, n, r, p, salt, expected = stored.split("$")
+        n, r, p = int(n), int(r), int(p)
+        salt, expected = _b64decode(salt), _b64decode(expected)
+        # Parameters out of range or past the memory limit are a corrupt row, not a 500
+        actual = _scrypt(password, salt, n, r, p)
+    except (ValueError, OverflowError):
+        return False, False
+    matches = hmac.compare_digest(actual, expected)
+    return matches, (n, r, p) != (PASSWORD_HASH_N, PASSWORD_HASH_R, PASSWORD_HASH_P)
+
+
+# Verified against when the login doesn't exist, so unknown users take as long as wrong passwords
+_DUMMY_HASH = None
+
+
+class HashingPool:
+    def __init__(self, workers, queue_size):
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hash")
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+
+    def _submit(self, fn, *args, wait=False):
+        # Logins never wait for a slot, bulk work waits up to PASSWORD_HASH_TIMEOUT
+        acquired = self._slots.acquire(timeout=PASSWORD_HASH_TIMEOUT) if wait else self._slots.acquire(blocking=False)
+        if not acquired:
+            raise PasswordHashingBusy()
+        try:
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def _results(self, futures):
+        try:
+            return [future.result(timeout=PASSWORD_HASH_TIMEOUT) for future in futures]
+        except TimeoutError:
+            for future in futures:
+                future.cancel()
+            raise PasswordHashingBusy()
+
+    def run(self, fn, *args):
+        return self._results([self._submit(fn, *args)])[0]
+
+    def map(self, fn, items):
+        # Half the workers at a time at most, the other half stays free for logins
+        batch_size = max(1, self.workers // 2)
+        results = []
+        for start in range(0, len(items), batch_size):
+            results.extend(self._results([self._submit(fn, item, wait=True)
+                                          for item in items[start:start + batch_size]]))
+        return results
+
+
+hashing_pool = HashingPool(PASSWORD_HASH_WORKERS, PASSWORD_HASH_QUEUE)
+
+
+def hash_password(password):
+    return hashing_pool.run(make_hash, password)
+
+
+def hash_passwords(passwords):
+    return hashing_pool.map(make_hash, list(passwords))
+
+
+def verify_password(password, stored):
+    """(matches, needs_rehash), stored=None for unknown users."""
+    global _DUMMY_HASH
+    if stored is None:
+        if _DUMMY_HASH is None:
+            _DUMMY_HASH = hashing_pool.run(make_hash, os.urandom(8).hex())
+        hashing_pool.run(check_hash, password, _DUMMY_HASH)
+        return False, False
+    return hashing_pool.run(check_hash, password, stored)
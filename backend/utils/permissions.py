@@ -0,0 +1,129 @@
+from utils import database
+from utils.change_feed import change_feed
+
+import threading
+import time
+import os
+
+# How often each worker reloads usr_perm_version for every user
+PERM_VERSION_REFRESH_INTERVAL = float(os.environ.get("PERM_VERSION_REFRESH_INTERVAL", 30))
+
+
+class PermissionVersions:
+    """
+    In-memory usr_id -> usr_perm_version table. Tokens carrying service scopes
+    are only trusted while their "pv" claim matches the version here, every
+    admin change to a user's access or admin flag bumps the version.
+    Reloaded in the background, writes made by this worker are applied right
+    away with update()/remove().
+    """
+
+    def __init__(self, refresh_interval):
+        self.refresh_interval = refresh_interval
+        self._versions = {}
+        self._loaded = False
+        self._replay = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="perm-versions", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.reload()
+            except Exception as e:
+                print(f"Permission version reload failed: {e}")
+            time.sleep(self.refresh_interval)
+
+    def reload(self):
+        with self._lock:
+            # update()/remove() calls made while the table is read are replayed
+            # on the result, its snapshot may predate them
+            self._replay = []
+        try:
+            with database.db_connection() as conn:
+                cur = conn.cursor()
+                try:
+                    cur.execute("SELECT usr_id, usr_perm_version FROM usr_info")
+                    versions = dict(cur.fetchall())
+                finally:
+                    cur.close()
+            with self._lock:
+                for user_id, version in self._replay:
+                    self._set(versions, user_id, version)
+                # Versions only go up, never let a reload move one back
+                for user_id, version in versions.items():
+                    current = self._versions.get(user_id)
+                    if current is not None and current > version:
+                        versions[user_id] = current
+                self._versions = versions
+                self._loaded = True
+        finally:
+            with self._lock:
+                self._replay = None
+
+    @staticmethod
+    def _set(versions, user_id, version):
+        if version is None:
+            versions.pop(user_id, None)
+        else:
+            versions[user_id] = max(version, versions.get(user_id, version))
+
+    @property
+    def loaded(self):
+        if self._thread is None:
+            self._start()
+        return self._loaded
+
+    def get(self, user_id):
+        """Current version, None for unknown (deleted) users."""
+        if self._thread is None:
+            self._start()
+        return self._versions.get(user_id)
+
+    def _apply(self, user_id, version):
+        # Caller holds the lock
+        self._set(self._versions, user_id, version)
+        if self._replay is not None:
+            self._replay.append((user_id, version))
+
+    def update(self, rows):
+        """rows of (usr_id, usr_perm_version) as returned by bump_permission_versions."""
+        with self._lock:
+            for user_id, version in rows:
+                self._apply(int(user_id), int(version))
+
+    def remove(self, user_id):
+        with self._lock:
+            self._apply(int(user_id), None)
+
+
+def bump_permission_versions(cur, user_ids):
+    """Bumps usr_perm_version inside the caller's transaction, returns (usr_id, version) rows."""
+    cur.execute("""
+        UPDATE usr_info SET usr_perm_version = usr_perm_version + 1
+        WHERE usr_id = ANY(%s) RETURNING usr_id, usr_perm_version
+    """, ([int(user_id) for user_id in user_ids],))
+    return cur.fetchall()
+
+
+permission_versions = PermissionVersions(PERM_VERSION_REFRESH_INTERVAL)
+
+
+def _on_change(event):
+    if event.get("table") != "usr_info":
+        return
+    if event.get("op") == "BULK":
+        permission_versions.update(event["users"])
+    elif event.get("op") == "DELETE":
+        permission_versions.remove(event["usr_id"])
+    elif event.get("pv") is not None:
+        permission_versions.update([(event["usr_id"], event["pv"])])
+
+change_feed.subscribe(_on_change, permission_versions.reload)
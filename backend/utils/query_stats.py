@@ -0,0 +1,93 @@
+"""
+Per-request database statistics.
+
+TimedCursor (utils.database) reports every statement here: the text (the
+query template, never the parameters), duration and row count. Statements
+slower than DB_SLOW_QUERY_MS are logged wherever they run. Inside a request
+QueryStatsMiddleware also collects them, logs the request's statements when
+it makes more than DB_QUERY_BUDGET round trips, and sends the totals back in
+a Server-Timing header (db, db-acquire).
+
+Only what runs before the view returns is counted, rows a streaming
+response fetches afterwards aren't.
+"""
+from contextvars import ContextVar
+import os
+
+from utils.metrics import DB_QUERIES_PER_REQUEST,DB_QUERY_BUDGET_EXCEEDED
+
+DB_SLOW_QUERY_MS = float(os.environ.get("DB_SLOW_QUERY_MS", 200))       # 0 disables the slow query log
+DB_QUERY_BUDGET = int(os.environ.get("DB_QUERY_BUDGET", 10))             # statements per request, 0 disables
+DB_QUERY_LOG_MAX_STATEMENTS = 50                                          # kept per request for the budget log
+SERVER_TIMING_ENABLED = os.environ.get("SERVER_TIMING_ENABLED", "true").lower() in ("1", "true", "yes")
+
+_current = ContextVar("query_stats", default=None)
+
+
+def _statement_text(statement):
+    if isinstance(statement, bytes):
+        statement = statement.decode(errors="replace")
+    return " ".join(str(statement).split())[:500]
+
+
+class RequestQueries:
+    def __init__(self):
+        self.count = 0
+        self.rows = 0
+        self.duration = 0.0
+        self.acquire_duration = 0.0
+        self.statements = []    # (statement, seconds, rows), the first DB_QUERY_LOG_MAX_STATEMENTS
+
+    def server_timing(self):
+        return (f'db;dur={self.duration * 1000:.2f};desc="{self.count} queries, {self.rows} rows", '
+                f'db-acquire;dur={self.acquire_duration * 1000:.2f}')
+
+
+def record_query(statement, duration, rows):
+    if DB_SLOW_QUERY_MS and duration * 1000 >= DB_SLOW_QUERY_MS:
+        print(f"Slow query ({duration * 1000:.1f} ms, {rows} rows): {_statement_text(statement)}")
+    stats = _current.get()
+    if stats is None:
+        return
+    stats.count += 1
+    stats.rows += rows
+    stats.duration += duration
+    if len(stats.statements) < DB_QUERY_LOG_MAX_STATEMENTS:
+        stats.statements.append((statement, duration, rows))
+
+
+def record_acquire(duration):
+    stats = _current.get()
+    if stats is not None:
+        stats.acquire_duration += duration
+
+
+def current_queries():
+    """RequestQueries of the request being served, None outside one."""
+    return _current.get()
+
+
+class QueryStatsMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        stats = RequestQueries()
+        token = _current.set(stats)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+
+        match = request.resolver_match
+        endpoint = match.route if match is not None and match.route else "unmatched"
+        DB_QUERIES_PER_REQUEST.labels(endpoint).observe(stats.count)
+        if DB_QUERY_BUDGET and stats.count > DB_QUERY_BUDGET:
+            DB_QUERY_BUDGET_EXCEEDED.labels(endpoint).inc()
+            statements = "\n".join(f"  {seconds * 1000:.1f} ms, {rows} rows: {_statement_text(statement)}"
+                                   for statement, seconds, rows in stats.statements)
+            print(f"Query budget exceeded: {request.method} {request.path} made {stats.count} queries "
+                  f"(budget {DB_QUERY_BUDGET}, {stats.duration * 1000:.1f} ms)\n{statements}")
+        if SERVER_TIMING_ENABLED:
+            response["Server-Timing"] = stats.server_timing()
+        return response
@@ -0,0 +1,231 @@
+"""
+Revoked tokens, checked in memory by decode_token().
+
+Two kinds of revocation are kept in Postgres:
+- single tokens: revoked_tokens, keyed by the token's jti. Logout writes these.
+- users: usr_info.usr_tokens_not_before. Every token of the user issued
+  (iat) before it is rejected, as are tokens from before jti/iat existed.
+  Used for "log out everywhere" and password changes.
+
+Each worker holds the jtis in a Bloom filter in front of an exact set, so the
+common case (not revoked) is a few bit probes, and a filter hit is confirmed
+against the set. The not-before times are a dict per user. Both are loaded at
+start and every REVOCATION_RELOAD seconds. The reload also drops expired
+rows, and is the only way to shrink the filter. In between, new revocations
+arrive through the change feed, and the worker that revokes applies them
+right away. Another worker can accept a revoked token until the notification
+reaches it, usually a few milliseconds.
+
+Until the first load succeeds nothing counts as revoked: behaving as before
+beats rejecting every token when the database is down at startup.
+"""
+from datetime import datetime,timezone
+import threading
+import hashlib
+import math
+import time
+import os
+
+from utils import database
+from utils.change_feed import change_feed
+
+REVOCATION_ENABLED = os.environ.get("REVOCATION_ENABLED", "true").lower() in ("1", "true", "yes")
+REVOCATION_RELOAD = float(os.environ.get("REVOCATION_RELOAD", 10 * 60))
+REVOCATION_BLOOM_CAPACITY = int(os.environ.get("REVOCATION_BLOOM_CAPACITY", 100000))  # grows on reload when outgrown
+REVOCATION_BLOOM_FP_RATE = float(os.environ.get("REVOCATION_BLOOM_FP_RATE", 0.001))
+REVOCATION_CLOCK_SKEW = float(os.environ.get("REVOCATION_CLOCK_SKEW", 2))  # seconds, max clock difference between backend hosts
+
+
+class BloomFilter:
+    """Plain Bloom filter over strings, k probes by double hashing one blake2b digest."""
+
+    def __init__(self, capacity, fp_rate):
+        capacity = max(capacity, 1)
+        self.size = max(64, math.ceil(-capacity * math.log(fp_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.capacity = capacity
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, value):
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, value):
+        for position in self._positions(value):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value):
+        bits = self._bits
+        return all(bits[position >> 3] >> (position & 7) & 1 for position in self._positions(value))
+
+
+class _State:
+    __slots__ = ("bloom", "jtis", "not_before")
+
+    def __init__(self, bloom, jtis, not_before):
+        self.bloom = bloom
+        self.jtis = jtis
+        self.not_before = not_before    # usr_id -> epoch seconds
+
+
+class RevocationList:
+    def __init__(self):
+        self._state = None
+        self._lock = threading.Lock()
+        self._started = False
+        self._replay = None
+        self.stats = {"reloads": 0, "bloom_hits": 0, "false_positives": 0, "rejected": 0}
+
+    def reload(self):
+        with self._lock:
+            # Revocations that arrive while the table is read are replayed on the new state
+            self._replay = []
+        try:
+            self._reload()
+        finally:
+            with self._lock:
+                self._replay = None
+
+    def _reload(self):
+        with database.db_connection() as conn:
+            cur = conn.cursor()
+            try:
+                cur.execute("DELETE FROM revoked_tokens WHERE expires_at < now()")
+                cur.execute("SELECT jti FROM revoked_tokens")
+                jtis = {row[0] for row in cur.fetchall()}
+                cur.execute("""
+                    SELECT usr_id, extract(epoch FROM usr_tokens_not_before)::float8 FROM usr_info
+                    WHERE usr_tokens_not_before IS NOT NULL
+                """)
+                not_before = dict(cur.fetchall())
+                conn.commit()
+            finally:
+                cur.close()
+
+        capacity = REVOCATION_BLOOM_CAPACITY
+        while capacity < len(jtis) * 2:
+            capacity *= 2
+        bloom = BloomFilter(capacity, REVOCATION_BLOOM_FP_RATE)
+        for jti in jtis:
+            bloom.add(jti)
+        state = _State(bloom, jtis, not_before)
+        with self._lock:
+            for apply, args in self._replay:
+                apply(state, *args)
+            self._state = state
+        self.stats["reloads"] += 1
+
+    def _run(self):
+        while True:
+            time.sleep(REVOCATION_RELOAD)
+            try:
+                self.reload()
+            except Exception as e:
+                print(f"Revocation list reload failed: {e}")
+
+    def start(self):
+        """First load plus the periodic reload thread, called once per worker."""
+        if not REVOCATION_ENABLED or self._started:
+            return
+        self._started = True
+        try:
+            self.reload()
+        except Exception as e:
+            print(f"Revocation list load failed: {e}")
+        threading.Thread(target=self._run, name="revocation-list", daemon=True).start()
+
+    def is_revoked(self, payload):
+        state = self._state
+        if state is None:
+            return False
+        try:
+            user_id = int(payload.get("user_id"))
+        except (TypeError, ValueError):
+            user_id = None
+        not_before = state.not_before.get(user_id)
+        if not_before is not None and payload.get("iat", 0) < not_before:
+            self.stats["rejected"] += 1
+            return True
+        jti = payload.get("jti")
+        if isinstance(jti, str) and jti in state.bloom:
+            self.stats["bloom_hits"] += 1
+            if jti in state.jtis:
+                self.stats["rejected"] += 1
+                return True
+            self.stats["false_positives"] += 1
+        return False
+
+    @staticmethod
+    def _add_token(state, jti):
+        if jti not in state.jtis:
+            state.jtis.add(jti)
+            state.bloom.add(jti)
+
+    @staticmethod
+    def _set_not_before(state, user_id, not_before):
+        if not_before is None:
+            state.not_before.pop(user_id, None)
+        else:
+            state.not_before[user_id] = float(not_before)
+
+    def _apply(self, apply, *args):
+        with self._lock:
+            if self._replay is not None:
+                self._replay.append((apply, args))
+            if self._state is not None:
+                apply(self._state, *args)
+
+    def add_token(self, jti):
+        self._apply(self._add_token, jti)
+
+    def set_not_before(self, user_id, not_before):
+        self._apply(self._set_not_before, int(user_id), not_before)
+
+
+revocation_list = RevocationList()
+
+
+def revoke_token(cur, payload):
+    """
+    Records a decoded token's jti (caller commits, the trigger tells the
+    other workers). Returns False for tokens issued before jti existed.
+    """
+    jti = payload.get("jti")
+    if not isinstance(jti, str):
+        return False
+    exp = payload.get("exp")
+    expires_at = datetime.fromtimestamp(exp, tz=timezone.utc) if isinstance(exp, (int, float)) else None
+    cur.execute("""
+        INSERT INTO revoked_tokens (jti, usr_id, expires_at) VALUES (%s, %s, %s)
+        ON CONFLICT (jti) DO NOTHING
+    """, (jti, payload.get("user_id"), expires_at))
+    return True
+
+
+def revoke_user_tokens(cur, user_id):
+    """
+    Rejects every token the user holds now, returns the cut-off as epoch
+    seconds. The tokens' iat comes from the clock of whichever host minted
+    them, so the cut-off is this host's clock plus REVOCATION_CLOCK_SKEW:
+    a token minted just before on a host running slightly ahead is still
+    caught, at the price of a login in the next moments being rejected too.
+    """
+    not_before = time.time() + REVOCATION_CLOCK_SKEW
+    cur.execute("UPDATE usr_info SET usr_tokens_not_before = to_timestamp(%s) WHERE usr_id = %s",
+                (not_before, user_id))
+    return not_before
+
+
+def _on_change(event):
+    if event.get("table") == "revoked_tokens" and event.get("jti"):
+        revocation_list.add_token(event["jti"])
+    elif event.get("table") == "usr_info" and event.get("usr_id") is not None and event.get("op") != "BULK":
+        revocation_list.set_not_before(event["usr_id"], event.get("nbf"))
+
+def _on_resync():
+    if revocation_list._started:
+        revocation_list.reload()
+
+change_feed.subscribe(_on_change, _on_resync)
@@ -0,0 +1,275 @@
+"""
+Token signing keys (EdDSA or ES256) with scheduled rotation.
+
+Keys live in jwt_signing_keys so every worker and host signs and verifies
+with the same set. Each key has a kid, carried in the token header. The
+newest activated key of JWT_SIGNING_ALG signs. Once it is older than
+JWT_KEY_ROTATION_DAYS, whichever worker notices first creates the next key
+(under an advisory lock). The new key activates JWT_KEY_PREPUBLISH seconds
+later, so the JWKS caches of downstream verifiers already have it when the
+first token signed with it shows up. A key replaced by a newer one keeps
+verifying for JWT_KEY_RETAIN_DAYS, which must cover the longest token
+lifetime (refresh tokens: 90 days), counted from when the next key of the
+same algorithm activated. Tokens of users with jwt_expiration 'inf' never
+expire, so while any such user exists no key is dropped at all (the JWKS
+keeps growing by one key per rotation). Once none is left, the keys past
+JWT_KEY_RETAIN_DAYS go, along with the 'inf' tokens they signed: users who
+were switched to a finite lifetime have to log in again.
+
+Workers reload the table every JWT_KEYS_REFRESH seconds from a background
+thread, and early when a token names a kid they don't know yet. Requests
+never wait on that reload (the ASGI validate path runs on the event loop):
+the token is rejected, the client's retry finds the key.
+
+Private keys are stored as PKCS8 PEM encrypted with JWT_KEY_PASSPHRASE, so
+a database dump or read-only SQL access doesn't hand out the signing keys.
+Without a passphrase they are stored in the clear (a warning is printed).
+Keys stored before the passphrase was set keep loading until rotation
+replaces them.
+"""
+from rest_framework.exceptions import APIException
+from rest_framework import status
+from django.http import HttpResponse,JsonResponse
+from cryptography.hazmat.primitives.asymmetric import ec,ed25519
+from cryptography.hazmat.primitives import serialization
+from jwt.algorithms import ECAlgorithm,OKPAlgorithm
+
+from datetime import datetime,timedelta,timezone
+import threading
+import hashlib
+import secrets
+import json
+import time
+import os
+
+import psycopg2
+
+from utils import database
+
+JWT_SIGNING_ALG = os.environ.get("JWT_SIGNING_ALG", "EdDSA")                      # EdDSA | ES256 | HS256 (legacy shared secret)
+JWT_KEY_ROTATION_DAYS = float(os.environ.get("JWT_KEY_ROTATION_DAYS", 30))
+JWT_KEY_PREPUBLISH = float(os.environ.get("JWT_KEY_PREPUBLISH", 60 * 60))        # seconds a new key is in the JWKS before it signs
+JWT_KEY_RETAIN_DAYS = float(os.environ.get("JWT_KEY_RETAIN_DAYS", 120))          # verification after a key was replaced
+JWT_KEYS_REFRESH = float(os.environ.get("JWT_KEYS_REFRESH", 60))
+JWT_KEYS_MISS_RELOAD = float(os.environ.get("JWT_KEYS_MISS_RELOAD", 5))         # at most one reload per this for unknown kids
+JWKS_MAX_AGE = int(os.environ.get("JWKS_MAX_AGE", 300))                          # keep well under JWT_KEY_PREPUBLISH
+JWT_KEY_PASSPHRASE = os.environ.get("JWT_KEY_PASSPHRASE", "").encode() or None
+
+ASYMMETRIC_ALGORITHMS = ("EdDSA", "ES256")
+
+# Any constant works, it only has to differ from other advisory lock users
+ROTATION_LOCK_ID = 0x6A776B73
+
+
+class SigningKey:
+    __slots__ = ("kid", "alg", "private_key", "public_key", "activates_at", "retired_at")
+
+    def __init__(self, kid, alg, private_pem, activates_at):
+        self.kid = kid
+        self.alg = alg
+        encrypted = "ENCRYPTED PRIVATE KEY" in private_pem
+        self.private_key = serialization.load_pem_private_key(private_pem.encode(),
+                                                              password=JWT_KEY_PASSPHRASE if encrypted else None)
+        self.public_key = self.private_key.public_key()
+        self.activates_at = activates_at
+        self.retired_at = None
+
+    def jwk(self):
+        algorithm = OKPAlgorithm if self.alg == "EdDSA" else ECAlgorithm
+        jwk = algorithm.to_jwk(self.public_key, as_dict=True)
+        jwk.update({"kid": self.kid, "alg": self.alg, "use": "sig"})
+        return jwk
+
+
+def generate_private_pem(alg):
+    key = ed25519.Ed25519PrivateKey.generate() if alg == "EdDSA" else ec.generate_private_key(ec.SECP256R1())
+    if JWT_KEY_PASSPHRASE is None:
+        print("WARNING: storing a signing key unencrypted, set JWT_KEY_PASSPHRASE")
+        encryption = serialization.NoEncryption()
+    else:
+        encryption = serialization.BestAvailableEncryption(JWT_KEY_PASSPHRASE)
+    return key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, encryption).decode()
+
+
+def retire_keys(keys, signing_alg):
+    """
+    Sets retired_at on keys (sorted by activates_at): when the next key of
+    the same algorithm activated, or for the last key of an algorithm we
+    switched away from, the first signing_alg key after it.
+    """
+    for index, key in enumerate(keys):
+        later = keys[index + 1:]
+        successor = next((other for other in later if other.alg == key.alg), None)
+        if successor is None and key.alg != signing_alg:
+            successor = next((other for other in later if other.alg == signing_alg), None)
+        key.retired_at = successor.activates_at if successor is not None else None
+
+
+class SigningKeysUnavailable(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = "Signing keys unavailable, try again later."
+    default_code = "signing_keys_unavailable"
+
+
+class KeyRing:
+    def __init__(self):
+        self._keys = {}             # kid -> SigningKey, every key that still verifies
+        self._loaded_at = None
+        self._last_miss_reload = 0.0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._started = False
+
+    def _rotate_if_due(self, cur, now):
+        cur.execute("SELECT max(activates_at) FROM jwt_signing_keys WHERE alg = %s", (JWT_SIGNING_ALG,))
+        newest = cur.fetchone()[0]
+        if newest is not None and newest > now - timedelta(days=JWT_KEY_ROTATION_DAYS):
+            return
+        cur.execute("SELECT pg_try_advisory_xact_lock(%s)", (ROTATION_LOCK_ID,))
+        if not cur.fetchone()[0]:
+            return  # another worker is rotating
+        # Recheck under the lock, the other worker may have just committed one
+        cur.execute("SELECT max(activates_at) FROM jwt_signing_keys WHERE alg = %s", (JWT_SIGNING_ALG,))
+        newest = cur.fetchone()[0]
+        if newest is not None and newest > now - timedelta(days=JWT_KEY_ROTATION_DAYS):
+            return
+        # The very first key has to sign right away, later ones are published ahead
+        activates_at = now if newest is None else now + timedelta(seconds=JWT_KEY_PREPUBLISH)
+        cur.execute("""
+            INSERT INTO jwt_signing_keys (kid, alg, private_key, activates_at) VALUES (%s, %s, %s, %s)
+        """, (secrets.token_urlsafe(12), JWT_SIGNING_ALG, generate_private_pem(JWT_SIGNING_ALG), activates_at))
+
+    def _load(self):
+        now = datetime.now(tz=timezone.utc)
+        with database.db_connection() as conn:
+            cur = conn.cursor()
+            try:
+                if JWT_SIGNING_ALG in ASYMMETRIC_ALGORITHMS:
+                    self._rotate_if_due(cur, now)
+                cur.execute("""
+                    SELECT kid, alg, private_key, activates_at FROM jwt_signing_keys ORDER BY activates_at
+                """)
+                rows = cur.fetchall()
+                cur.execute("SELECT EXISTS (SELECT 1 FROM usr_info WHERE jwt_expiration = 'inf')")
+                keep_all = cur.fetchone()[0]
+                conn.commit()
+            finally:
+                cur.close()
+
+        keys = []
+        for row in rows:
+            try:
+                keys.append(SigningKey(*row))
+            except (TypeError, ValueError) as e:
+                # Encrypted without (or with another) JWT_KEY_PASSPHRASE
+                print(f"Signing key {row[0]} can't be loaded: {e}")
+        retire_keys(keys, JWT_SIGNING_ALG)
+        retain = timedelta(days=JWT_KEY_RETAIN_DAYS)
+        self._keys = {key.kid: key for key in keys
+                      if keep_all or key.retired_at is None or key.retired_at + retain > now}
+        self._loaded_at = time.monotonic()
+
+    def reload(self):
+        """Reads the table (rotating first when due), keeps the old keys on failure."""
+        with self._lock:
+            try:
+                self._load()
+            except (psycopg2.Error, APIException) as e:
+                print(f"Signing key reload failed: {e}")
+                if self._loaded_at is None:
+                    raise SigningKeysUnavailable()
+
+    def _ensure_loaded(self):
+        # With the refresher thread running requests never wait on the table,
+        # otherwise (management commands, scripts) reload inline when stale
+        loaded_at = self._loaded_at
+        if self._started:
+            if loaded_at is None:
+                self._wake.set()
+                raise SigningKeysUnavailable()
+            return
+        if loaded_at is None or time.monotonic() - loaded_at >= JWT_KEYS_REFRESH:
+            self.reload()
+
+    def _run(self):
+        last_reload = time.monotonic()
+        while True:
+            # Sooner while the first load keeps failing, and never more than once per JWT_KEYS_MISS_RELOAD
+            self._wake.wait(JWT_KEYS_REFRESH if self._loaded_at is not None else JWT_KEYS_MISS_RELOAD)
+            time.sleep(max(0, last_reload + JWT_KEYS_MISS_RELOAD - time.monotonic()))
+            self._wake.clear()
+            last_reload = time.monotonic()
+            try:
+                self.reload()
+            except SigningKeysUnavailable:
+                pass
+
+    def start(self):
+        """
+        Loads the keys and keeps them fresh from a daemon thread, called once
+        per worker. From then on lookups never reload inline.
+        """
+        if self._started:
+            return
+        try:
+            self.reload()
+        except SigningKeysUnavailable:
+            pass  # the thread keeps trying, requests get a 503 until then
+        threading.Thread(target=self._run, name="signing-keys", daemon=True).start()
+        self._started = True
+
+    def _active(self):
+        now = datetime.now(tz=timezone.utc)
+        return [key for key in self._keys.values() if key.alg == JWT_SIGNING_ALG and key.activates_at <= now]
+
+    def signing_key(self):
+        """Newest activated key of JWT_SIGNING_ALG."""
+        self._ensure_loaded()
+        active = self._active()
+        if not active:
+            # Switched to another algorithm (or the keys were deleted), the reload
+            # creates one. Same as for unknown kids: the refresher does it
+            if self._started:
+                self._wake.set()
+                raise SigningKeysUnavailable()
+            self.reload()
+            active = self._active()
+            if not active:
+                raise SigningKeysUnavailable()
+        return max(active, key=lambda key: key.activates_at)
+
+    def verification_key(self, kid):
+        """SigningKey for a token's kid, None when unknown or dropped."""
+        self._ensure_loaded()
+        key = self._keys.get(kid)
+        if key is None and time.monotonic() - self._last_miss_reload > JWT_KEYS_MISS_RELOAD:
+            # A key another worker just created, or garbage
+            self._last_miss_reload = time.monotonic()
+            if self._started:
+                self._wake.set()
+            else:
+                self.reload()
+                key = self._keys.get(kid)
+        return key
+
+    def jwks(self):
+        """Every key that signs, will sign or still verifies, public parts only."""
+        self._ensure_loaded()
+        return {"keys": [key.jwk() for key in sorted(self._keys.values(), key=lambda key: key.activates_at)]}
+
+
+key_ring = KeyRing()
+
+
+def jwks_view(request):
+    """/.well-known/jwks.json, public keys for verifying tokens without calling us."""
+    try:
+        body = json.dumps(key_ring.jwks(), separators=(",", ":"))
+    except SigningKeysUnavailable:
+        return JsonResponse({"detail": SigningKeysUnavailable.default_detail}, status=503,
+                            headers={"Cache-Control": "no-store"})
+    etag = '"' + hashlib.sha256(body.encode()).hexdigest()[:32] + '"'
+    headers = {"Cache-Control": f"public, max-age={JWKS_MAX_AGE}", "ETag": etag}
+    if request.headers.get("If-None-Match") == etag:
+        return HttpResponse(status=304, headers=headers)
+    return HttpResponse(body, content_type="application/json", headers=headers)
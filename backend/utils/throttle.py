@@ -0,0 +1,219 @@
+"""
+Login throttling, checked before UserLogin touches the database.
+
+Attempts are counted per client IP (X-Real-IP when the request comes from a
+proxy listed in TRUSTED_PROXIES, else the socket peer) and per username
+with a sliding window counter: the previous fixed window's count weighted by
+how much of it still overlaps the sliding window, plus the current one. Going
+over the limit locks the key out for LOGIN_LOCKOUT_BASE seconds, doubling
+with every repeat offence up to LOGIN_LOCKOUT_MAX. A successful login clears
+the username's counter (never the IP's).
+
+The default backend keeps the counters in this process, split across shards
+with a lock each so concurrent logins rarely wait on each other. With several
+workers set LOGIN_THROTTLE_BACKEND=cache and point a shared Django cache
+(Redis, Memcached) at LOGIN_THROTTLE_CACHE so every worker sees the same
+counters.
+"""
+from rest_framework.exceptions import Throttled
+
+import ipaddress
+import threading
+import hashlib
+import math
+import time
+import os
+
+LOGIN_THROTTLE_ENABLED = os.environ.get("LOGIN_THROTTLE_ENABLED", "true").lower() in ("1", "true", "yes")
+LOGIN_THROTTLE_BACKEND = os.environ.get("LOGIN_THROTTLE_BACKEND", "memory")  # memory | cache
+LOGIN_THROTTLE_CACHE = os.environ.get("LOGIN_THROTTLE_CACHE", "default")     # Django cache alias for the cache backend
+LOGIN_THROTTLE_WINDOW = float(os.environ.get("LOGIN_THROTTLE_WINDOW", 60))
+LOGIN_THROTTLE_IP_LIMIT = int(os.environ.get("LOGIN_THROTTLE_IP_LIMIT", 30))
+LOGIN_THROTTLE_USER_LIMIT = int(os.environ.get("LOGIN_THROTTLE_USER_LIMIT", 10))
+LOGIN_LOCKOUT_BASE = float(os.environ.get("LOGIN_LOCKOUT_BASE", 30))
+LOGIN_LOCKOUT_MAX = float(os.environ.get("LOGIN_LOCKOUT_MAX", 60 * 60))
+LOGIN_THROTTLE_SHARDS = int(os.environ.get("LOGIN_THROTTLE_SHARDS", 32))
+LOGIN_THROTTLE_MAX_KEYS = int(os.environ.get("LOGIN_THROTTLE_MAX_KEYS", 100000))  # per process, across shards
+# Addresses/networks of the nginx gateways allowed to set X-Real-IP, comma
+# separated. A client reaching the backend directly could otherwise rotate
+# the header and never hit the per-IP limit.
+TRUSTED_PROXIES = [ipaddress.ip_network(network.strip(), strict=False)
+                   for network in os.environ.get("TRUSTED_PROXIES", "127.0.0.1,::1").split(",") if network.strip()]
+
+
+def _is_trusted_proxy(address):
+    try:
+        address = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(address in network for network in TRUSTED_PROXIES)
+
+
+_untrusted_warned = set()
+
+def client_ip(request):
+    """Address nginx saw (X-Real-IP) behind a trusted proxy, the socket peer otherwise."""
+    remote_addr = request.META.get("REMOTE_ADDR", "")
+    real_ip = request.META.get("HTTP_X_REAL_IP", "").strip()
+    if real_ip and _is_trusted_proxy(remote_addr):
+        return real_ip
+    if real_ip and remote_addr not in _untrusted_warned and len(_untrusted_warned) < 100:
+        # Most likely the gateway missing from TRUSTED_PROXIES, which counts every
+        # login against its address and soon locks everybody out
+        _untrusted_warned.add(remote_addr)
+        print(f"Login throttle: X-Real-IP from {remote_addr} ignored, it is not in TRUSTED_PROXIES")
+    return remote_addr
+
+
+def lockout_duration(strikes):
+    return min(LOGIN_LOCKOUT_BASE * 2 ** (strikes - 1), LOGIN_LOCKOUT_MAX)
+
+
+def sliding_count(previous, current, now, window):
+    elapsed = (now % window) / window
+    return previous * (1 - elapsed) + current
+
+
+class _Entry:
+    __slots__ = ("bucket", "current", "previous", "strikes", "locked_until", "last_strike")
+
+    def __init__(self):
+        self.bucket = 0
+        self.current = 0
+        self.previous = 0
+        self.strikes = 0
+        self.locked_until = 0.0
+        self.last_strike = 0.0
+
+
+class MemoryBackend:
+    def __init__(self, shards, max_keys):
+        self._shards = [({}, threading.Lock()) for _ in range(shards)]
+        self._max_keys_per_shard = max(1, max_keys // shards)
+
+    def _shard(self, key):
+        return self._shards[hash(key) % len(self._shards)]
+
+    def _prune(self, entries, now, window):
+        # Forget keys that are neither counting nor locked, oldest buckets first
+        current_bucket = int(now // window)
+        stale = [key for key, entry in entries.items()
+                 if entry.bucket < current_bucket - 1 and entry.locked_until <= now
+                 and now - entry.last_strike > LOGIN_LOCKOUT_MAX]
+        for key in stale:
+            del entries[key]
+        if len(entries) >= self._max_keys_per_shard:
+            # Still full (an attack with many keys), drop the quietest half
+            for key in sorted(entries, key=lambda k: entries[k].bucket)[:len(entries) // 2]:
+                del entries[key]
+
+    def hit(self, key, limit, window, now):
+        """Counts an attempt, returns seconds to wait when it's over the limit."""
+        entries, lock = self._shard(key)
+        with lock:
+            entry = entries.get(key)
+            if entry is None:
+                if len(entries) >= self._max_keys_per_shard:
+                    self._prune(entries, now, window)
+                entry = entries[key] = _Entry()
+
+            if entry.locked_until > now:
+                return entry.locked_until - now
+
+            bucket = int(now // window)
+            if bucket != entry.bucket:
+                entry.previous = entry.current if bucket == entry.bucket + 1 else 0
+                entry.current = 0
+                entry.bucket = bucket
+            if sliding_count(entry.previous, entry.current, now, window) >= limit:
+                if now - entry.last_strike > LOGIN_LOCKOUT_MAX + window:
+                    entry.strikes = 0
+                entry.strikes += 1
+                entry.last_strike = now
+                entry.locked_until = now + lockout_duration(entry.strikes)
+                return entry.locked_until - now
+            entry.current += 1
+            return None
+
+    def reset(self, key):
+        entries, lock = self._shard(key)
+        with lock:
+            entries.pop(key, None)
+
+
+def _cache_key(key):
+    # Usernames may hold anything, memcached keys can't have spaces or control characters
+    scope, value = key
+    return f"{scope}:{hashlib.sha1(value.encode()).hexdigest()}"
+
+
+class CacheBackend:
+    """Same algorithm on a Django cache shared by every worker."""
+
+    def __init__(self, alias):
+        self.alias = alias
+
+    @property
+    def cache(self):
+        from django.core.cache import caches
+        return caches[self.alias]
+
+    def _incr(self, key, timeout):
+        cache = self.cache
+        cache.add(key, 0, timeout=timeout)
+        try:
+            return cache.incr(key)
+        except ValueError:  # expired between add and incr
+            cache.set(key, 1, timeout=timeout)
+            return 1
+
+    def hit(self, key, limit, window, now):
+        cache = self.cache
+        key = _cache_key(key)
+        locked_until = cache.get(f"throttle:lock:{key}")
+        if locked_until and locked_until > now:
+            return locked_until - now
+
+        bucket = int(now // window)
+        counts = cache.get_many([f"throttle:{key}:{bucket - 1}", f"throttle:{key}:{bucket}"])
+        previous = counts.get(f"throttle:{key}:{bucket - 1}", 0)
+        current = counts.get(f"throttle:{key}:{bucket}", 0)
+        if sliding_count(previous, current, now, window) >= limit:
+            strikes = self._incr(f"throttle:strikes:{key}", math.ceil(LOGIN_LOCKOUT_MAX + window))
+            duration = lockout_duration(strikes)
+            cache.set(f"throttle:lock:{key}", now + duration, timeout=math.ceil(duration))
+            return duration
+        self._incr(f"throttle:{key}:{bucket}", math.ceil(window * 2))
+        return None
+
+    def reset(self, key):
+        key = _cache_key(key)
+        bucket = int(time.time() // LOGIN_THROTTLE_WINDOW)
+        self.cache.delete_many([f"throttle:{key}:{bucket - 1}", f"throttle:{key}:{bucket}",
+                                f"throttle:lock:{key}", f"throttle:strikes:{key}"])
+
+
+class LoginThrottle:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def check(self, request, user_name):
+        """Counts the attempt, raises Throttled (429 with Retry-After) when over a limit."""
+        if not LOGIN_THROTTLE_ENABLED:
+            return
+        now = time.time()
+        waits = [
+            self.backend.hit(("ip", client_ip(request)), LOGIN_THROTTLE_IP_LIMIT, LOGIN_THROTTLE_WINDOW, now),
+            self.backend.hit(("user", user_name), LOGIN_THROTTLE_USER_LIMIT, LOGIN_THROTTLE_WINDOW, now),
+        ]
+        waits = [wait for wait in waits if wait is not None]
+        if waits:
+            raise Throttled(wait=math.ceil(max(waits)), detail="Too many login attempts, try again later.")
+
+    def success(self, user_name):
+        if LOGIN_THROTTLE_ENABLED:
+            self.backend.reset(("user", user_name))
+
+
+login_throttle = LoginThrottle(CacheBackend(LOGIN_THROTTLE_CACHE) if LOGIN_THROTTLE_BACKEND == "cache"
+                               else MemoryBackend(LOGIN_THROTTLE_SHARDS, LOGIN_THROTTLE_MAX_KEYS))
@@ -15,7 +15,7 @@ import UserManager from "./components/UserManager";
 // Define interfaces for our data types
 interface ServiceType {
   srv_id: number;
-  srv_image: Base64URLString;
+  srv_image_url: string | null;
   srv_name: string;
   srv_ip: string;
   srv_desc: string;
@@ -40,7 +40,7 @@ export default function Dashboard() {
   const [addModalOpen, setAddModalOpen] = useState<boolean>(false);
   const [userManager, setUserManager] = useState<boolean>(false);
   const [newService, setNewService] = useState<Omit<ServiceType, "srv_id">>({
-    srv_image: "/api/placeholder/200/150",
+    srv_image_url: "/api/placeholder/200/150",
     srv_name: "",
     srv_ip: "",
     srv_desc: "",
@@ -228,10 +228,7 @@ export default function Dashboard() {
                   >
                     <div className="aspect-w-16 aspect-h-9 bg-gray-200">
                       <img
-                        src={`data:${service.srv_image
-                          .split(".")
-                          .pop()
-                          ?.toLowerCase()};base64,${service.srv_image}`}
+                        src={`${import.meta.env.VITE_API_URL}${service.srv_image_url}`}
                         alt={service.srv_name}
                         className="w-full h-48 object-cover"
                         onClick={() => handleServiceClick(service.srv_ip)}